@@ -40,8 +40,7 @@ build_db () {
 	echo "Generating Sylph taxonomy"
 	python3 ${HERE}/../../taxtools/build_sylph_taxonomy.py \
 		--samplesheet $SAMPLESHEET \
-		--names_dmp ${TAXONOMY}/names.dmp \
-		--nodes_dmp ${TAXONOMY}/nodes.dmp \
+		--taxonomy ${TAXONOMY} \
 		--use-taxids \
 		--output ${PWD}/sylph_tax_ids.tsv 
 	echo "Done"
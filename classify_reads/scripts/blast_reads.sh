@@ -1,8 +1,12 @@
 #!/bin/bash
 
-# BLAST sample fastq reads against a viral database
+# BLAST sample fastq reads against a viral database. Given an
+# extract_positive_reads output, only the positive reads of each sample and
+# taxid are extracted as queries instead of all reads of the fastq files.
 
 HERE="$(dirname $0)"
+TAXTOOLS="$(realpath ${HERE}/../../taxtools)"
+POSITIVE_READS="${1:+$(realpath $1)}"
 TAXONOMY="${HERE}/../../taxonomy"
 SAMPLESHEET="${HERE}/../inputs/samplesheet.tsv"
 DB="nt_viruses"
@@ -22,13 +26,22 @@ echo "Done"
 
 mkdir queries
 
-echo "Extracting FASTA queries from input fastq files"
-cut -f 2 $SAMPLESHEET \
-	| tail -n +2 \
-	| xargs -n 1 -P 16 -I{} sh -c '
-		seqkit fq2fa -j 1 $1 \
-		> queries/$(basename $1).fa
-	' -- {}
+if [ -n "$POSITIVE_READS" ]; then
+	echo "Extracting positive reads from input fastq files"
+	python3 ${TAXTOOLS}/taxontools.py extract-reads \
+		--positive-reads $POSITIVE_READS \
+		--outdir queries \
+		--index-dir read_indices \
+		--workers 16
+else
+	echo "Extracting FASTA queries from input fastq files"
+	cut -f 2 $SAMPLESHEET \
+		| tail -n +2 \
+		| xargs -n 1 -P 16 -I{} sh -c '
+			seqkit fq2fa -j 1 $1 \
+			> queries/$(basename $1).fa
+		' -- {}
+fi
 echo "Done"
 
 # For some reason using more than one thread made BLAST extremely slow,
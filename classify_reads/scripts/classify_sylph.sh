@@ -3,6 +3,7 @@
 set -ueo
 
 HERE="$(dirname $0)"
+TAXTOOLS="$(realpath ${HERE}/../../taxtools)"
 TAXONOMY="${HERE}/../../taxonomy"
 SYLPH_TAX="${HERE}/../../results/sylph_db/sylph_tax_ids.tsv"
 SAMPLESHEET="${HERE}/../inputs/samplesheet.tsv"
@@ -50,33 +51,13 @@ sylph-tax taxprof \
 echo "Done"
 
 echo "Estimating read counts"
-for SAMPLE in "${FILES[@]}"
-do
-	SAMPLE_BASE=$(basename $SAMPLE)
-	if [ ! -f ${SAMPLE_BASE}.sylphmpa ]; then
-		continue
-	fi
-
-	# get total number of sample reads
-	N_READS=$(seqtk seq -A $SAMPLE | grep "^>" -c)
-
-	# get estimated read counts from sequence abundances
-	echo "read_count" > ${SAMPLE_BASE}.read_counts.tmp
-	tail -n +3 ${SAMPLE_BASE}.sylphmpa \
-		| awk -v n_reads="$N_READS" \
-			'{printf "%1.0f\n", $3 * n_reads / 100}' \
-		>> ${SAMPLE_BASE}.read_counts.tmp
-
-	# add read counts to taxonomic output
-	head -n 1 ${SAMPLE_BASE}.sylphmpa \
-		> ${SAMPLE_BASE}.with_read_counts.sylphmpa
-	paste \
-		<(tail -n +2 ${SAMPLE_BASE}.sylphmpa | cut -f 1-3) \
-		${SAMPLE_BASE}.read_counts.tmp \
-		<(tail -n +2 ${SAMPLE_BASE}.sylphmpa | cut -f 4-) \
-		>> ${SAMPLE_BASE}.with_read_counts.sylphmpa
-	rm ${SAMPLE_BASE}.read_counts.tmp
-done
+# total sample read counts scale the sequence abundances of the
+# <sample>.sylphmpa profiles into <sample>.with_read_counts.sylphmpa
+python3 ${TAXTOOLS}/fastq_stats.py \
+	--sylphmpa-dir . \
+	--output fastq_stats.tsv \
+	--workers 16 \
+	${FILES[@]}
 echo "Done"
 
 mkdir minimap2
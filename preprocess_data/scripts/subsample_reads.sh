@@ -1,15 +1,24 @@
 #!/bin/bash
 
-## Usage: subsample_reads.sh <input fastq files>
+## Usage: subsample_reads.sh [--bases <target bases, e.g. 5000MB>]... <input fastq files>
 
 set -ueo
 
-BASES="5000MB"
+HERE="$(dirname $0)"
+TAXTOOLS="$(realpath ${HERE}/../../taxtools)"
+# all depths are written in one pass over each input file
+DEFAULT_BASES=("5000MB")
+BASES=()
 CPUS=16
 
 while test $# -gt 0
 do
 	case "$1" in
+		# target number of bases, can be repeated for several depths
+		--bases)
+			BASES+=("$2")
+			shift
+		;;
 		# input fastq files
 		*)
 			if [[ "$1" =~ (.fastq|.fq|.fastq.gz|.fq.gz)$ ]]
@@ -24,13 +33,16 @@ do
 	shift
 done
 
-echo "Subsampling input reads to $BASES bases"
+if [ ${#BASES[@]} -eq 0 ]
+then
+	BASES=("${DEFAULT_BASES[@]}")
+fi
+
+echo "Subsampling input reads to ${BASES[@]} bases"
 mkdir -p rasusa
-printf "%s\n" ${FILES[@]} \
-	| xargs -P $CPUS -n 1 -I{} sh -c '
-		rasusa reads \
-			-o rasusa/$(basename $1).subsampled.fq.gz \
-			-b $2 \
-			$1
-		' -- {} $BASES
+python3 ${TAXTOOLS}/subsample_reads.py \
+	$(printf -- "--bases %s " ${BASES[@]}) \
+	--outdir rasusa \
+	--workers $CPUS \
+	${FILES[@]}
 echo "Done"
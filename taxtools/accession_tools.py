@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+"""
+Accession -> taxid lookups over NCBI accession2taxid files. Each file is
+compiled once into a sorted, memory-mappable index next to it, which is
+rebuilt when the file changes. Bulk lookups are vectorised binary searches.
+"""
+
+import csv
+import os
+import tempfile
+import numpy
+import pandas
+from pathlib import Path
+import taxdmp_tools
+import compression_tools
+
+
+ACCESSION2TAXID_FILES = {
+    "nucl": ("nucl_gb.accession2taxid", "nucl_wgs.accession2taxid"),
+    "prot": ("prot.accession2taxid.FULL",),
+}
+INDEX_SUFFIX = ".index.bin"
+# the files can also be kept as downloaded from NCBI
+COMPRESSED_SUFFIX = ".gz"
+
+
+def create_accession_index(taxonomy: str, seq_type: str = "nucl"):
+    # index over the accession2taxid files of a sequence type found in taxonomy
+    paths = []
+    for fname in ACCESSION2TAXID_FILES[seq_type]:
+        path = Path(taxonomy + "/" + fname)
+        if not path.exists():
+            path = Path(taxonomy + "/" + fname + COMPRESSED_SUFFIX)
+        if path.exists():
+            paths.append(path)
+    return(AccessionIndex(paths))
+
+def compile_accession2taxid(path: Path, chunk_size: int = 10000000) -> tuple[dict, dict]:
+    """
+    Sorted accessions and taxids of an accession2taxid file. Each chunk is
+    sorted into a run on disk and the runs are merged into memory-mapped
+    arrays, so that files of a billion rows are compiled in about the memory
+    of one chunk. Accessions listed more than once keep their file order.
+    """
+    # the runs are as large as the index, keep them next to it if possible
+    scratch_dir = str(path.parent) if os.access(path.parent, os.W_OK) else None
+    with tempfile.TemporaryDirectory(dir=scratch_dir, prefix=path.name) as scratch:
+        runs = []
+        with compression_tools.open_input(path) as accession2taxid_fp:
+            header = accession2taxid_fp.readline().rstrip("\n").split("\t")
+            if "accession.version" not in header:
+                return({}, {"accessions": numpy.array([], dtype="S1"),
+                            "taxids": numpy.array([], dtype=numpy.int32)})
+            reader = pandas.read_csv(
+                accession2taxid_fp, sep="\t", header=None, names=header,
+                usecols=["accession.version", "taxid"],
+                dtype={"accession.version": str, "taxid": "int32"},
+                quoting=csv.QUOTE_NONE, chunksize=chunk_size)
+            with reader:
+                for chunk in reader:
+                    accessions = chunk["accession.version"].to_numpy().astype("S")
+                    taxids = chunk["taxid"].to_numpy()
+                    order = sort_order(accessions)
+                    runs.append(write_run(Path(scratch) / str(len(runs)),
+                                          accessions[order], taxids[order]))
+        accessions, taxids = merge_runs(runs, Path(scratch), batch_size=chunk_size)
+    # the merged arrays stay mapped after their files are removed with scratch
+    return({}, {"accessions": accessions, "taxids": taxids})
+
+def sort_order(accessions: numpy.ndarray) -> numpy.ndarray:
+    # stable lexicographic order of byte strings, sorted as big-endian 8-byte
+    # words, which is faster than comparing the strings
+    width = -(-accessions.itemsize // 8) * 8
+    words = accessions.astype(f"S{width}").view(">u8").reshape(len(accessions), width // 8)
+    return(numpy.lexsort(words.T[::-1]))
+
+def write_run(run_path: Path, accessions: numpy.ndarray, taxids: numpy.ndarray) -> tuple:
+    numpy.save(f"{run_path}.accessions.npy", accessions)
+    numpy.save(f"{run_path}.taxids.npy", taxids)
+    return(numpy.load(f"{run_path}.accessions.npy", mmap_mode="r"),
+           numpy.load(f"{run_path}.taxids.npy", mmap_mode="r"))
+
+def merge_runs(runs: list, scratch: Path, batch_size: int) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Merge sorted (accessions, taxids) runs into memory-mapped arrays in
+    scratch, reading about batch_size rows of the runs at a time. Equal
+    accessions keep the order of their runs.
+    """
+    total = sum(len(accessions) for accessions, _ in runs)
+    if not total:
+        return(numpy.array([], dtype="S1"), numpy.array([], dtype=numpy.int32))
+    width = max(accessions.itemsize for accessions, _ in runs)
+    merged_accessions = numpy.lib.format.open_memmap(
+        scratch / "accessions.npy", mode="w+", dtype=f"S{width}", shape=(total,))
+    merged_taxids = numpy.lib.format.open_memmap(
+        scratch / "taxids.npy", mode="w+", dtype=numpy.int32, shape=(total,))
+    starts = [0] * len(runs)
+    written = 0
+    while written < total:
+        block_size = max(1, batch_size // len(runs))
+        while True:
+            blocks = [accessions[start:start + block_size].astype(f"S{width}")
+                      for (accessions, _), start in zip(runs, starts)]
+            # rows below the smallest last accession of the blocks that do not
+            # reach the end of their run are followed by no smaller rows
+            cutoffs = [block[-1] for block, (accessions, _), start in zip(blocks, runs, starts)
+                       if start + block_size < len(accessions)]
+            if not cutoffs:
+                takes = [len(block) for block in blocks]
+            else:
+                cutoff = min(cutoffs)
+                takes = [int(numpy.searchsorted(block, cutoff)) for block in blocks]
+            if sum(takes):
+                break
+            # the blocks all start with the cutoff accession
+            block_size *= 2
+        accessions = numpy.concatenate([block[:take] for block, take in zip(blocks, takes)])
+        taxids = numpy.concatenate([run_taxids[start:start + take]
+                                    for (_, run_taxids), start, take in zip(runs, starts, takes)])
+        order = sort_order(accessions)
+        merged_accessions[written:written + len(order)] = accessions[order]
+        merged_taxids[written:written + len(order)] = taxids[order]
+        starts = [start + take for start, take in zip(starts, takes)]
+        written += len(order)
+    return(merged_accessions, merged_taxids)
+
+def load_accession2taxid(path: Path) -> tuple[numpy.ndarray, numpy.ndarray]:
+    _, arrays = taxdmp_tools.load_cache(
+        cache_path=Path(str(path) + INDEX_SUFFIX),
+        sources={path.name: path},
+        build=lambda: compile_accession2taxid(path))
+    return(arrays["accessions"], arrays["taxids"])
+
+
+class AccessionIndex:
+    """
+    Bulk accession -> taxid lookups over one or more accession2taxid files.
+    Files are searched in order and the first hit wins. Accessions without
+    a version match the lowest indexed version of that accession.
+    """
+    def __init__(self, paths: list):
+        self.indices = [load_accession2taxid(Path(path)) for path in paths]
+
+    def lookup(self, accessions) -> numpy.ndarray:
+        # taxids of accessions, 0 for accessions that are not indexed
+        queries = numpy.char.encode(numpy.asarray(accessions, dtype=str))
+        taxids = numpy.zeros(len(queries), dtype=numpy.int32)
+        if not len(queries):
+            return(taxids)
+        unversioned = numpy.char.find(queries, b".") < 0
+        for keys, key_taxids in self.indices:
+            missing = taxids == 0
+            if not missing.any():
+                break
+            if not len(keys):
+                continue
+            exact = missing & ~unversioned
+            taxids[exact] = search_keys(keys, key_taxids, queries[exact])
+            prefixed = missing & unversioned
+            taxids[prefixed] = search_keys(
+                keys, key_taxids, numpy.char.add(queries[prefixed], b"."), prefix=True)
+        return(taxids)
+
+    def lookup_one(self, accession: str) -> int:
+        return(int(self.lookup([accession])[0]))
+
+def search_keys(keys: numpy.ndarray, key_taxids: numpy.ndarray, queries: numpy.ndarray,
+                prefix: bool = False) -> numpy.ndarray:
+    taxids = numpy.zeros(len(queries), dtype=numpy.int32)
+    # queries longer than the widest key cannot be indexed
+    fits = numpy.char.str_len(queries) <= keys.itemsize
+    if not fits.any():
+        return(taxids)
+    fitting = queries[fits].astype(keys.dtype)
+    positions = numpy.minimum(numpy.searchsorted(keys, fitting), len(keys) - 1)
+    if prefix:
+        found = numpy.char.startswith(keys[positions], fitting)
+    else:
+        found = keys[positions] == fitting
+    taxids[numpy.flatnonzero(fits)[found]] = key_taxids[positions[found]]
+    return(taxids)
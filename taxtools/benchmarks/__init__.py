@@ -0,0 +1,7 @@
+"""
+Benchmarks for taxtools on synthetic taxonomies and classifier outputs.
+
+Run from the taxtools directory with
+
+    python -m benchmarks.bench --workdir /tmp/taxtools_bench --output bench.json
+"""
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+"""
+Time the stages of taxtools (taxonomy compile/load, profile parsing,
+standardisation, summarisation and output) on synthetic data of increasing
+size. Every stage runs in a forked child process, so its wall time, CPU time
+and peak RSS are measured in isolation. Results are written as JSON.
+"""
+
+import click
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import numpy
+import pandas
+import taxdmp_tools
+import taxnoodle
+import extract_positive_reads
+from benchmarks import synthetic
+
+
+TOOLS = ("kraken2", "diamond", "metabuli", "metacache", "sylph")
+
+
+@click.command()
+@click.option(
+    "--workdir",
+    "workdir",
+    required=True,
+    type=click.Path(file_okay=False),
+    help="directory for the generated synthetic data"
+)
+@click.option(
+    "--output",
+    "output_path",
+    required=True,
+    type=click.Path(dir_okay=False),
+    help="path to output json file"
+)
+@click.option(
+    "--scales",
+    "scales",
+    default="1,2,4",
+    show_default=True,
+    type=click.STRING,
+    help="comma-separated size multipliers of the base taxonomy and read counts"
+)
+@click.option(
+    "--taxa",
+    "base_taxa",
+    default=20000,
+    show_default=True,
+    type=click.INT,
+    help="number of taxa in the synthetic taxonomy at scale 1"
+)
+@click.option(
+    "--reads",
+    "base_reads",
+    default=50000,
+    show_default=True,
+    type=click.INT,
+    help="number of reads per sample at scale 1"
+)
+@click.option(
+    "--samples",
+    "num_samples",
+    default=4,
+    show_default=True,
+    type=click.INT,
+    help="number of samples"
+)
+@click.option(
+    "--tools",
+    "tools",
+    default=",".join(TOOLS),
+    show_default=True,
+    type=click.STRING,
+    help="comma-separated classifier tools to benchmark"
+)
+@click.option(
+    "--seed",
+    "seed",
+    default=0,
+    type=click.INT,
+    help="random seed of the data generators"
+)
+def main(workdir: str, output_path: str, scales: str, base_taxa: int, base_reads: int,
+         num_samples: int, tools: str, seed: int):
+    results = []
+    for scale in [int(scale) for scale in scales.split(",")]:
+        scale_dir = Path(workdir) / f"scale_{scale}"
+        taxonomy_dir = scale_dir / "taxonomy"
+        print(f"Generating data at scale {scale}", file=sys.stderr)
+        taxids_at = synthetic.write_taxonomy(taxonomy_dir, num_taxa=base_taxa * scale, seed=seed)
+        samplesheets = synthetic.write_samples(scale_dir / "samples", taxonomy_dir, taxids_at,
+                                               num_samples=num_samples,
+                                               num_reads=base_reads * scale, seed=seed)
+        params = {"scale": scale, "num_taxa": sum(len(taxids) for taxids in taxids_at.values()),
+                  "num_samples": num_samples, "reads_per_sample": base_reads * scale}
+        for result in benchmark_scale(str(taxonomy_dir), samplesheets, tools.split(",")):
+            results.append({**params, **result})
+            print(json.dumps(results[-1]), file=sys.stderr)
+
+    output = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "platform": {"python": platform.python_version(), "machine": platform.machine(),
+                     "numpy": numpy.__version__, "pandas": pandas.__version__},
+        "results": results,
+    }
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "w") as output_fp:
+        json.dump(output, output_fp, indent=2)
+
+def benchmark_scale(taxonomy: str, samplesheets: dict, tools: list):
+    def remove_caches():
+        for cache in (taxdmp_tools.TAXA_CACHE, taxdmp_tools.ANCESTORS_CACHE,
+                      taxdmp_tools.NAMES_CACHE):
+            for path in (Path(taxonomy) / cache, Path(taxonomy) / (cache + ".lock")):
+                path.unlink(missing_ok=True)
+
+    def load_taxa():
+        taxa = taxdmp_tools.create_taxa(taxonomy=taxonomy)
+        taxa.rank_ancestors
+        taxa.names
+        return(taxa)
+
+    remove_caches()
+    yield(time_stage("taxonomy_compile", stage=load_taxa))
+    yield(time_stage("taxonomy_load", stage=load_taxa))
+
+    expected_taxa = tuple(
+        int(line) for line in samplesheets["expected"].read_text().split())
+    for tool in tools:
+        with open(samplesheets[f"taxnoodle.{tool}.report"], "r") as samplesheet_fp:
+            report_profiles = taxnoodle.get_tool_profiles(
+                samplesheet_fp=samplesheet_fp, tool=tool)[tool]
+        with open(samplesheets[f"taxnoodle.{tool}.per_read"], "r") as samplesheet_fp:
+            per_read_profiles = taxnoodle.get_tool_profiles(
+                samplesheet_fp=samplesheet_fp, tool=tool)[tool]
+        with open(samplesheets["extract_positive_reads"], "r") as samplesheet_fp:
+            samplesheet = extract_positive_reads.parse_samplesheet(samplesheet_fp, classifier=tool)
+
+        # taxnoodle
+        def parse_reports():
+            return(taxnoodle.parse_profiles(profiles=report_profiles, classifier=tool))
+        def count_reports():
+            data = parse_reports()
+            return({sample: taxnoodle.get_taxid_counts(tool)(data=data[sample]) for sample in data})
+        def standardise():
+            return(taxnoodle.standardise_counts(taxid_counts=count_reports(), taxa=load_taxa()))
+        yield(time_stage("taxnoodle.parse", tool=tool, stage=parse_reports))
+        yield(time_stage("taxnoodle.count_per_read", tool=tool, stage=lambda: taxnoodle.count_profiles(
+            profiles=per_read_profiles, classifier=tool, per_read=True)))
+        yield(time_stage("taxnoodle.standardise", tool=tool,
+                         setup=lambda: (count_reports(), load_taxa()),
+                         stage=lambda counts, taxa: taxnoodle.standardise_counts(
+                             taxid_counts=counts, taxa=taxa)))
+        yield(time_stage("taxnoodle.summarise", tool=tool,
+                         setup=lambda: (standardise(), load_taxa()),
+                         stage=lambda data, taxa: taxnoodle.summarise_data_at(
+                             data=data, taxa=taxa, taxid_map=taxdmp_tools.map_taxids_to_higher(
+                                 taxids=data["taxonomy_id"], target_rank="species", taxa=taxa))))
+        yield(time_stage("taxnoodle.output", tool=tool, setup=lambda: (standardise(),),
+                         stage=lambda data: taxnoodle.format_tax_data(data).to_csv(os.devnull, sep="\t")))
+
+        # extract_positive_reads
+        def parse_per_read():
+            return(extract_positive_reads.parse_profiles(samplesheet=samplesheet, classifier=tool))
+        yield(time_stage("extract_positive_reads.parse", tool=tool, stage=parse_per_read))
+        yield(time_stage("extract_positive_reads.standardise", tool=tool,
+                         setup=lambda: (parse_per_read(),),
+                         stage=lambda profiles: extract_positive_reads.standardise_profiles(
+                             profiles=profiles)))
+        yield(time_stage("extract_positive_reads.summarise", tool=tool,
+                         setup=lambda: (extract_positive_reads.standardise_profiles(
+                             profiles=parse_per_read()), load_taxa()),
+                         stage=lambda profiles, taxa: extract_positive_reads.summarise_profiles(
+                             profiles=profiles, summarise_at="species", taxa=taxa)))
+        yield(time_stage("extract_positive_reads.stream", tool=tool, setup=lambda: (load_taxa(),),
+                         stage=lambda taxa: extract_positive_reads.stream_profiles(
+                             samplesheet=samplesheet, classifier=tool, summarise_at="species",
+                             taxa=taxa, expected_taxa=expected_taxa, chunk_size=100000)))
+
+def time_stage(name: str, stage, setup=None, tool: str = None) -> dict:
+    """
+    Run setup() and then stage(*setup()) in a forked child process and return
+    the wall time, CPU time and peak RSS of the stage.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            args = setup() if setup else ()
+            rss_before = get_peak_rss()
+            cpu_start = time.process_time()
+            wall_start = time.perf_counter()
+            stage(*args)
+            result = {"wall_time_s": time.perf_counter() - wall_start,
+                      "cpu_time_s": time.process_time() - cpu_start,
+                      "peak_rss_mb": get_peak_rss(),
+                      "peak_rss_increase_mb": get_peak_rss() - rss_before}
+        except Exception as error:
+            result = {"error": repr(error)}
+            status = 1
+        with os.fdopen(write_fd, "w") as result_fp:
+            json.dump(result, result_fp)
+        os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd, "r") as result_fp:
+        result = json.load(result_fp)
+    os.waitpid(pid, 0)
+    return({"stage": name, "tool": tool, **result})
+
+def get_peak_rss() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return(peak_rss / 1024 ** 2)
+    return(peak_rss / 1024)
+
+if __name__ == "__main__":
+    main()
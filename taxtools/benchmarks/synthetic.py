@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""
+Generators of synthetic NCBI taxdump files and classifier outputs in the
+formats parsed by taxnoodle and extract_positive_reads.
+"""
+
+import random
+from pathlib import Path
+
+
+RANKS = ("superkingdom", "phylum", "class", "order", "family", "genus", "species")
+SYLPH_PREFIXES = dict(zip(RANKS, ("d", "p", "c", "o", "f", "g", "s")))
+
+
+def write_taxonomy(taxonomy_dir: Path, num_taxa: int, seed: int = 0) -> dict:
+    """
+    Write nodes.dmp and names.dmp of a random tree with about num_taxa taxa.
+    Each canonical rank has twice as many taxa as the one above it, some
+    taxa hang below unranked "clade" nodes and some species have strains.
+    Returns {rank: [taxids]} of the generated tree.
+    """
+    rng = random.Random(seed)
+    taxonomy_dir.mkdir(parents=True, exist_ok=True)
+    nodes = [(1, 1, "no rank")]
+    taxids_at = {rank: [] for rank in RANKS + ("strain",)}
+    # split taxa over the ranks with geometrically growing counts
+    weights = [2 ** level for level in range(len(RANKS))]
+    counts = [max(2, num_taxa * weight // (sum(weights) + weights[-1] // 2)) for weight in weights]
+    next_taxid = 2
+    for level, (rank, count) in enumerate(zip(RANKS, counts)):
+        for _ in range(count):
+            parent = 1 if level == 0 else rng.choice(taxids_at[RANKS[level - 1]])
+            if level > 0 and rng.random() < 0.05:
+                nodes.append((next_taxid, parent, "clade"))
+                parent = next_taxid
+                next_taxid += 1
+            nodes.append((next_taxid, parent, rank))
+            taxids_at[rank].append(next_taxid)
+            next_taxid += 1
+    for species in taxids_at["species"]:
+        if rng.random() < 0.25:
+            nodes.append((next_taxid, species, "strain"))
+            taxids_at["strain"].append(next_taxid)
+            next_taxid += 1
+
+    with open(taxonomy_dir / "nodes.dmp", "w") as nodes_fp:
+        for taxid, parent, rank in nodes:
+            nodes_fp.write(f"{taxid}\t|\t{parent}\t|\t{rank}\t|\tXX\t|\t0\t|\n")
+    with open(taxonomy_dir / "names.dmp", "w") as names_fp:
+        for taxid, _, rank in nodes:
+            names_fp.write(f"{taxid}\t|\tTaxon {taxid} {rank}\t|\t\t|\tscientific name\t|\n")
+            # NCBI has about as many synonyms and common names as taxa
+            names_fp.write(f"{taxid}\t|\tsynonym {taxid}\t|\t\t|\tsynonym\t|\n")
+    return(taxids_at)
+
+def get_parents(taxonomy_dir: Path) -> dict:
+    parents = {}
+    with open(taxonomy_dir / "nodes.dmp", "r") as nodes_fp:
+        for line in nodes_fp:
+            fields = line.split(sep="|")
+            parents[int(fields[0])] = (int(fields[1]), fields[2].strip())
+    return(parents)
+
+def sample_read_taxids(taxids_at: dict, num_reads: int, rng: random.Random,
+                       unclassified: float = 0.3) -> list:
+    # mostly species/strain level assignments with some at higher ranks
+    pool = taxids_at["species"] * 4 + taxids_at["strain"] + taxids_at["genus"] + taxids_at["family"]
+    return([0 if rng.random() < unclassified else rng.choice(pool) for _ in range(num_reads)])
+
+def write_per_read(path: Path, tool: str, read_taxids: list, prefix: str = "read"):
+    with open(path, "w") as profile_fp:
+        if tool == "metacache":
+            profile_fp.write("# query | rank | name | taxid\n")
+        for i, taxid in enumerate(read_taxids):
+            read_id = f"{prefix}_{i}"
+            match tool:
+                case "kraken2":
+                    status = "C" if taxid else "U"
+                    profile_fp.write(f"{status}\t{read_id}\t{taxid}\t1500\t{taxid}:40 0:12 {taxid}:60\n")
+                case "metabuli":
+                    profile_fp.write(f"{int(taxid > 0)}\t{read_id}\t{taxid}\t1500\t0.95\tspecies\t{taxid}:12\n")
+                case "metacache":
+                    profile_fp.write(f"{read_id} | species | Taxon {taxid} | {taxid}\n")
+                case "diamond":
+                    profile_fp.write(f"{read_id}\t{taxid}\t1e-10\n")
+                case "sylph":
+                    if taxid:
+                        profile_fp.write(f"{read_id}\t{taxid}\n")
+
+def write_report(path: Path, tool: str, read_taxids: list, parents: dict):
+    counts = {}
+    for taxid in read_taxids:
+        counts[taxid] = counts.get(taxid, 0) + 1
+    total = max(len(read_taxids), 1)
+    with open(path, "w") as report_fp:
+        match tool:
+            case "kraken2" | "metabuli":
+                for taxid, count in counts.items():
+                    rank = parents.get(taxid, (0, "U"))[1]
+                    report_fp.write(f"{100 * count / total:.2f}\t{count}\t{count}\t{rank}\t{taxid}\tTaxon {taxid}\n")
+            case "metacache":
+                report_fp.write("# query summary\n# rank | name | taxid | reads | abundance\n")
+                for taxid, count in counts.items():
+                    rank = parents.get(taxid, (0, "unclassified"))[1]
+                    report_fp.write(f"{rank} | Taxon {taxid} | {taxid} | {count} | {100 * count / total:.2f}%\n")
+            case "diamond":
+                write_per_read(path, "diamond", read_taxids)
+            case "sylph":
+                report_fp.write("#SampleID\tsample\n")
+                report_fp.write("clade_name\trelative_abundance\tsequence_abundance\tread_count\n")
+                for taxid, count in counts.items():
+                    if taxid == 0 or parents[taxid][1] != "species":
+                        continue
+                    clade = []
+                    node = taxid
+                    while node != 1:
+                        if parents[node][1] in SYLPH_PREFIXES:
+                            clade.append(f"{SYLPH_PREFIXES[parents[node][1]]}__{node}")
+                        node = parents[node][0]
+                    report_fp.write(
+                        f"{'|'.join(reversed(clade))}\t{100 * count / total:.4f}\t{100 * count / total:.4f}\t{count}\n")
+
+def write_samples(outdir: Path, taxonomy_dir: Path, taxids_at: dict, num_samples: int,
+                  num_reads: int, seed: int = 0) -> dict:
+    """
+    Write per-read outputs and reports of every tool for num_samples samples,
+    plus the samplesheets used by taxnoodle (one per tool and output type)
+    and extract_positive_reads. Returns the samplesheet paths.
+    """
+    rng = random.Random(seed)
+    outdir.mkdir(parents=True, exist_ok=True)
+    parents = get_parents(taxonomy_dir)
+    tools = ("kraken2", "diamond", "metabuli", "metacache", "sylph")
+    rows = []
+    for sample_idx in range(num_samples):
+        sample = f"sample{sample_idx}"
+        read_taxids = sample_read_taxids(taxids_at, num_reads, rng)
+        row = [sample, str(outdir / f"{sample}.fastq")]
+        for tool in tools:
+            per_read = outdir / f"{sample}.{tool}.per_read.tsv"
+            write_per_read(per_read, tool, read_taxids, prefix=sample)
+            write_report(outdir / f"{sample}.{tool}.report.tsv", tool, read_taxids, parents)
+            row.append(str(per_read))
+        rows.append(row)
+
+    samplesheets = {}
+    path = outdir / "extract_positive_reads.samplesheet.tsv"
+    with open(path, "w") as samplesheet_fp:
+        samplesheet_fp.write("\t".join(("sample", "fastq") + tools) + "\n")
+        samplesheet_fp.writelines("\t".join(row) + "\n" for row in rows)
+    samplesheets["extract_positive_reads"] = path
+    for tool in tools:
+        for kind in ("report", "per_read"):
+            path = outdir / f"taxnoodle.{tool}.{kind}.samplesheet.tsv"
+            with open(path, "w") as samplesheet_fp:
+                samplesheet_fp.write("sample\tprofile\n")
+                for row in rows:
+                    samplesheet_fp.write(f"{row[0]}\t{outdir / f'{row[0]}.{tool}.{kind}.tsv'}\n")
+            samplesheets[f"taxnoodle.{tool}.{kind}"] = path
+
+    expected = rng.sample(taxids_at["species"], min(5, len(taxids_at["species"])))
+    path = outdir / "expected.txt"
+    path.write_text("".join(f"{taxid}\n" for taxid in expected))
+    samplesheets["expected"] = path
+    return(samplesheets)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+"""
+Summarise BLAST results of sample reads (outfmt "10 qseqid sseqid evalue
+pident qlen qstart qend sstart send"). Each BLAST CSV is streamed once:
+hits with a query length below a minimum are discarded, hit accessions are
+mapped to taxids and summarised to a taxonomic rank, and reads of the
+sample FASTA queries without any hit are collected.
+
+Multi-hit BLAST or DIAMOND tabular output can also be collapsed to the
+lowest common ancestor of the hit taxa of each read.
+"""
+
+import csv
+import numpy
+import pandas
+from pathlib import Path
+from typing import TextIO
+import taxdmp_tools
+import pool_tools
+import compression_tools
+import metrics
+
+
+# column delimiter and accession2taxid sequence type of tabular hit formats
+HIT_FORMATS = {
+    "blast": (",", "nucl"),
+    "diamond": ("\t", "prot"),
+}
+
+def parse_blast_samplesheet(samplesheet_fp: TextIO):
+    # skip samplesheet header
+    next(samplesheet_fp)
+    samples = []
+    for line in samplesheet_fp:
+        if not line.strip():
+            continue
+        fields = line.rstrip("\n").split(sep="\t")
+        samples.append({"sample": fields[0], "blast": Path(fields[1].strip()),
+                        "fasta": Path(fields[2].strip())})
+    return(samples)
+
+def parse_taxmap(taxmap_fp: TextIO) -> dict:
+    # accession -> taxid from the first two whitespace-separated columns
+    taxmap = {}
+    for line in taxmap_fp:
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+        try:
+            taxmap[fields[0]] = int(fields[1])
+        except ValueError:
+            continue
+    return(taxmap)
+
+def get_hit_accession(sseqid: str) -> str:
+    # e.g. gi|123|gb|MN908947.3| -> MN908947.3
+    fields = sseqid.split(sep="|")
+    if len(fields) >= 4:
+        return(fields[3])
+    return(sseqid)
+
+def read_blast_hits(blast_path: Path, min_qlen: int):
+    read_ids, accessions, scores = [], [], []
+    with compression_tools.open_input(blast_path) as blast_fp:
+        for line in blast_fp:
+            fields = line.rstrip("\n").split(sep=",")
+            if len(fields) < 5 or not fields[4] or float(fields[4]) < min_qlen:
+                continue
+            read_ids.append(fields[0])
+            accessions.append(get_hit_accession(fields[1]))
+            scores.append(",".join(fields[2:]))
+    return(read_ids, accessions, scores)
+
+def map_accessions(accessions: list, accession_index=None, taxmap: dict = None) -> numpy.ndarray:
+    if taxmap is not None:
+        return(numpy.array([taxmap.get(accession, 0) for accession in accessions],
+                           dtype=numpy.int64))
+    return(accession_index.lookup(accessions).astype(numpy.int64))
+
+def get_no_hit_reads(fasta_path: Path, hit_read_ids: set) -> list:
+    # FASTA header lines of query reads without any remaining hit
+    no_hit_reads = []
+    with compression_tools.open_input(fasta_path) as fasta_fp:
+        for line in fasta_fp:
+            if line[0] != ">":
+                continue
+            fields = line[1:].split()
+            if not fields or fields[0] not in hit_read_ids:
+                no_hit_reads.append(line.rstrip("\n"))
+    return(no_hit_reads)
+
+def summarise_blast_sample(sample: dict, outdir: Path, taxa: dict, min_qlen: int,
+                           summarise_at: str, accession_index=None, taxmap: dict = None):
+    read_ids, accessions, scores = read_blast_hits(sample["blast"], min_qlen=min_qlen)
+    taxids = map_accessions(accessions, accession_index=accession_index, taxmap=taxmap)
+    summarised = taxdmp_tools.get_ancestors_at_rank(
+        taxids=taxids, target_rank=summarise_at, taxa=taxa)
+
+    # hits are reported in accession order, hits with unknown accessions are dropped
+    lines = []
+    for read_id, accession, taxid, score in zip(read_ids, accessions, summarised.tolist(), scores):
+        if taxid not in taxa:
+            continue
+        taxon = taxa[taxid]
+        lines.append((accession, f"{read_id},{taxid}|{taxon['name']}|{taxon['rank']},{score}\n"))
+    lines.sort()
+
+    blast_name = sample["blast"].name
+    with open(outdir / "summarised_blast" / blast_name, "w") as summary_fp:
+        summary_fp.writelines(line for _, line in lines)
+
+    no_hit_reads = get_no_hit_reads(sample["fasta"], hit_read_ids=set(read_ids))
+    no_hits_name = blast_name.removesuffix(".blast") + ".no_blast_hits.txt"
+    with open(outdir / no_hits_name, "w") as no_hits_fp:
+        no_hits_fp.write("\n".join(no_hit_reads) + "\n")
+    return(len(lines), len(no_hit_reads))
+
+def summarise_blast(samples: list, outdir: Path, taxa: dict, min_qlen: int = 50,
+                    summarise_at: str = "species", accession_index=None,
+                    taxmap: dict = None, workers: int = 1,
+                    run_metrics: metrics.Metrics = None) -> list:
+    (outdir / "summarised_blast").mkdir(parents=True, exist_ok=True)
+    if isinstance(taxa, taxdmp_tools.Taxa):
+        # load the rank-ancestor table once before forking workers
+        taxa.rank_ancestors
+    summaries = pool_tools.map_samples(
+        summarise_blast_sample, samples, workers=workers, outdir=outdir, taxa=taxa,
+        min_qlen=min_qlen, summarise_at=summarise_at,
+        accession_index=accession_index, taxmap=taxmap,
+        with_metrics=metrics.is_enabled(run_metrics))
+    if metrics.is_enabled(run_metrics):
+        summaries, records = pool_tools.split_metrics(summaries)
+        run_metrics.add_samples("summarise_sample",
+                                [sample["sample"] for sample in samples], records)
+    return(summaries)
+
+def read_hit_columns(hits_path: Path, delimiter: str, subject_column: int = 1,
+                     qlen_column: int = None, min_qlen: int = 0,
+                     chunk_size: int = 1000000) -> tuple[pandas.Series, pandas.Series]:
+    # query read IDs (first column) and a subject column of all hits as strings,
+    # discarding hits with a query length (in qlen_column) below min_qlen
+    filter_qlen = min_qlen > 0 and qlen_column is not None
+    columns = [0, subject_column] + ([qlen_column] if filter_qlen else [])
+    read_ids, subjects = [], []
+    with compression_tools.open_input(hits_path) as hits_fp:
+        try:
+            reader = pandas.read_csv(
+                hits_fp, sep=delimiter, header=None, usecols=columns,
+                dtype=str, quoting=csv.QUOTE_NONE, keep_default_na=False, chunksize=chunk_size)
+        except pandas.errors.EmptyDataError:
+            # blastn writes an empty file for samples without hits
+            return(pandas.Series([], dtype=str), pandas.Series([], dtype=str))
+        with reader:
+            for chunk in reader:
+                if filter_qlen:
+                    qlens = pandas.to_numeric(chunk[qlen_column], errors="coerce")
+                    chunk = chunk.loc[qlens >= min_qlen]
+                read_ids.append(chunk[0])
+                subjects.append(chunk[subject_column])
+    if not read_ids:
+        return(pandas.Series([], dtype=str), pandas.Series([], dtype=str))
+    return(pandas.concat(read_ids, ignore_index=True), pandas.concat(subjects, ignore_index=True))
+
+def parse_staxid(staxids: str) -> int:
+    # first taxid of a ;-separated staxids field, 0 if there is none
+    try:
+        return(int(staxids.split(sep=";", maxsplit=1)[0]))
+    except ValueError:
+        return(0)
+
+def collapse_hits(hits_path: Path, output_fp, taxa: dict, hit_format: str = "blast",
+                  taxid_column: int = None, accession_index=None,
+                  taxmap: dict = None, min_qlen: int = 0, qlen_column: int = 4) -> int:
+    """
+    Write the lowest common ancestor of the hit taxa of each read (in order
+    of first appearance) with its number of hits. Hit taxids are taken from
+    taxid_column (0-based, e.g. staxids) or mapped from the hit accessions.
+    Hits with a query length (in qlen_column, 0-based) below min_qlen are
+    discarded as by summarise_blast, hits with unknown taxa are ignored and
+    reads without any known hit taxon get taxid 0. Returns the number of reads.
+    """
+    delimiter, _ = HIT_FORMATS[hit_format]
+    subject_column = 1 if taxid_column is None else taxid_column
+    read_ids, subjects = read_hit_columns(hits_path, delimiter, subject_column=subject_column,
+                                          qlen_column=qlen_column, min_qlen=min_qlen)
+    # hits share few distinct subjects, each is parsed and mapped once
+    subject_codes, subjects = pandas.factorize(subjects)
+    if taxid_column is not None:
+        subject_taxids = numpy.array([parse_staxid(staxids) for staxids in subjects.tolist()],
+                                     dtype=numpy.int64)
+    else:
+        subject_taxids = map_accessions(
+            [get_hit_accession(sseqid) for sseqid in subjects.tolist()],
+            accession_index=accession_index, taxmap=taxmap)
+    taxids = subject_taxids[subject_codes]
+    read_codes, reads = pandas.factorize(read_ids)
+    _, lcas = taxdmp_tools.get_group_lcas(taxids, read_codes, taxa)
+    num_hits = numpy.bincount(read_codes, minlength=len(reads))
+    output_fp.write("".join(
+        f"{read_id}\t{taxid}\t{hits}\n"
+        for read_id, taxid, hits in zip(reads.tolist(), lcas.tolist(), num_hits.tolist())))
+    return(len(reads))
@@ -6,7 +6,22 @@ import re
 from collections import OrderedDict
 from typing import TextIO
 import taxdmp_tools
+import pool_tools
+import metrics
 from pathlib import Path
+import numpy
+
+
+WANTED_RANKS = (
+    "superkingdom",
+    "phylum",
+    "class",
+    "order",
+    "family",
+    "genus",
+    "species",
+)
+FASTA_FILENAME = re.compile("(^.*?)_(?:ASM|genomic).*")
 
 
 @click.command()
@@ -17,19 +32,23 @@ from pathlib import Path
     type=click.File("r"),
     help="samplesheet file in csv format",
 )
+@click.option(
+    "--taxonomy",
+    "taxonomy",
+    type=click.Path(file_okay=False, exists=True),
+    help="path to directory containing NCBI taxdump files (uses the compiled taxonomy cache)",
+)
 @click.option(
     "--nodes_dmp",
     "nodes_dmp_fp",
-    required=True,
     type=click.File("r"),
-    help="path to nodes.dmp file",
+    help="path to nodes.dmp file (instead of --taxonomy)",
 )
 @click.option(
     "--names_dmp",
     "names_dmp_fp",
-    required=True,
     type=click.File("r"),
-    help="path to names.dmp file",
+    help="path to names.dmp file (instead of --taxonomy)",
 )
 @click.option(
     "--output",
@@ -45,48 +64,128 @@ from pathlib import Path
     default=False,
     help="generate a lineage of taxonomic IDs instead of names"
 )
-
+@click.option(
+    "--taxid-output",
+    "taxid_output_path",
+    type=click.Path(dir_okay=False),
+    help="also write the lineages of taxonomic IDs to this file in the same pass"
+)
+@click.option(
+    "--workers",
+    "workers",
+    type=click.INT,
+    default=1,
+    show_default=True,
+    help="number of processes formatting chunks of samplesheet rows"
+)
+@click.option(
+    "--chunk-size",
+    "chunk_size",
+    type=click.INT,
+    default=100000,
+    show_default=True,
+    help="number of samplesheet rows formatted per chunk"
+)
+@metrics.metrics_options
 def build_sylph_taxonomy(
     samplesheet_fp: TextIO,
+    taxonomy: str,
     nodes_dmp_fp: TextIO,
     names_dmp_fp: TextIO,
     output_path: str,
-    output_taxids: bool
+    output_taxids: bool,
+    taxid_output_path: str,
+    workers: int,
+    chunk_size: int,
+    metrics_path: str,
+    profile_stage: str
 ):
-    
-    output_file = Path(output_path)
+    if not taxonomy and not (nodes_dmp_fp and names_dmp_fp):
+        raise click.UsageError("Give either --taxonomy or both --nodes_dmp and --names_dmp")
+
+    output_file = Path(output_path).resolve()
     output_dir = output_file.parent
     output_dir.mkdir(parents=True, exist_ok=True)
+    # (lineage of taxids, output path) pairs written in the same pass
+    outputs = [(output_taxids, output_file)]
+    if taxid_output_path:
+        outputs.append((True, Path(taxid_output_path).resolve()))
+    run_metrics = metrics.Metrics(command="build_sylph_taxonomy",
+                                  path=metrics_path and os.path.abspath(metrics_path),
+                                  profile_stage=profile_stage)
+
+    with run_metrics.stage("taxonomy_load"):
+        if taxonomy:
+            taxa = taxdmp_tools.create_taxa(taxonomy=os.path.abspath(taxonomy))
+        else:
+            taxa = taxdmp_tools.Taxa(taxdmp_tools.taxa_dict_to_arrays(
+                taxdmp_tools.build_taxa_dict(nodes_dmp_fp, names_dmp_fp)))
+        # compute the rank-ancestor table once before forking workers
+        taxa.rank_ancestors
     os.chdir(output_dir)
 
-    taxa = taxdmp_tools.build_taxa_dict(nodes_dmp_fp, names_dmp_fp)
+    with run_metrics.stage("samplesheet") as stage:
+        taxids, fasta_paths = parse_samplesheet(samplesheet_fp)
+        stage["rows"] = len(taxids)
+    unknown = ~taxa.known(taxids)
+    if unknown.any():
+        raise click.ClickException(
+            f"Unknown taxid in samplesheet: {taxids[unknown][0]}")
+
+    chunks = [
+        (taxids[start:start + chunk_size], fasta_paths[start:start + chunk_size])
+        for start in range(0, len(taxids), max(chunk_size, 1))
+    ]
+    with run_metrics.stage("lineages") as stage:
+        formatted = pool_tools.map_samples(
+            format_lineage_chunk, chunks, workers=workers, taxa=taxa,
+            wanted_ranks=WANTED_RANKS, formats={taxid_format for taxid_format, _ in outputs})
+        for taxid_format, path in outputs:
+            with open(path, "w") as f_taxonomy:
+                for lines in formatted:
+                    f_taxonomy.write(lines[taxid_format])
+        stage["rows"] = len(taxids)
+    run_metrics.write()
+
+
+def parse_samplesheet(samplesheet_fp: TextIO) -> tuple[numpy.ndarray, list]:
+    taxids, fasta_paths = [], []
+    next(samplesheet_fp)  # skip header
+    for line in samplesheet_fp:
+        if not line.strip():
+            continue
+        fields = line.split(sep=",")
+        taxids.append(int(fields[1]))
+        fasta_paths.append(fields[2])
+    return(numpy.array(taxids, dtype=numpy.int64), fasta_paths)
 
-    wanted_ranks = (
-        "superkingdom",
-        "phylum",
-        "class",
-        "order",
-        "family",
-        "genus",
-        "species",
-    )
 
-    with open(output_file, "w") as f_taxonomy:
-        next(samplesheet_fp)  # skip header
-        for line in samplesheet_fp:
-            if not line.strip():
-                continue
-            fields = line.split(sep=",")
-            taxid = int(fields[1])
-            fasta_dna = format_sylph_fasta_filename(fields[2]).split("/")[-1]
-            taxonomy = format_sylph_taxonomy(
-                taxdmp_tools.get_lineage(
-                    first_taxid=taxid,
-                    taxa=taxa,
-                    wanted_ranks=wanted_ranks,
-                    output_taxids=output_taxids)
-            )
-            f_taxonomy.write("\t".join([fasta_dna, taxonomy]) + "\n")
+def format_lineage_chunk(chunk: tuple, taxa: dict, wanted_ranks: tuple,
+                         formats: set) -> dict:
+    # Sylph taxonomy text of a chunk of samplesheet rows, for each format
+    # (False: names, True: taxids). The lineage of every distinct taxid and
+    # every ancestor name is formatted once.
+    taxids, fasta_paths = chunk
+    unique_taxids, inverse = numpy.unique(taxids, return_inverse=True)
+    lineages = taxdmp_tools.get_lineages(unique_taxids, taxa=taxa, wanted_ranks=wanted_ranks)
+    names = {}
+    if False in formats:
+        names = {ancestor: taxa.name(ancestor)
+                 for ancestor in numpy.unique(lineages).tolist() if ancestor > 0}
+    fasta_names = [format_sylph_fasta_filename(fasta).split("/")[-1] for fasta in fasta_paths]
+    lines = {}
+    for output_taxids in formats:
+        formatted = [
+            format_sylph_taxonomy(OrderedDict(
+                (rank, (ancestor if output_taxids else names[ancestor]) if ancestor > 0 else None)
+                for rank, ancestor in zip(wanted_ranks, lineage)))
+            for lineage in lineages.tolist()
+        ]
+        lines[output_taxids] = "".join(
+            fasta_name + "\t" + formatted[row] + "\n"
+            for fasta_name, row in zip(fasta_names, inverse.reshape(-1).tolist())
+        )
+    return(lines)
 
 
 def format_sylph_taxonomy(taxonomy: OrderedDict) -> str:
@@ -98,7 +197,7 @@ def format_sylph_taxonomy(taxonomy: OrderedDict) -> str:
 
 
 def format_sylph_fasta_filename(fname: str) -> str:
-    r = re.search("(^.*?)_(?:ASM|genomic).*", fname)
+    r = FASTA_FILENAME.search(fname)
     if not r:
         return fname
     return r.groups()[0]
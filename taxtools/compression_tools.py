@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+"""
+Transparent reading of plain, gzip/bgzip and zstd compressed inputs. The
+compression is detected from the magic bytes of a file, not its name.
+Decompression runs outside of the parsing thread: in an external
+(multi-threaded where available) decompressor process, or in a background
+thread that reads ahead of the parser. Outputs are compressed (by their
+suffix) in a background writer thread per file.
+"""
+
+import gzip
+import io
+import queue
+import shutil
+import struct
+import subprocess
+import threading
+import zlib
+from pathlib import Path
+import numpy
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# gzip member header with the extra field bgzip writes the block size in
+BGZF_HEADER = b"\x1f\x8b\x08\x04"
+BGZF_HEADER_SIZE = 18
+BLOCK_SIZE = 1 << 20
+READ_AHEAD_BLOCKS = 8
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def get_compression(path: Path):
+    # "gzip" (including bgzip), "zstd" or None for uncompressed files
+    with open(path, "rb") as input_fp:
+        magic = input_fp.read(4)
+    if magic[:2] == GZIP_MAGIC:
+        return("gzip")
+    if magic == ZSTD_MAGIC:
+        return("zstd")
+    return(None)
+
+def is_bgzf(path: Path) -> bool:
+    # bgzip compressed files can be read at random offsets with BgzfReader
+    with open(path, "rb") as input_fp:
+        header = input_fp.read(BGZF_HEADER_SIZE)
+    return(header[:4] == BGZF_HEADER and header[12:14] == b"BC")
+
+def read_bgzf_block(bgzf_fp) -> bytes:
+    # decompressed data of the BGZF block at the current position, None at EOF
+    header = bgzf_fp.read(BGZF_HEADER_SIZE)
+    if not header:
+        return(None)
+    if len(header) < BGZF_HEADER_SIZE or header[:4] != BGZF_HEADER:
+        raise ValueError(f"Invalid BGZF block at offset {bgzf_fp.tell() - len(header)}")
+    extra_size = struct.unpack("<H", header[10:12])[0]
+    block_size = struct.unpack("<H", header[16:18])[0] + 1
+    block = bgzf_fp.read(block_size - BGZF_HEADER_SIZE)
+    # compressed data is followed by the CRC32 and size of the block data
+    return(zlib.decompress(block[extra_size - 6:-8], wbits=-15))
+
+def iter_bgzf_blocks(path: Path):
+    # (compressed offset, decompressed data) of each block of a BGZF file
+    with open(path, "rb") as bgzf_fp:
+        while True:
+            offset = bgzf_fp.tell()
+            data = read_bgzf_block(bgzf_fp)
+            if data is None:
+                return
+            yield(offset, data)
+
+def open_input(path: Path, mode: str = "r"):
+    """
+    Open a possibly compressed file for reading in text ("r") or binary
+    ("rb") mode.
+    """
+    compression = get_compression(path)
+    if compression is None:
+        return(open(path, mode))
+    raw = io.BufferedReader(open_decompressed(path, compression), buffer_size=BLOCK_SIZE)
+    if "b" in mode:
+        return(raw)
+    return(io.TextIOWrapper(raw, encoding="utf-8"))
+
+def open_decompressed(path: Path, compression: str) -> io.RawIOBase:
+    match compression:
+        case "gzip":
+            if shutil.which("pigz"):
+                return(ProcessReader(["pigz", "-dc", str(path)]))
+            # zlib releases the GIL while inflating, so the thread runs alongside parsing
+            return(ThreadedReader(gzip.open(path, "rb")))
+        case "zstd":
+            if shutil.which("zstd"):
+                return(ProcessReader(["zstd", "-dcq", str(path)]))
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError(
+                    f"{path} is zstd compressed. Install the zstd command or the "
+                    "zstandard python package to read it.")
+            return(ThreadedReader(
+                zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)))
+
+def open_output(path: Path):
+    """
+    Open a binary output file, compressed by a background thread if its
+    name ends in .gz or .zst.
+    """
+    path = Path(path)
+    match path.suffix:
+        case ".gz":
+            return(ThreadedWriter(gzip.open(path, "wb", compresslevel=GZIP_LEVEL)))
+        case ".zst":
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError(
+                    f"Install the zstandard python package to write {path}")
+            return(ThreadedWriter(zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(
+                open(path, "wb"), closefd=True)))
+    return(open(path, "wb"))
+
+
+class ThreadedReader(io.RawIOBase):
+    """
+    Raw stream over a decompressing file object which is read ahead in a
+    background thread.
+    """
+    def __init__(self, source, block_size: int = BLOCK_SIZE,
+                 read_ahead: int = READ_AHEAD_BLOCKS):
+        self.source = source
+        self.block_size = block_size
+        self.blocks = queue.Queue(maxsize=read_ahead)
+        self.pending = memoryview(b"")
+        self.eof = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._read_ahead, daemon=True)
+        self.thread.start()
+
+    def _read_ahead(self):
+        try:
+            while not self.stopped.is_set():
+                block = self.source.read(self.block_size)
+                self._put(block)
+                if not block:
+                    return
+        except Exception as error:
+            self._put(error)
+
+    def _put(self, item):
+        # give up once the reader was closed and nobody takes blocks anymore
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self) -> bool:
+        return(True)
+
+    def readinto(self, buffer) -> int:
+        while not len(self.pending):
+            if self.eof:
+                return(0)
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                self.eof = True
+                return(0)
+            self.pending = memoryview(block)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return(size)
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.source.close()
+        super().close()
+
+
+class ThreadedWriter(io.RawIOBase):
+    """
+    Raw output stream handing blocks to a compressing file object in a
+    background thread, so that several outputs are compressed in parallel
+    with the producer.
+    """
+    def __init__(self, sink, write_behind: int = READ_AHEAD_BLOCKS):
+        self.sink = sink
+        self.blocks = queue.Queue(maxsize=write_behind)
+        self.error = None
+        self.thread = threading.Thread(target=self._write_behind, daemon=True)
+        self.thread.start()
+
+    def _write_behind(self):
+        while (block := self.blocks.get()) is not None:
+            if self.error is not None:
+                continue
+            try:
+                self.sink.write(block)
+            except Exception as error:
+                self.error = error
+
+    def writable(self) -> bool:
+        return(True)
+
+    def write(self, block) -> int:
+        if self.error is not None:
+            raise self.error
+        self.blocks.put(bytes(block))
+        return(len(block))
+
+    def close(self):
+        if not self.closed:
+            self.blocks.put(None)
+            self.thread.join()
+            try:
+                self.sink.close()
+            finally:
+                super().close()
+            if self.error is not None:
+                raise self.error
+
+
+class BgzfReader:
+    """
+    Random access to the decompressed data of a BGZF file, given the
+    compressed offsets and the decompressed start offsets of its blocks.
+    """
+    def __init__(self, path: Path, block_offsets: numpy.ndarray, block_starts: numpy.ndarray):
+        self.bgzf_fp = open(path, "rb")
+        self.block_offsets = block_offsets
+        self.block_starts = block_starts
+        self.block = -1
+        self.data = b""
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        block = int(numpy.searchsorted(self.block_starts, offset, side="right")) - 1
+        parts = []
+        while size > 0 and 0 <= block < len(self.block_offsets):
+            if block != self.block:
+                self.bgzf_fp.seek(int(self.block_offsets[block]))
+                self.block, self.data = block, read_bgzf_block(self.bgzf_fp)
+            start = offset - int(self.block_starts[block])
+            part = self.data[start:start + size]
+            parts.append(part)
+            offset += len(part)
+            size -= len(part)
+            block += 1
+        return(b"".join(parts))
+
+    def close(self):
+        self.bgzf_fp.close()
+
+
+class ProcessReader(io.RawIOBase):
+    """
+    Raw stream over the stdout of an external decompressor.
+    """
+    def __init__(self, command: list):
+        self.command = command
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+        self.eof = False
+
+    def readable(self) -> bool:
+        return(True)
+
+    def readinto(self, buffer) -> int:
+        size = self.process.stdout.readinto(buffer)
+        if not size:
+            self.eof = True
+            self.check()
+        return(size)
+
+    def check(self):
+        # only fail on decompressor errors, not on being closed before the end
+        if self.process.wait() != 0 and self.eof:
+            message = self.process.stderr.read().decode().strip()
+            raise OSError(f"{' '.join(self.command)} failed: {message}")
+
+    def close(self):
+        if not self.closed:
+            self.process.stdout.close()
+            self.process.wait()
+            self.process.stderr.close()
+        super().close()
@@ -12,15 +12,32 @@ sample1    /path/to/sample1.fq  taxid1  read1,read2,...,readN
 ...
 
 where taxid1 is the taxonomic identifier of an expected taxon 
+
+With --clade, only reads classified within one of the given clades (e.g.
+10239 for viruses) are considered.
 """
 
 import click
-from typing import TextIO
+import csv
+from typing import Iterator, TextIO
 import taxdmp_tools
+import pool_tools
+import metrics
+import compression_tools
 from pathlib import Path
 import pandas
 
 
+# (read_id, taxid) column positions and maximum field count of tab-separated
+# per-read classifier outputs, used by the streaming parser
+STREAMED_COLUMNS = {
+    "kraken2": (1, 2, 5),
+    "metabuli": (1, 2, 7),
+    "diamond": (0, 1, 3),
+    "sylph": (0, 1, 2),
+}
+
+
 @click.command()
 @click.option(
     "--samplesheet",
@@ -63,6 +80,30 @@ import pandas
     type=click.File("r"),
     help="text file with expected positive taxids, one per line"
 )
+@click.option(
+    "--clade",
+    "clades",
+    multiple=True,
+    type=click.INT,
+    help="only keep reads classified within this clade, e.g. 10239 for viruses (can be repeated)"
+)
+@click.option(
+    "--chunk-size",
+    "chunk_size",
+    type=click.INT,
+    default=1000000,
+    show_default=True,
+    help="number of profile lines parsed and processed at a time (0 to read whole profiles into memory)"
+)
+@click.option(
+    "--workers",
+    "workers",
+    type=click.INT,
+    default=1,
+    show_default=True,
+    help="number of samples processed in parallel"
+)
+@metrics.metrics_options
 
 def main(
         samplesheet_fp: TextIO,
@@ -70,25 +111,54 @@ def main(
         tool: str,
         taxonomy: str,
         summarise_at: str,
-        expected_fp: TextIO
+        expected_fp: TextIO,
+        clades: tuple,
+        chunk_size: int,
+        workers: int,
+        metrics_path: str,
+        profile_stage: str
 ):
 
     output_file = Path(output_path)
     output_file.parent.mkdir(parents=True, exist_ok=True)
-    taxa = taxdmp_tools.create_taxa(taxonomy=taxonomy)
+    run_metrics = metrics.Metrics(command="extract_positive_reads", path=metrics_path,
+                                  profile_stage=profile_stage)
+    with run_metrics.stage("taxonomy_load"):
+        taxa = taxdmp_tools.create_taxa(taxonomy=taxonomy)
 
     samplesheet = parse_samplesheet(samplesheet_fp, classifier=tool)
     expected_taxa = parse_expected_taxa(expected_fp)
-    
-    classifier_profiles = parse_profiles(samplesheet=samplesheet, classifier=tool)
-    std_profiles = standardise_profiles(profiles=classifier_profiles)
-    summarised_profiles = summarise_profiles(profiles=std_profiles,
-                                             summarise_at=summarise_at,
-                                             taxa=taxa)
-    filtered_profiles = filter_profiles(profiles=summarised_profiles, expected_taxa=expected_taxa)
 
-    output_data = get_output_data(profiles=filtered_profiles, samplesheet=samplesheet, expected_taxa=expected_taxa)
-    format_output(output_data).to_csv(output_file, sep="\t", index=False)
+    if chunk_size > 0:
+        with run_metrics.stage("stream"):
+            filtered_profiles = stream_profiles(samplesheet=samplesheet, classifier=tool,
+                                                summarise_at=summarise_at, taxa=taxa,
+                                                expected_taxa=expected_taxa, clades=clades,
+                                                chunk_size=chunk_size, workers=workers,
+                                                run_metrics=run_metrics)
+    else:
+        with run_metrics.stage("parse"):
+            classifier_profiles = parse_profiles(samplesheet=samplesheet, classifier=tool,
+                                                 workers=workers, run_metrics=run_metrics)
+        with run_metrics.stage("standardise") as stage:
+            std_profiles = standardise_profiles(profiles=classifier_profiles)
+            if clades:
+                std_profiles = filter_clade_profiles(profiles=std_profiles, clades=clades,
+                                                     taxa=taxa)
+            stage["rows"] = sum(len(profile) for profile in std_profiles.values())
+        with run_metrics.stage("summarise") as stage:
+            summarised_profiles = summarise_profiles(profiles=std_profiles,
+                                                     summarise_at=summarise_at,
+                                                     taxa=taxa)
+            stage["rows"] = sum(len(profile) for profile in summarised_profiles.values())
+        with run_metrics.stage("filter"):
+            filtered_profiles = filter_profiles(profiles=summarised_profiles, expected_taxa=expected_taxa)
+
+    with run_metrics.stage("output") as stage:
+        stage["rows"] = sum(len(profile) for profile in filtered_profiles.values())
+        write_output(profiles=filtered_profiles, samplesheet=samplesheet,
+                     expected_taxa=expected_taxa, output_file=output_file)
+    run_metrics.write()
 
 def parse_samplesheet(samplesheet_fp: TextIO, classifier: str):
     match classifier:
@@ -113,17 +183,22 @@ def parse_samplesheet(samplesheet_fp: TextIO, classifier: str):
         data["profile"].append(fields[profile_idx].strip())
     return(pandas.DataFrame(data))
 
-def get_output_data(profiles: dict, samplesheet: pandas.DataFrame, expected_taxa: tuple):
-    df = pandas.DataFrame({"sample": [], "fastq": [], "taxid": [], "reads": []})
+def iter_output_rows(profiles: dict, samplesheet: pandas.DataFrame, expected_taxa: tuple):
+    # one (sample, fastq, taxid, reads) row per sample and expected taxon,
+    # scanning each sample profile once
+    fastqs = {}
+    for sample, fastq in zip(samplesheet["sample"], samplesheet["fastq"]):
+        fastqs.setdefault(sample, fastq)
     for sample, profile in profiles.items():
+        reads_by_taxid = profile.groupby("taxid", sort=False)["read_id"].agg(list).to_dict()
         for taxid in expected_taxa:
-            reads = list(profile.loc[profile["taxid"] == taxid, "read_id"])
-            fastq = list(samplesheet.loc[samplesheet["sample"] == sample, "fastq"])[0]
-            row = pandas.DataFrame(
-                {"sample": [sample], "fastq": [fastq],
-                 "taxid": [taxid], "reads": [reads]}
-            )
-            df = pandas.concat([df,row])
+            yield(sample, fastqs[sample], int(taxid), reads_by_taxid.get(taxid, []))
+
+def get_output_data(profiles: dict, samplesheet: pandas.DataFrame, expected_taxa: tuple):
+    df = pandas.DataFrame(
+        list(iter_output_rows(profiles=profiles, samplesheet=samplesheet,
+                              expected_taxa=expected_taxa)),
+        columns=["sample", "fastq", "taxid", "reads"])
     return(df.astype({"taxid": int}))
 
 def format_output(data: pandas.DataFrame):
@@ -131,36 +206,38 @@ def format_output(data: pandas.DataFrame):
     formatted_data["reads"] = data["reads"].apply(lambda reads_list: ",".join(reads_list))
     return(formatted_data)
 
+def write_output(profiles: dict, samplesheet: pandas.DataFrame, expected_taxa: tuple,
+                 output_file: Path):
+    # write output rows as they are built instead of materialising the table
+    with open(output_file, "w", newline="") as output_fp:
+        writer = csv.writer(output_fp, delimiter="\t", lineterminator="\n")
+        writer.writerow(["sample", "fastq", "taxid", "reads"])
+        for sample, fastq, taxid, reads in iter_output_rows(
+                profiles=profiles, samplesheet=samplesheet, expected_taxa=expected_taxa):
+            writer.writerow([sample, fastq, taxid, ",".join(reads)])
+
+def standardise_profile(profile: pandas.DataFrame):
+    return(profile.loc[profile["taxid"] > 0, ["taxid","read_id"]])
+
 def standardise_profiles(profiles: dict):
-    def standardise_profile(profile: pandas.DataFrame):
-        return(profile.loc[profile["taxid"] > 0, ["taxid","read_id"]])
     std_profiles = {}
     for sample in profiles:
         std_profiles[sample] = standardise_profile(profile=profiles[sample])
     return(std_profiles)
 
+def summarise_profile(profile: pandas.DataFrame, summarise_at: str, taxa: dict):
+    summarised_profile = profile.copy()
+    summarised_profile["taxid"] = taxdmp_tools.get_ancestors_at_rank(
+        taxids=profile["taxid"], target_rank=summarise_at, taxa=taxa)
+    at_rank = taxdmp_tools.have_rank(
+        taxids=summarised_profile["taxid"], rank=summarise_at, taxa=taxa)
+    return(summarised_profile.loc[at_rank, ["taxid", "read_id"]])
+
 def summarise_profiles(profiles: dict, summarise_at: str, taxa: dict):
-    def summarise_taxid(taxid: int):
-        return(taxdmp_tools.get_ancestor_at_rank(
-            first_taxid=taxid, target_rank=summarise_at, taxa=taxa
-        ))
-    def summarise_profile(profile: pandas.DataFrame):
-        summarised_profile = profile.copy()
-        summarised_profile["taxid"] = list(map(summarise_taxid,
-                                    profile["taxid"]))
-        tax_ranks = []
-        for taxid in summarised_profile["taxid"]:
-            try:
-                tax_ranks.append(taxa[taxid]["rank"])
-            except KeyError:
-                tax_ranks.append("unknown")
-        summarised_profile["tax_rank"] = tax_ranks
-        return(summarised_profile.loc[
-            summarised_profile["tax_rank"] == summarise_at, ["taxid", "read_id"]])
-            
     summarised_profiles = {}
     for sample in profiles:
-        summarised_profiles[sample] = summarise_profile(profile=profiles[sample])
+        summarised_profiles[sample] = summarise_profile(
+            profile=profiles[sample], summarise_at=summarise_at, taxa=taxa)
     return(summarised_profiles)
 
 def parse_expected_taxa(expected_fp: TextIO):
@@ -171,37 +248,151 @@ def parse_expected_taxa(expected_fp: TextIO):
         expected_taxa.append(int(line.strip()))
     return(tuple(expected_taxa))
 
+def filter_profile(profile: pandas.DataFrame, expected_taxa: tuple):
+    return(profile.loc[profile["taxid"].isin(expected_taxa), ["taxid", "read_id"]])
+
 def filter_profiles(profiles: dict, expected_taxa: tuple):
-    def filter_profile(profile: pandas.DataFrame):
-        return(profile.loc[profile["taxid"].isin(expected_taxa), ["taxid", "read_id"]])
     filtered_profiles = {}
     for sample in profiles:
-        filtered_profiles[sample] = filter_profile(profile=profiles[sample])
+        filtered_profiles[sample] = filter_profile(
+            profile=profiles[sample], expected_taxa=expected_taxa)
     return(filtered_profiles)
 
-def parse_profiles(samplesheet: pandas.DataFrame, classifier: str):
-    profile_data = {}
-    for sample in samplesheet["sample"]:
-        profile_path = list(samplesheet.loc[samplesheet["sample"] == sample, "profile"])[0]
-        if not profile_path:
-            profile_data[sample] = pandas.DataFrame(
-                {"read_id": [], "taxid": []}
-            )
-            continue
-        with open(profile_path, "r") as profile_fp:
-            profile = profile_fp.readlines()
-        match classifier:
-            case "kraken2":
-                profile_data[sample] = parse_k2_profile(profile=profile)
-            case "metabuli":
-                profile_data[sample] = parse_metabuli_profile(profile=profile)
-            case "diamond":
-                profile_data[sample] = parse_diamond_profile(profile=profile)
-            case "metacache":
-                profile_data[sample] = parse_metacache_profile(profile=profile)
-            case "sylph":
-                profile_data[sample] = parse_sylph_mapped_reads(profile=profile)
-    return(profile_data)
+def filter_clade_profile(profile: pandas.DataFrame, clades: tuple, taxa: dict):
+    return(profile.loc[taxdmp_tools.are_in_clades(profile["taxid"], clades=clades, taxa=taxa),
+                       ["taxid", "read_id"]])
+
+def filter_clade_profiles(profiles: dict, clades: tuple, taxa: dict):
+    clade_profiles = {}
+    for sample in profiles:
+        clade_profiles[sample] = filter_clade_profile(
+            profile=profiles[sample], clades=clades, taxa=taxa)
+    return(clade_profiles)
+
+def stream_profiles(samplesheet: pandas.DataFrame, classifier: str, summarise_at: str,
+                    taxa: dict, expected_taxa: tuple, chunk_size: int, workers: int = 1,
+                    run_metrics: metrics.Metrics = None, clades: tuple = ()):
+    """
+    Parse, standardise, summarise and filter each sample profile one chunk
+    at a time, so that only positive reads of expected taxa are kept in memory.
+    """
+    # reads of taxa that cannot summarise to an expected taxon are dropped
+    # by the parser, before any summarisation
+    keep_taxids = taxdmp_tools.get_rank_descendants(
+        ancestors=expected_taxa, target_rank=summarise_at, taxa=taxa)
+    if clades:
+        keep_taxids = keep_taxids[taxdmp_tools.are_in_clades(keep_taxids, clades=clades, taxa=taxa)]
+    filtered_profiles = pool_tools.map_samples(
+        stream_profile, samplesheet["profile"], workers=workers,
+        classifier=classifier, summarise_at=summarise_at, taxa=taxa,
+        expected_taxa=expected_taxa, chunk_size=chunk_size, keep_taxids=keep_taxids,
+        with_metrics=metrics.is_enabled(run_metrics))
+    if metrics.is_enabled(run_metrics):
+        filtered_profiles, records = pool_tools.split_metrics(filtered_profiles)
+        run_metrics.add_samples("stream_sample", samplesheet["sample"], records)
+    return(dict(zip(samplesheet["sample"], filtered_profiles)))
+
+def stream_profile(profile_path: str, classifier: str, summarise_at: str, taxa: dict,
+                   expected_taxa: tuple, chunk_size: int, keep_taxids=None):
+    filtered_chunks = [
+        filter_profile(
+            profile=summarise_profile(
+                profile=standardise_profile(profile=chunk),
+                summarise_at=summarise_at, taxa=taxa),
+            expected_taxa=expected_taxa)
+        for chunk in iter_profile_chunks(profile_path=profile_path,
+                                         classifier=classifier,
+                                         chunk_size=chunk_size,
+                                         keep_taxids=keep_taxids)
+    ]
+    if not filtered_chunks:
+        return(pandas.DataFrame(
+            {"taxid": pandas.Series([], dtype="int32"),
+             "read_id": pandas.Series([], dtype=str)}))
+    return(pandas.concat(filtered_chunks))
+
+def iter_profile_chunks(profile_path: str, classifier: str, chunk_size: int,
+                        keep_taxids=None) -> Iterator[pandas.DataFrame]:
+    # yield (read_id, taxid) frames of at most chunk_size profile lines,
+    # optionally only keeping reads assigned to one of keep_taxids
+    if not profile_path:
+        return
+    if classifier == "metacache":
+        yield from iter_metacache_chunks(profile_path=profile_path, chunk_size=chunk_size,
+                                         keep_taxids=keep_taxids)
+        return
+    read_id_col, taxid_col, num_fields = STREAMED_COLUMNS[classifier]
+    names = [f"field_{i}" for i in range(num_fields)]
+    names[read_id_col], names[taxid_col] = "read_id", "taxid"
+    with compression_tools.open_input(profile_path) as profile_fp:
+        try:
+            reader = pandas.read_csv(
+                profile_fp, sep="\t", header=None, names=names,
+                usecols=["read_id", "taxid"], dtype={"read_id": str, "taxid": "int32"},
+                quoting=csv.QUOTE_NONE, keep_default_na=False, index_col=False,
+                chunksize=chunk_size)
+            with reader:
+                for chunk in reader:
+                    if keep_taxids is not None:
+                        chunk = chunk.loc[chunk["taxid"].isin(keep_taxids)]
+                    yield(chunk[["read_id", "taxid"]])
+        except pandas.errors.EmptyDataError:
+            return
+
+def iter_metacache_chunks(profile_path: str, chunk_size: int,
+                          keep_taxids=None) -> Iterator[pandas.DataFrame]:
+    if keep_taxids is not None:
+        keep_taxids = set(int(taxid) for taxid in keep_taxids)
+    data = {"read_id": [], "taxid": []}
+    num_lines = 0
+    with compression_tools.open_input(profile_path) as profile_fp:
+        for line in profile_fp:
+            if not line.strip() or line[0] == "#":
+                continue
+            fields = line.split(sep="|")
+            taxid = int(fields[3].strip())
+            num_lines += 1
+            if keep_taxids is None or taxid in keep_taxids:
+                data["read_id"].append(fields[0].strip())
+                data["taxid"].append(taxid)
+            if num_lines == chunk_size:
+                num_lines = 0
+                if data["read_id"]:
+                    yield(pandas.DataFrame(data).astype({"taxid": "int32"}))
+                    data = {"read_id": [], "taxid": []}
+    if data["read_id"]:
+        yield(pandas.DataFrame(data).astype({"taxid": "int32"}))
+
+def parse_profiles(samplesheet: pandas.DataFrame, classifier: str, workers: int = 1,
+                   run_metrics: metrics.Metrics = None):
+    profile_paths = [
+        list(samplesheet.loc[samplesheet["sample"] == sample, "profile"])[0]
+        for sample in samplesheet["sample"]
+    ]
+    profiles = pool_tools.map_samples(parse_profile, profile_paths, workers=workers,
+                                      classifier=classifier,
+                                      with_metrics=metrics.is_enabled(run_metrics))
+    if metrics.is_enabled(run_metrics):
+        profiles, records = pool_tools.split_metrics(profiles)
+        run_metrics.add_samples("parse_sample", samplesheet["sample"], records)
+    return(dict(zip(samplesheet["sample"], profiles)))
+
+def parse_profile(profile_path: str, classifier: str):
+    if not profile_path:
+        return(pandas.DataFrame({"read_id": [], "taxid": []}))
+    with compression_tools.open_input(profile_path) as profile_fp:
+        profile = profile_fp.readlines()
+    match classifier:
+        case "kraken2":
+            return(parse_k2_profile(profile=profile))
+        case "metabuli":
+            return(parse_metabuli_profile(profile=profile))
+        case "diamond":
+            return(parse_diamond_profile(profile=profile))
+        case "metacache":
+            return(parse_metacache_profile(profile=profile))
+        case "sylph":
+            return(parse_sylph_mapped_reads(profile=profile))
 
 def parse_diamond_profile(profile: list):
     columns = ("read_id", "taxid", "e-value")
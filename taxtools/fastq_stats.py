@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+"""
+Count the reads and bases of (4-line, possibly compressed) FASTQ files.
+Files are decompressed outside of the counting thread (see
+compression_tools) and newlines are counted with numpy. Counts are cached
+in a JSON file by the real path, size and mtime of each FASTQ file.
+
+With --sylphmpa-dir, the estimated read count of every clade is added to the
+sylph-tax profile <fastq name>.sylphmpa of each FASTQ file as a read_count
+column (sequence abundance x number of reads / 100), written to
+<fastq name>.with_read_counts.sylphmpa.
+"""
+
+import click
+import json
+import os
+import sys
+import tempfile
+import numpy
+import pool_tools
+import compression_tools
+import metrics
+from pathlib import Path
+
+
+STATS_CACHE = "fastq_stats.cache.json"
+SCAN_SIZE = 1 << 22
+
+
+@click.command()
+@click.argument(
+    "fastq_paths",
+    nargs=-1,
+    required=True,
+    type=click.Path(dir_okay=False, exists=True),
+)
+@click.option(
+    "--output",
+    "output_path",
+    default="-",
+    type=click.Path(dir_okay=False, allow_dash=True),
+    help="path to output tsv file of read and base counts [default: stdout]",
+)
+@click.option(
+    "--sylphmpa-dir",
+    "sylphmpa_dir",
+    type=click.Path(file_okay=False, exists=True),
+    help="directory with <fastq name>.sylphmpa profiles to add estimated read counts to",
+)
+@click.option(
+    "--cache",
+    "cache_path",
+    default=STATS_CACHE,
+    show_default=True,
+    type=click.Path(dir_okay=False),
+    help="JSON file caching the counts of unchanged fastq files",
+)
+@click.option(
+    "--workers",
+    "workers",
+    type=click.INT,
+    default=1,
+    show_default=True,
+    help="number of fastq files counted in parallel",
+)
+@metrics.metrics_options
+def main(
+        fastq_paths: tuple,
+        output_path: str,
+        sylphmpa_dir: str,
+        cache_path: str,
+        workers: int,
+        metrics_path: str,
+        profile_stage: str
+):
+    run_metrics = metrics.Metrics(command="fastq_stats", path=metrics_path,
+                                  profile_stage=profile_stage)
+    with run_metrics.stage("count") as stage:
+        stats = get_fastq_stats(fastq_paths, cache_path=Path(cache_path), workers=workers,
+                                run_metrics=run_metrics)
+        stage["rows"] = sum(num_reads for num_reads, _ in stats)
+
+    with run_metrics.stage("output"):
+        with click.open_file(output_path, "w") as output_fp:
+            output_fp.write("fastq\tnum_reads\tnum_bases\n")
+            for fastq_path, (num_reads, num_bases) in zip(fastq_paths, stats):
+                output_fp.write(f"{fastq_path}\t{num_reads}\t{num_bases}\n")
+        if sylphmpa_dir:
+            for fastq_path, (num_reads, _) in zip(fastq_paths, stats):
+                fastq_name = Path(fastq_path).name
+                sylphmpa_path = Path(sylphmpa_dir) / (fastq_name + ".sylphmpa")
+                if not sylphmpa_path.exists():
+                    continue
+                add_sylph_read_counts(
+                    sylphmpa_path, num_reads=num_reads,
+                    output_path=Path(sylphmpa_dir) / (fastq_name + ".with_read_counts.sylphmpa"))
+    run_metrics.write()
+
+def get_fastq_stats(fastq_paths: tuple, cache_path: Path = None, workers: int = 1,
+                    run_metrics: metrics.Metrics = None) -> list:
+    # [(number of reads, number of bases)] of fastq files, counting only
+    # files that changed since they were cached
+    cache = load_stats_cache(cache_path) if cache_path else {}
+    stamps = {}
+    for fastq_path in fastq_paths:
+        path = os.path.realpath(fastq_path)
+        stat = os.stat(path)
+        stamps[path] = [stat.st_size, stat.st_mtime_ns]
+    uncached = [path for path in dict.fromkeys(stamps)
+                if path not in cache or cache[path]["stamp"] != stamps[path]]
+
+    counts = pool_tools.map_samples(count_fastq, uncached, workers=workers,
+                                    with_metrics=metrics.is_enabled(run_metrics))
+    if metrics.is_enabled(run_metrics):
+        counts, records = pool_tools.split_metrics(counts)
+        run_metrics.add_samples("count_fastq", uncached, records)
+    for path, (num_reads, num_bases) in zip(uncached, counts):
+        cache[path] = {"stamp": stamps[path], "reads": num_reads, "bases": num_bases}
+    if uncached and cache_path:
+        save_stats_cache(cache_path, cache)
+    return([(cache[path]["reads"], cache[path]["bases"])
+            for path in (os.path.realpath(fastq_path) for fastq_path in fastq_paths)])
+
+def load_stats_cache(cache_path: Path) -> dict:
+    try:
+        with open(cache_path, "r") as cache_fp:
+            return(json.load(cache_fp))
+    except (OSError, ValueError):
+        return({})
+
+def save_stats_cache(cache_path: Path, cache: dict):
+    # write to a temporary file and rename so concurrent runs never see partial caches
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.resolve().parent, suffix=".json")
+    except OSError:
+        print(f"Cannot write fastq stats cache {cache_path}", file=sys.stderr)
+        return
+    with os.fdopen(fd, "w") as cache_fp:
+        json.dump(cache, cache_fp)
+    os.replace(tmp_path, cache_path)
+
+def count_fastq(fastq_path: str, chunk_size: int = SCAN_SIZE) -> tuple[int, int]:
+    """
+    Number of reads and bases of a 4-line fastq file. Only the lengths of
+    the sequence lines (every 4th line, starting at the 2nd) are summed.
+    """
+    num_lines = 0
+    num_bases = 0
+    # length of the line continued from the previous chunk
+    partial = 0
+    with compression_tools.open_input(fastq_path, "rb") as fastq_fp:
+        while chunk := fastq_fp.read(chunk_size):
+            newlines = numpy.flatnonzero(numpy.frombuffer(chunk, dtype=numpy.uint8) == ord("\n"))
+            if not len(newlines):
+                partial += len(chunk)
+                continue
+            line_lengths = numpy.diff(newlines, prepend=-1) - 1
+            line_lengths[0] += partial
+            num_bases += int(line_lengths[(1 - num_lines) % 4::4].sum())
+            num_lines += len(newlines)
+            partial = len(chunk) - int(newlines[-1]) - 1
+    if partial:
+        # last line without a newline
+        if num_lines % 4 == 1:
+            num_bases += partial
+        num_lines += 1
+    if num_lines % 4:
+        raise ValueError(f"{fastq_path} is not a 4-line FASTQ file")
+    return(num_lines // 4, num_bases)
+
+def add_sylph_read_counts(sylphmpa_path: Path, num_reads: int, output_path: Path):
+    # insert a read_count column after the sequence_abundance column
+    with open(sylphmpa_path, "r") as sylphmpa_fp:
+        lines = sylphmpa_fp.readlines()
+    with open(output_path, "w") as output_fp:
+        output_fp.writelines(lines[:1])
+        for i, line in enumerate(lines[1:]):
+            fields = line.rstrip("\n").split("\t")
+            if i == 0:
+                read_count = "read_count"
+            else:
+                read_count = f"{float(fields[2]) * num_reads / 100:.0f}"
+            output_fp.write("\t".join(fields[:3] + [read_count] + fields[3:]) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+"""
+Random access to the reads of (4-line) FASTQ files. Plain and bgzip
+compressed FASTQ files are scanned once into a sorted read ID -> byte offset
+index, which is cached next to it (or in an index directory) and rebuilt when
+the file changes. Their reads are then read directly at their offsets.
+Other gzip or zstd compressed files cannot be entered mid-stream, so they are
+not indexed and their reads are collected in a single pass that tests each
+read ID against the wanted ones.
+
+The positive reads listed by extract_positive_reads are extracted into one
+FASTA query file per sample and taxid.
+"""
+
+import hashlib
+import mmap
+import sys
+from collections import defaultdict
+from pathlib import Path
+from typing import TextIO
+import numpy
+import taxdmp_tools
+import pool_tools
+import compression_tools
+import metrics
+
+
+INDEX_SUFFIX = ".reads.index.bin"
+SCAN_SIZE = 1 << 22
+
+
+def get_index_path(fastq_path: Path, index_dir: Path = None) -> Path:
+    if index_dir is None:
+        return(Path(str(fastq_path) + INDEX_SUFFIX))
+    # files with the same name in different directories get different indices
+    path_hash = hashlib.sha1(str(fastq_path.resolve()).encode()).hexdigest()[:12]
+    return(index_dir / f"{fastq_path.name}.{path_hash}{INDEX_SUFFIX}")
+
+def is_indexable(fastq_path: Path) -> bool:
+    # plain and bgzip files can be read at any offset
+    return(compression_tools.get_compression(fastq_path) is None
+           or compression_tools.is_bgzf(fastq_path))
+
+def compile_fastq_index(fastq_path: Path) -> tuple[dict, dict]:
+    # bgzip files also get the compressed and decompressed offsets of their blocks
+    block_offsets, block_starts = [], []
+    if compression_tools.is_bgzf(fastq_path):
+        compression = "bgzf"
+        chunks = iter_bgzf_chunks(fastq_path, block_offsets, block_starts)
+        records = list(scan_records(chunks, fastq_path))
+    elif compression_tools.get_compression(fastq_path) is None:
+        compression = "plain"
+        with open(fastq_path, "rb") as fastq_fp:
+            chunks = iter(lambda: fastq_fp.read(SCAN_SIZE), b"")
+            records = list(scan_records(chunks, fastq_path))
+    else:
+        raise ValueError(f"{fastq_path} cannot be indexed, only plain and bgzip "
+                         "compressed FASTQ files can")
+
+    read_ids = concatenate_read_ids([read_ids for read_ids, _, _ in records])
+    offsets = numpy.concatenate(
+        [numpy.array([], dtype=numpy.int64)] + [offsets for _, offsets, _ in records])
+    lengths = numpy.concatenate(
+        [numpy.array([], dtype=numpy.int32)] + [lengths for _, _, lengths in records])
+    order = numpy.argsort(read_ids, kind="stable")
+    return({"compression": compression}, {
+        "read_ids": read_ids[order],
+        "offsets": offsets[order],
+        "lengths": lengths[order],
+        "block_offsets": numpy.array(block_offsets, dtype=numpy.int64),
+        "block_starts": numpy.array(block_starts, dtype=numpy.int64),
+    })
+
+def iter_bgzf_chunks(fastq_path: Path, block_offsets: list, block_starts: list):
+    start = 0
+    for offset, data in compression_tools.iter_bgzf_blocks(fastq_path):
+        block_offsets.append(offset)
+        block_starts.append(start)
+        start += len(data)
+        yield(data)
+
+def scan_records(chunks, fastq_path: Path):
+    # (read IDs, record offsets, record lengths) of the records in each chunk
+    # of decompressed FASTQ data
+    for buffer, base, newlines in iter_record_buffers(chunks, fastq_path):
+        yield(split_records(buffer, base, newlines, fastq_path))
+
+def iter_record_buffers(chunks, fastq_path: Path):
+    """
+    Regroup chunks of decompressed FASTQ data into buffers starting at a
+    record. Yields each buffer with its offset in the file and the positions
+    of the newlines of the complete 4-line records in it (the remainder of
+    the buffer is carried over to the next one).
+    """
+    base = 0
+    pending = b""
+    for data in chunks:
+        buffer = pending + data
+        newlines = numpy.flatnonzero(numpy.frombuffer(buffer, dtype=numpy.uint8) == ord("\n"))
+        newlines = newlines[:len(newlines) // 4 * 4]
+        yield(buffer, base, newlines)
+        end = int(newlines[-1]) + 1 if len(newlines) else 0
+        pending = buffer[end:]
+        base += end
+    if pending.strip():
+        if not pending.endswith(b"\n"):
+            pending += b"\n"
+        newlines = numpy.flatnonzero(numpy.frombuffer(pending, dtype=numpy.uint8) == ord("\n"))
+        if len(newlines) != 4:
+            raise ValueError(f"{fastq_path} ends with an incomplete FASTQ record")
+        yield(pending, base, newlines)
+
+def split_records(buffer: bytes, base: int, newlines: numpy.ndarray, fastq_path: Path):
+    # read IDs, offsets and lengths of the records of a buffer from
+    # iter_record_buffers. Only the header lines are split in python.
+    ends = newlines[3::4] + 1
+    starts = numpy.concatenate([[0], ends[:-1]]).astype(numpy.int64)[:len(ends)]
+    if (numpy.frombuffer(buffer, dtype=numpy.uint8)[starts] != ord("@")).any():
+        raise ValueError(f"{fastq_path} is not a 4-line FASTQ file (after offset {base})")
+    read_ids = numpy.array(
+        [buffer[start + 1:end].split(maxsplit=1)[0]
+         for start, end in zip(starts.tolist(), newlines[0::4].tolist())], dtype="S")
+    return(read_ids.reshape(-1), starts + base, (ends - starts).astype(numpy.int32))
+
+def concatenate_read_ids(chunks: list) -> numpy.ndarray:
+    chunks = [chunk for chunk in chunks if len(chunk)]
+    if not chunks:
+        return(numpy.array([], dtype="S1"))
+    width = max(chunk.itemsize for chunk in chunks)
+    return(numpy.concatenate([chunk.astype(f"S{width}") for chunk in chunks]))
+
+
+class FastqIndex:
+    """
+    Sorted read IDs of a plain or bgzip compressed FASTQ file with the
+    offset and length of each record in the decompressed file.
+    """
+    def __init__(self, fastq_path: Path, index_dir: Path = None):
+        self.path = Path(fastq_path)
+        meta, arrays = taxdmp_tools.load_cache(
+            cache_path=get_index_path(self.path, index_dir),
+            sources={self.path.name: self.path},
+            build=lambda: compile_fastq_index(self.path))
+        self.compression = meta["compression"]
+        self.read_ids = arrays["read_ids"]
+        self.offsets = arrays["offsets"]
+        self.lengths = arrays["lengths"]
+        self.block_offsets = arrays["block_offsets"]
+        self.block_starts = arrays["block_starts"]
+
+    def __len__(self):
+        return(len(self.read_ids))
+
+    def lookup(self, read_ids) -> numpy.ndarray:
+        # index positions of read IDs, -1 for reads that are not in the file
+        queries = numpy.asarray(read_ids, dtype="S")
+        positions = numpy.full(len(queries), -1, dtype=numpy.int64)
+        if not len(queries) or not len(self.read_ids):
+            return(positions)
+        # queries longer than the widest read ID cannot be indexed
+        fits = numpy.char.str_len(queries) <= self.read_ids.itemsize
+        fitting = queries[fits].astype(self.read_ids.dtype)
+        found_positions = numpy.minimum(numpy.searchsorted(self.read_ids, fitting),
+                                        len(self.read_ids) - 1)
+        found = self.read_ids[found_positions] == fitting
+        positions[numpy.flatnonzero(fits)[found]] = found_positions[found]
+        return(positions)
+
+    def iter_records(self, positions: numpy.ndarray):
+        # (position, record) of index positions, in file order
+        positions = numpy.unique(positions[positions >= 0])
+        positions = positions[numpy.argsort(self.offsets[positions], kind="stable")]
+        offsets = self.offsets[positions].tolist()
+        lengths = self.lengths[positions].tolist()
+        if self.compression == "plain":
+            yield from self._iter_mapped(positions.tolist(), offsets, lengths)
+            return
+        reader = compression_tools.BgzfReader(self.path, self.block_offsets, self.block_starts)
+        try:
+            for position, offset, length in zip(positions.tolist(), offsets, lengths):
+                yield(position, reader.read_at(offset, length))
+        finally:
+            reader.close()
+
+    def _iter_mapped(self, positions: list, offsets: list, lengths: list):
+        if not positions:
+            return
+        with open(self.path, "rb") as fastq_fp:
+            with mmap.mmap(fastq_fp.fileno(), 0, access=mmap.ACCESS_READ) as fastq_map:
+                for position, offset, length in zip(positions, offsets, lengths):
+                    yield(position, fastq_map[offset:offset + length])
+
+def record_to_fasta(record: bytes) -> bytes:
+    header, sequence = record.split(b"\n", 2)[:2]
+    return(b">" + header[1:] + b"\n" + sequence + b"\n")
+
+def collect_fasta_records(fastq_path: Path, read_ids) -> dict:
+    """
+    {read ID: FASTA record} of the wanted read IDs (bytes) of a FASTQ file
+    in a single pass over the decompressed file, which ends as soon as all
+    of them were found. The first record of a duplicated read ID is kept,
+    as by FastqIndex.
+    """
+    wanted = numpy.unique(numpy.array(list(read_ids), dtype="S"))
+    fasta_records = {}
+    if not len(wanted):
+        return(fasta_records)
+    with compression_tools.open_input(fastq_path, "rb") as fastq_fp:
+        chunks = iter(lambda: fastq_fp.read(SCAN_SIZE), b"")
+        for buffer, base, newlines in iter_record_buffers(chunks, fastq_path):
+            chunk_ids, offsets, lengths = split_records(buffer, base, newlines, fastq_path)
+            for index in numpy.flatnonzero(numpy.isin(chunk_ids, wanted)).tolist():
+                read_id = bytes(chunk_ids[index])
+                if read_id not in fasta_records:
+                    start = int(offsets[index]) - base
+                    fasta_records[read_id] = record_to_fasta(
+                        buffer[start:start + int(lengths[index])])
+            if len(fasta_records) == len(wanted):
+                break
+    return(fasta_records)
+
+def parse_positive_reads(positive_reads_fp: TextIO) -> dict:
+    # {fastq: [(sample, taxid, read IDs)]} from extract_positive_reads output.
+    # Lines are split by hand as the read ID lists exceed csv field limits.
+    header = positive_reads_fp.readline().rstrip("\n").split("\t")
+    columns = [header.index(column) for column in ("sample", "fastq", "taxid", "reads")]
+    rows = defaultdict(list)
+    for line in positive_reads_fp:
+        if not line.strip():
+            continue
+        fields = line.rstrip("\n").split("\t")
+        sample, fastq, taxid, reads = (fields[column] for column in columns)
+        rows[fastq].append((sample, taxid, reads.split(",") if reads else []))
+    return(rows)
+
+def extract_fastq_reads(job: tuple, outdir: Path, index_dir: Path = None) -> tuple:
+    """
+    Write the reads of every (sample, taxid) row of a FASTQ file to
+    <outdir>/<sample>.<taxid>.fa, reading each wanted record once.
+    Returns the number of written and of missing reads.
+    """
+    fastq, rows = job
+    fastq_path = Path(fastq)
+    if is_indexable(fastq_path):
+        fastq_index = FastqIndex(fastq_path, index_dir=index_dir)
+        row_positions = [fastq_index.lookup(read_ids) for _, _, read_ids in rows]
+        wanted = numpy.concatenate([numpy.array([], dtype=numpy.int64), *row_positions])
+        fasta_records = {position: record_to_fasta(record)
+                         for position, record in fastq_index.iter_records(wanted)}
+        row_found = [positions[positions >= 0].tolist() for positions in row_positions]
+    else:
+        # an index would cost a full decompression on top of reading the records
+        row_read_ids = [[read_id.encode() for read_id in read_ids] for _, _, read_ids in rows]
+        fasta_records = collect_fasta_records(
+            fastq_path, (read_id for read_ids in row_read_ids for read_id in read_ids))
+        row_found = [[read_id for read_id in read_ids if read_id in fasta_records]
+                     for read_ids in row_read_ids]
+
+    num_written = 0
+    num_missing = 0
+    for (sample, taxid, read_ids), found in zip(rows, row_found):
+        with open(outdir / f"{sample}.{taxid}.fa", "wb") as fasta_fp:
+            fasta_fp.writelines(fasta_records[key] for key in found)
+        num_written += len(found)
+        num_missing += len(read_ids) - len(found)
+    if num_missing:
+        print(f"{num_missing} positive reads are not in {fastq}", file=sys.stderr)
+    return(num_written, num_missing)
+
+def extract_positive_reads(positive_reads_fp: TextIO, outdir: Path, index_dir: Path = None,
+                           workers: int = 1, run_metrics: metrics.Metrics = None) -> list:
+    outdir.mkdir(parents=True, exist_ok=True)
+    if index_dir is not None:
+        index_dir.mkdir(parents=True, exist_ok=True)
+    jobs = list(parse_positive_reads(positive_reads_fp).items())
+    extracted = pool_tools.map_samples(
+        extract_fastq_reads, jobs, workers=workers, outdir=outdir, index_dir=index_dir,
+        with_metrics=metrics.is_enabled(run_metrics))
+    if metrics.is_enabled(run_metrics):
+        extracted, records = pool_tools.split_metrics(extracted)
+        run_metrics.add_samples("extract_fastq", [fastq for fastq, _ in jobs], records)
+    return(extracted)
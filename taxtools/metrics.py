@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+"""
+Per-stage run metrics for the taxtools CLIs: wall and CPU time, peak RSS
+and row counts of each stage (and each sample of per-sample stages),
+written as JSON. A single stage can also be profiled with cProfile.
+"""
+
+import click
+import cProfile
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+
+def metrics_options(func):
+    # --metrics-json and --profile options shared by all taxtools entry points
+    func = click.option(
+        "--profile",
+        "profile_stage",
+        type=click.STRING,
+        help="profile the named stage with cProfile and write the stats to "
+             "<metrics json>.<stage>.prof (or <stage>.prof without --metrics-json)"
+    )(func)
+    func = click.option(
+        "--metrics-json",
+        "metrics_path",
+        type=click.Path(dir_okay=False),
+        help="write wall/CPU time, peak memory and row counts of each stage to this json file"
+    )(func)
+    return(func)
+
+def get_cpu_time() -> float:
+    # CPU time of this process and of its reaped children (e.g. pool workers)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return(time.process_time() + children.ru_utime + children.ru_stime)
+
+def reset_peak_rss() -> bool:
+    # Linux allows resetting the peak RSS (VmHWM) of a process
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs_fp:
+            clear_refs_fp.write("5")
+        return(True)
+    except OSError:
+        return(False)
+
+def get_peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status", "r") as status_fp:
+            for line in status_fp:
+                if line.startswith("VmHWM:"):
+                    return(int(line.split()[1]) / 1024)
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return(peak_rss / 1024 ** 2 if sys.platform == "darwin" else peak_rss / 1024)
+
+def get_children_peak_rss_mb() -> float:
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return(peak_rss / 1024 ** 2 if sys.platform == "darwin" else peak_rss / 1024)
+
+def is_enabled(run_metrics) -> bool:
+    # whether per-sample records of an optional Metrics are written
+    return(run_metrics is not None and run_metrics.enabled)
+
+def measure(func, *args, **kwargs) -> tuple:
+    """
+    Call func and return its result with the wall time, CPU time and peak
+    RSS of the call in the current process.
+    """
+    reset_peak_rss()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    result = func(*args, **kwargs)
+    record = {"wall_time_s": time.perf_counter() - wall_start,
+              "cpu_time_s": time.process_time() - cpu_start,
+              "peak_rss_mb": get_peak_rss_mb(), "pid": os.getpid()}
+    if hasattr(result, "__len__"):
+        record["rows"] = len(result)
+    return(result, record)
+
+
+class Metrics:
+    def __init__(self, command: str, path: str = None, profile_stage: str = None):
+        self.command = command
+        self.path = path
+        self.profile_stage = profile_stage
+        self.profiler = cProfile.Profile() if profile_stage else None
+        self.profiled = False
+        self.created = datetime.now(timezone.utc).isoformat()
+        self.start = time.perf_counter()
+        self.stages = []
+
+    @property
+    def enabled(self) -> bool:
+        # stage and per-sample records are only written with a metrics path
+        return(self.path is not None)
+
+    @contextmanager
+    def stage(self, name: str, sample: str = None):
+        """
+        Record a stage run in the with block. The yielded dict can be used
+        to add row counts or other numbers to the stage record.
+        """
+        record = {"stage": name}
+        if sample is not None:
+            record["sample"] = sample
+        if self.enabled:
+            reset_peak_rss()
+        cpu_start = get_cpu_time()
+        wall_start = time.perf_counter()
+        profiling = self.profiler is not None and name == self.profile_stage
+        if profiling:
+            self.profiled = True
+            self.profiler.enable()
+        try:
+            yield(record)
+        finally:
+            if profiling:
+                self.profiler.disable()
+            record["wall_time_s"] = time.perf_counter() - wall_start
+            record["cpu_time_s"] = get_cpu_time() - cpu_start
+            record["peak_rss_mb"] = get_peak_rss_mb()
+            record["pid"] = os.getpid()
+            self.stages.append(record)
+
+    def add_samples(self, name: str, samples: list, records: list):
+        # add per-sample records measured in (possibly forked) workers
+        for sample, record in zip(samples, records):
+            self.stages.append({"stage": name, "sample": sample, **record})
+
+    def write(self):
+        if self.profiler is not None and not self.profiled:
+            print(f"Stage {self.profile_stage} was not run, nothing was profiled",
+                  file=sys.stderr)
+        elif self.profiler is not None:
+            if self.path:
+                self.profiler.dump_stats(f"{self.path}.{self.profile_stage}.prof")
+            else:
+                self.profiler.dump_stats(f"{self.profile_stage}.prof")
+        if not self.path:
+            return
+        metrics = {
+            "command": self.command,
+            "argv": sys.argv,
+            "created": self.created,
+            "host": platform.node(),
+            "python": platform.python_version(),
+            "total_wall_time_s": time.perf_counter() - self.start,
+            "total_cpu_time_s": get_cpu_time(),
+            # peak RSS is reset at the start of every stage, so take the
+            # maximum over the stages
+            "peak_rss_mb": max([record.get("peak_rss_mb", 0) for record in self.stages
+                                if record.get("pid", os.getpid()) == os.getpid()]
+                               + [get_peak_rss_mb()]),
+            "children_peak_rss_mb": get_children_peak_rss_mb(),
+            "stages": self.stages,
+        }
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "w") as metrics_fp:
+            json.dump(metrics, metrics_fp, indent=2)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+import metrics
+
+# function and keyword arguments inherited by forked pool workers
+_shared = {}
+
+
+def map_samples(func, items: list, workers: int = 1, with_metrics: bool = False,
+                **shared) -> list:
+    """
+    Return [func(item, **shared) for item in items], using a pool of forked
+    worker processes when workers > 1. The shared keyword arguments (e.g. the
+    taxonomy) are inherited by the workers at fork time instead of being
+    pickled for every task. Results are returned in the order of items.
+    With with_metrics, (result, metrics record) pairs are returned instead.
+    """
+    items = list(items)
+    if with_metrics:
+        func = _measured(func)
+    if workers <= 1 or len(items) <= 1:
+        return([func(item, **shared) for item in items])
+    _shared.update(func=func, kwargs=shared)
+    try:
+        context = multiprocessing.get_context("fork")
+        with context.Pool(processes=min(workers, len(items))) as pool:
+            return(pool.map(_call_shared, items, chunksize=1))
+    finally:
+        _shared.clear()
+
+def split_metrics(measured: list) -> tuple[list, list]:
+    # split map_samples(..., with_metrics=True) output into results and records
+    return([result for result, _ in measured], [record for _, record in measured])
+
+class _measured:
+    # picklable wrapper measuring each call of func
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, item, **kwargs):
+        return(metrics.measure(self.func, item, **kwargs))
+
+def _call_shared(item):
+    return(_shared["func"](item, **_shared["kwargs"]))
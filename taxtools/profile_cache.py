@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""
+On-disk cache of standardised per-sample taxid counts, keyed by the content
+hash of the sample profile, the classifier tool, the counting mode and the
+taxonomy version. Content hashes are remembered per file path, size and
+mtime so unchanged profiles are not re-read.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import numpy
+from pathlib import Path
+
+
+HASHES_FILE = "profile_hashes.json"
+
+
+class ProfileCache:
+    def __init__(self, cache_dir: Path, key: str):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # tool/mode/taxonomy part of the cache key shared by all samples
+        self.key = key
+        self.hashes_path = self.cache_dir / HASHES_FILE
+        try:
+            with open(self.hashes_path, "r") as hashes_fp:
+                self.hashes = json.load(hashes_fp)
+        except (OSError, ValueError):
+            self.hashes = {}
+
+    def get_profile_hash(self, profile_path: Path) -> str:
+        path = os.path.realpath(profile_path)
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        if path in self.hashes and self.hashes[path][0] == stamp:
+            return(self.hashes[path][1])
+        digest = hashlib.blake2b(digest_size=20)
+        with open(path, "rb") as profile_fp:
+            while block := profile_fp.read(1 << 20):
+                digest.update(block)
+        self.hashes[path] = [stamp, digest.hexdigest()]
+        return(self.hashes[path][1])
+
+    def get_path(self, profile_path: Path, prefix: str = None) -> Path:
+        # prefix (e.g. the classifier tool) is prepended to the shared key
+        key = self.key if prefix is None else prefix + "\t" + self.key
+        key = hashlib.blake2b(
+            (key + "\t" + self.get_profile_hash(profile_path)).encode(),
+            digest_size=20).hexdigest()
+        return(self.cache_dir / (key + ".npz"))
+
+    def load(self, profile_path: Path, prefix: str = None):
+        # cached taxid counts of a profile, or None if not cached
+        try:
+            with numpy.load(self.get_path(profile_path, prefix)) as cached:
+                return(dict(zip(cached["taxids"].tolist(), cached["counts"].tolist())))
+        except (OSError, ValueError, KeyError):
+            return(None)
+
+    def save(self, profile_path: Path, taxid_counts: dict, prefix: str = None):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".npz")
+        with os.fdopen(fd, "wb") as cache_fp:
+            numpy.savez(cache_fp,
+                        taxids=numpy.array(list(taxid_counts.keys()), dtype=numpy.int64),
+                        counts=numpy.array(list(taxid_counts.values()), dtype=numpy.int64))
+        os.replace(tmp_path, self.get_path(profile_path, prefix))
+
+    def save_hashes(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".json")
+        with os.fdopen(fd, "w") as hashes_fp:
+            json.dump(self.hashes, hashes_fp)
+        os.replace(tmp_path, self.hashes_path)
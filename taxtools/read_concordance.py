@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+"""
+Compare the per-read classifications of several classifiers. The read IDs
+of each sample are interned once into a sorted index (of the reads in the
+sample fastq file, or of all reads in the classifier outputs when there is
+no fastq file), and the taxids of each tool are kept as one int32 array over
+that index. Taxids are summarised to a taxonomic rank and for every pair of
+tools the reads are counted as
+
+agree      both tools resolve the read at the rank, to the same taxon
+disagree   both tools resolve the read at the rank, to different taxa
+only_a     only tool_a resolves the read at the rank
+only_b     only tool_b resolves the read at the rank
+neither    neither tool resolves the read at the rank
+
+The samplesheet is the extract_positive_reads samplesheet, with a sample
+and fastq column and one column of per-read outputs per classifier.
+"""
+
+import click
+import sys
+from itertools import combinations, islice
+from typing import TextIO
+import taxdmp_tools
+import pool_tools
+import metrics
+import compression_tools
+import extract_positive_reads
+from pathlib import Path
+import numpy
+import pandas
+
+
+CLASSIFIERS = ("kraken2", "diamond", "metabuli", "metacache", "sylph")
+CONCORDANCE_COLUMNS = ("agree", "disagree", "only_a", "only_b", "neither")
+
+
+@click.command()
+@click.option(
+    "--samplesheet",
+    "samplesheet_fp",
+    required=True,
+    type=click.File("r"),
+    help="tsv samplesheet with sample, fastq and per-classifier columns of per-read outputs",
+)
+@click.option(
+    "--taxonomy",
+    "taxonomy",
+    required=True,
+    type=click.Path(file_okay=False),
+    help="path to directory with NCBI taxdump files",
+)
+@click.option(
+    "--output",
+    "output_path",
+    required=True,
+    type=click.Path(dir_okay=False),
+    help="path to output tsv file of pairwise read counts, the tool x tool concordance "
+         "matrix is written next to it as <output stem>.matrix.tsv",
+)
+@click.option(
+    "--rank",
+    "rank",
+    default="species",
+    show_default=True,
+    type=click.STRING,
+    help="taxonomic rank at which classifications are compared",
+)
+@click.option(
+    "--tool",
+    "tools",
+    multiple=True,
+    type=click.Choice(CLASSIFIERS),
+    help="classifier to compare (can be repeated) [default: all classifier columns]",
+)
+@click.option(
+    "--chunk-size",
+    "chunk_size",
+    type=click.INT,
+    default=1000000,
+    show_default=True,
+    help="number of reads parsed at a time",
+)
+@click.option(
+    "--workers",
+    "workers",
+    type=click.INT,
+    default=1,
+    show_default=True,
+    help="number of samples processed in parallel",
+)
+@metrics.metrics_options
+def main(
+        samplesheet_fp: TextIO,
+        taxonomy: str,
+        output_path: str,
+        rank: str,
+        tools: tuple,
+        chunk_size: int,
+        workers: int,
+        metrics_path: str,
+        profile_stage: str
+):
+    output_file = Path(output_path)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    run_metrics = metrics.Metrics(command="read_concordance", path=metrics_path,
+                                  profile_stage=profile_stage)
+    samples = parse_samplesheet(samplesheet_fp, tools=tools)
+    with run_metrics.stage("taxonomy_load"):
+        taxa = taxdmp_tools.create_taxa(taxonomy=taxonomy)
+        if isinstance(taxa, taxdmp_tools.Taxa):
+            taxa.rank_ancestors
+
+    with run_metrics.stage("compare") as stage:
+        sample_rows = pool_tools.map_samples(
+            compare_sample, samples, workers=workers, taxa=taxa, rank=rank,
+            chunk_size=chunk_size, with_metrics=run_metrics.enabled)
+        if run_metrics.enabled:
+            sample_rows, records = pool_tools.split_metrics(sample_rows)
+            run_metrics.add_samples("compare_sample", [sample["sample"] for sample in samples],
+                                    records)
+        concordance = pandas.DataFrame(
+            [row for rows in sample_rows for row in rows],
+            columns=["sample", "tool_a", "tool_b", "rank", "num_reads", *CONCORDANCE_COLUMNS])
+        stage["rows"] = len(concordance)
+
+    with run_metrics.stage("output"):
+        concordance.to_csv(output_file, sep="\t", index=False)
+        get_concordance_matrix(concordance).to_csv(
+            Path(str(output_file.parent) + "/" + output_file.stem + ".matrix.tsv"), sep="\t")
+    run_metrics.write()
+
+def parse_samplesheet(samplesheet_fp: TextIO, tools: tuple = ()) -> list:
+    # [{"sample", "fastq", "profiles": {tool: path}}], skipping empty cells
+    header = [column.strip() for column in next(samplesheet_fp).split(sep="\t")]
+    tool_columns = {column: i for i, column in enumerate(header) if column in CLASSIFIERS}
+    if tools:
+        missing = [tool for tool in tools if tool not in tool_columns]
+        if missing:
+            raise click.UsageError(f"No {', '.join(missing)} column in samplesheet")
+        tool_columns = {tool: tool_columns[tool] for tool in tools}
+    if len(tool_columns) < 2:
+        raise click.UsageError("At least two classifiers are needed for a comparison")
+    fastq_column = header.index("fastq") if "fastq" in header else None
+
+    samples = []
+    for line in samplesheet_fp:
+        if not line.strip():
+            continue
+        fields = [field.strip() for field in line.split(sep="\t")]
+        profiles = {tool: fields[column] for tool, column in tool_columns.items()
+                    if column < len(fields) and fields[column]}
+        fastq = fields[fastq_column] if fastq_column is not None else ""
+        samples.append({"sample": fields[0], "fastq": fastq, "profiles": profiles})
+    return(samples)
+
+def compare_sample(sample: dict, taxa: dict, rank: str, chunk_size: int = 1000000) -> list:
+    # pairwise concordance rows of the tools with an output for the sample
+    profiles = sample["profiles"]
+    if sample["fastq"]:
+        read_index = ReadIndex(read_fastq_ids(sample["fastq"], chunk_size=chunk_size))
+    else:
+        read_index = ReadIndex(read_profile_ids(profiles, chunk_size=chunk_size))
+    calls = {}
+    for tool, profile_path in profiles.items():
+        taxids = get_read_taxids(profile_path, classifier=tool, read_index=read_index,
+                                 chunk_size=chunk_size)
+        calls[tool] = summarise_read_taxids(taxids, rank=rank, taxa=taxa)
+    rows = []
+    for tool_a, tool_b in combinations(profiles, 2):
+        counts = count_concordance(calls[tool_a], calls[tool_b])
+        rows.append((sample["sample"], tool_a, tool_b, rank, len(read_index),
+                     *(counts[column] for column in CONCORDANCE_COLUMNS)))
+    return(rows)
+
+
+class ReadIndex:
+    """
+    Sorted array of the distinct read IDs of a sample. The position of a
+    read ID in the array is its interned integer index.
+    """
+    def __init__(self, read_ids: numpy.ndarray):
+        self.read_ids = numpy.unique(read_ids)
+
+    def __len__(self):
+        return(len(self.read_ids))
+
+    def lookup(self, read_ids) -> numpy.ndarray:
+        # interned indices of read IDs, -1 for reads that are not indexed
+        queries = numpy.asarray(read_ids, dtype="S")
+        indices = numpy.full(len(queries), -1, dtype=numpy.int64)
+        if not len(queries) or not len(self.read_ids):
+            return(indices)
+        # queries longer than the widest read ID cannot be indexed
+        fits = numpy.char.str_len(queries) <= self.read_ids.itemsize
+        fitting = queries[fits].astype(self.read_ids.dtype)
+        positions = numpy.minimum(numpy.searchsorted(self.read_ids, fitting),
+                                  len(self.read_ids) - 1)
+        found = self.read_ids[positions] == fitting
+        indices[numpy.flatnonzero(fits)[found]] = positions[found]
+        return(indices)
+
+def read_fastq_ids(fastq_path: str, chunk_size: int = 1000000) -> numpy.ndarray:
+    # read IDs (first word of the header line) of a fastq file
+    chunks = []
+    with compression_tools.open_input(fastq_path, "rb") as fastq_fp:
+        headers = islice(fastq_fp, 0, None, 4)
+        while chunk := list(islice(headers, chunk_size)):
+            chunks.append(numpy.unique(
+                numpy.array([header[1:].split(maxsplit=1)[0] for header in chunk])))
+    return(concatenate_read_ids(chunks))
+
+def read_profile_ids(profiles: dict, chunk_size: int = 1000000) -> numpy.ndarray:
+    # distinct read IDs over the per-read outputs of all tools
+    chunks = []
+    for tool, profile_path in profiles.items():
+        for chunk in extract_positive_reads.iter_profile_chunks(
+                profile_path=profile_path, classifier=tool, chunk_size=chunk_size):
+            chunks.append(numpy.unique(chunk["read_id"].to_numpy().astype("S")))
+    return(concatenate_read_ids(chunks))
+
+def concatenate_read_ids(chunks: list) -> numpy.ndarray:
+    if not chunks:
+        return(numpy.array([], dtype="S1"))
+    width = max(chunk.itemsize for chunk in chunks)
+    return(numpy.concatenate([chunk.astype(f"S{width}") for chunk in chunks]))
+
+def get_read_taxids(profile_path: str, classifier: str, read_index: ReadIndex,
+                    chunk_size: int = 1000000) -> numpy.ndarray:
+    """
+    Taxid of each interned read in a per-read classifier output, 0 for reads
+    without a classification. Reads missing from the index are ignored.
+    """
+    taxids = numpy.zeros(len(read_index), dtype=numpy.int32)
+    num_unindexed = 0
+    for chunk in extract_positive_reads.iter_profile_chunks(
+            profile_path=profile_path, classifier=classifier, chunk_size=chunk_size):
+        indices = read_index.lookup(chunk["read_id"].to_numpy().astype("S"))
+        indexed = indices >= 0
+        num_unindexed += int((~indexed).sum())
+        taxids[indices[indexed]] = chunk["taxid"].to_numpy()[indexed]
+    if num_unindexed:
+        print(f"{num_unindexed} reads of {profile_path} are not in the read index",
+              file=sys.stderr)
+    return(taxids)
+
+def summarise_read_taxids(taxids: numpy.ndarray, rank: str, taxa: dict) -> numpy.ndarray:
+    # ancestor of each read taxid at rank, 0 for reads not resolved at rank.
+    # Each distinct taxid is summarised once and mapped back through a
+    # taxid-indexed table to keep memory at 4 bytes per read.
+    unique_taxids = numpy.unique(taxids)
+    unique_taxids = unique_taxids[unique_taxids > 0]
+    ancestors = taxdmp_tools.get_ancestors_at_rank(unique_taxids, target_rank=rank, taxa=taxa)
+    resolved = taxdmp_tools.have_rank(ancestors, rank=rank, taxa=taxa)
+    table = numpy.zeros(int(taxids.max(initial=0)) + 1, dtype=numpy.int32)
+    table[unique_taxids] = numpy.where(resolved, ancestors, 0)
+    return(table[taxids])
+
+def count_concordance(calls_a: numpy.ndarray, calls_b: numpy.ndarray) -> dict:
+    resolved_a, resolved_b = calls_a > 0, calls_b > 0
+    both = resolved_a & resolved_b
+    agree = int((both & (calls_a == calls_b)).sum())
+    return({
+        "agree": agree,
+        "disagree": int(both.sum()) - agree,
+        "only_a": int((resolved_a & ~resolved_b).sum()),
+        "only_b": int((resolved_b & ~resolved_a).sum()),
+        "neither": int((~resolved_a & ~resolved_b).sum()),
+    })
+
+def get_concordance_matrix(concordance: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    Tool x tool fraction of reads resolved by both tools that agree, pooled
+    over all samples.
+    """
+    pooled = concordance.groupby(["tool_a", "tool_b"], as_index=False)[
+        ["agree", "disagree"]].sum()
+    pooled = pandas.concat([pooled, pooled.rename(columns={"tool_a": "tool_b",
+                                                           "tool_b": "tool_a"})])
+    pooled["concordance"] = pooled["agree"] / (pooled["agree"] + pooled["disagree"])
+    matrix = pooled.pivot_table(index="tool_a", columns="tool_b", values="concordance",
+                                aggfunc="first", dropna=False)
+    for tool in matrix.index.intersection(matrix.columns):
+        matrix.loc[tool, tool] = 1.0
+    return(matrix)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+"""
+Randomly subsample FASTQ files to several depths at once. As with rasusa,
+reads are drawn in a random order until a target number of bases (or
+reads) is reached and are written in their original order. All depths of a
+file are prefixes of the same seeded random order of its reads, so smaller
+subsamples are nested in larger ones and runs with the same seed are
+reproducible.
+
+A first scan only collects the sequence length of every read. The file is
+then parsed once and each read is written to all subsamples it belongs to,
+each output being compressed in its own writer thread.
+
+Subsamples are written to <fastq name>.<target>.subsampled.fq.gz, or to
+<fastq name>.subsampled.fq.gz (as by rasusa) when there is a single target.
+"""
+
+import click
+import re
+import sys
+import numpy
+import pool_tools
+import compression_tools
+import fastq_tools
+import metrics
+from pathlib import Path
+
+
+BASE_UNITS = {"": 1, "k": 10**3, "m": 10**6, "g": 10**9, "t": 10**12}
+BASES_TARGET = re.compile(r"^(\d+(?:\.\d+)?)([kmgt]?)b?$", re.IGNORECASE)
+OUTPUT_SUFFIX = ".subsampled.fq.gz"
+
+
+@click.command()
+@click.argument(
+    "fastq_paths",
+    nargs=-1,
+    required=True,
+    type=click.Path(dir_okay=False, exists=True),
+)
+@click.option(
+    "--bases",
+    "bases_targets",
+    multiple=True,
+    type=click.STRING,
+    help="target number of bases, e.g. 5000MB or 2.5Gb (can be repeated)",
+)
+@click.option(
+    "--num-reads",
+    "reads_targets",
+    multiple=True,
+    type=click.INT,
+    help="target number of reads (can be repeated)",
+)
+@click.option(
+    "--outdir",
+    "outdir",
+    required=True,
+    type=click.Path(file_okay=False),
+    help="output directory for <fastq name>.<target>" + OUTPUT_SUFFIX + " files "
+         "(<fastq name>" + OUTPUT_SUFFIX + " for a single target)",
+)
+@click.option(
+    "--seed",
+    "seed",
+    type=click.INT,
+    default=0,
+    show_default=True,
+    help="seed of the random read order",
+)
+@click.option(
+    "--workers",
+    "workers",
+    type=click.INT,
+    default=1,
+    show_default=True,
+    help="number of fastq files subsampled in parallel",
+)
+@metrics.metrics_options
+def main(
+        fastq_paths: tuple,
+        bases_targets: tuple,
+        reads_targets: tuple,
+        outdir: str,
+        seed: int,
+        workers: int,
+        metrics_path: str,
+        profile_stage: str
+):
+    if not bases_targets and not reads_targets:
+        raise click.UsageError("Give at least one --bases or --num-reads target")
+    # (output label, number of bases or None, number of reads or None)
+    targets = [(label, parse_bases(label), None) for label in bases_targets]
+    targets += [(f"{num_reads}reads", None, num_reads) for num_reads in reads_targets]
+    output_dir = Path(outdir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    run_metrics = metrics.Metrics(command="subsample_reads", path=metrics_path,
+                                  profile_stage=profile_stage)
+
+    with run_metrics.stage("subsample") as stage:
+        subsampled = pool_tools.map_samples(
+            subsample_fastq, fastq_paths, workers=workers, targets=targets,
+            outdir=output_dir, seed=seed, with_metrics=run_metrics.enabled)
+        if run_metrics.enabled:
+            subsampled, records = pool_tools.split_metrics(subsampled)
+            run_metrics.add_samples("subsample_fastq", list(fastq_paths), records)
+        stage["rows"] = sum(sum(num_reads) for num_reads in subsampled)
+    run_metrics.write()
+
+def parse_bases(target: str) -> int:
+    match = BASES_TARGET.match(target.strip())
+    if not match:
+        raise click.BadParameter(f"Invalid number of bases: {target}",
+                                 param_hint="--bases")
+    return(int(float(match.group(1)) * BASE_UNITS[match.group(2).lower()]))
+
+def get_read_lengths(fastq_path: str) -> numpy.ndarray:
+    # sequence length of every read of a fastq file
+    lengths = []
+    with compression_tools.open_input(fastq_path, "rb") as fastq_fp:
+        chunks = iter(lambda: fastq_fp.read(fastq_tools.SCAN_SIZE), b"")
+        for _, _, newlines in fastq_tools.iter_record_buffers(chunks, fastq_path):
+            lengths.append(newlines[1::4] - newlines[0::4] - 1)
+    return(numpy.concatenate([numpy.array([], dtype=numpy.int64), *lengths]))
+
+def get_subsample_sizes(read_lengths: numpy.ndarray, order: numpy.ndarray,
+                        targets: list, fastq_path: str) -> list:
+    # number of reads, in random order, needed to reach each target
+    cumulative_bases = numpy.cumsum(read_lengths[order])
+    total_bases = int(cumulative_bases[-1]) if len(order) else 0
+    sizes = []
+    for label, num_bases, num_reads in targets:
+        if num_bases is not None:
+            if num_bases > total_bases:
+                print(f"{fastq_path} has only {total_bases} bases, writing all reads "
+                      f"for target {label}", file=sys.stderr)
+            size = int(numpy.searchsorted(cumulative_bases, num_bases)) + 1
+        else:
+            if num_reads > len(order):
+                print(f"{fastq_path} has only {len(order)} reads, writing all reads "
+                      f"for target {label}", file=sys.stderr)
+            size = num_reads
+        sizes.append(min(size, len(order)))
+    return(sizes)
+
+def get_output_name(fastq_path: str, label: str, targets: list) -> str:
+    fastq_name = Path(fastq_path).name
+    if len(targets) == 1:
+        return(fastq_name + OUTPUT_SUFFIX)
+    return(f"{fastq_name}.{label}{OUTPUT_SUFFIX}")
+
+def subsample_fastq(fastq_path: str, targets: list, outdir: Path, seed: int = 0) -> list:
+    """
+    Write the subsamples of a fastq file for all targets in one pass.
+    Returns the number of reads written per target.
+    """
+    read_lengths = get_read_lengths(fastq_path)
+    order = numpy.random.default_rng(seed).permutation(len(read_lengths))
+    sizes = get_subsample_sizes(read_lengths, order, targets, fastq_path)
+    # a read is in the subsamples whose size exceeds its rank in the random order
+    ranks = numpy.empty(len(order), dtype=numpy.int64)
+    ranks[order] = numpy.arange(len(order))
+    del read_lengths, order
+
+    outputs = [compression_tools.open_output(outdir / get_output_name(fastq_path, label, targets))
+               for label, _, _ in targets]
+    try:
+        first_read = 0
+        with compression_tools.open_input(fastq_path, "rb") as fastq_fp:
+            chunks = iter(lambda: fastq_fp.read(fastq_tools.SCAN_SIZE), b"")
+            for buffer, _, newlines in fastq_tools.iter_record_buffers(chunks, fastq_path):
+                ends = (newlines[3::4] + 1).tolist()
+                starts = [0] + ends[:-1]
+                chunk_ranks = ranks[first_read:first_read + len(ends)]
+                first_read += len(ends)
+                for output, size in zip(outputs, sizes):
+                    output.write(b"".join(
+                        buffer[starts[i]:ends[i]]
+                        for i in numpy.flatnonzero(chunk_ranks < size).tolist()))
+    finally:
+        for output in outputs:
+            output.close()
+    return(sizes)
+
+if __name__ == "__main__":
+    main()
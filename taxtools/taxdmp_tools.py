@@ -1,16 +1,560 @@
 #!/usr/bin/env python3
 
+import fcntl
+import json
+import mmap
+import os
+import struct
+import tarfile
+import tempfile
 from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
 from typing import TextIO
 from pathlib import Path
+import re
+import numpy
+import compression_tools
+
+
+# compiled taxonomy cache written next to nodes.dmp/names.dmp
+TAXA_CACHE = "taxa.cache.bin"
+ANCESTORS_CACHE = "ancestors.cache.bin"
+NAMES_CACHE = "names.cache.bin"
+TREE_CACHE = "tree.cache.bin"
+CACHE_MAGIC = b"TAXCACHE"
+# bump whenever the arrays compiled into any cache change, so that older
+# caches are rebuilt instead of being read with missing arrays
+CACHE_VERSION = 2
+CACHE_ALIGN = 64
+# elements written at a time, so that memory-mapped arrays are never copied whole
+CACHE_WRITE_SIZE = 1 << 20
+# read instead of nodes.dmp/names.dmp when the taxonomy directory was not unpacked
+TAXDUMP_ARCHIVE = "taxdump.tar.gz"
+
+# name class field of the scientific-name lines of names.dmp
+SCIENTIFIC_NAME_CLASS = re.compile(rb"\|\tscientific name\t\|")
+
+# ranks with a precomputed ancestor column in the rank-ancestor table
+CANONICAL_RANKS = ("superkingdom", "phylum", "class", "order", "family", "genus", "species")
+
+# pre-order positions per block of the LCA range-minimum structure
+LCA_BLOCK_SIZE = 32
 
 
 def create_taxa(taxonomy: str):
+    sources = get_taxdump_sources(taxonomy)
+    cache_path = Path(taxonomy + "/" + TAXA_CACHE)
+    arrays = load_cache(cache_path=cache_path, sources={"nodes.dmp": sources["nodes.dmp"]},
+                        build=lambda: compile_taxa(sources["nodes.dmp"]))
+    return(Taxa(arrays, taxonomy=taxonomy))
+
+def get_taxdump_sources(taxonomy: str) -> dict:
     nodes_dmp = Path(taxonomy + "/nodes.dmp")
-    names_dmp = Path(taxonomy + "/names.dmp")
-    with open(nodes_dmp, "r") as nodes_dmp_fp, open(names_dmp, "r") as names_dmp_fp:
-        taxa = build_taxa_dict(nodes_dmp_fp, names_dmp_fp)
-    return(taxa)
+    archive = Path(taxonomy + "/" + TAXDUMP_ARCHIVE)
+    if not nodes_dmp.exists() and archive.exists():
+        return({"nodes.dmp": archive, "names.dmp": archive})
+    return({"nodes.dmp": nodes_dmp, "names.dmp": Path(taxonomy + "/names.dmp")})
+
+@contextmanager
+def open_dmp(path: Path, member: str, mode: str = "r"):
+    # a (possibly compressed) .dmp file, or the member of that name when
+    # path is the taxdump archive
+    if path.name != TAXDUMP_ARCHIVE:
+        with compression_tools.open_input(path, mode) as dmp_fp:
+            yield(dmp_fp)
+        return
+    with compression_tools.open_input(path, "rb") as archive_fp, \
+            tarfile.open(fileobj=archive_fp, mode="r|") as tar:
+        for tar_member in tar:
+            if os.path.basename(tar_member.name) == member:
+                member_fp = tar.extractfile(tar_member)
+                yield(member_fp if "b" in mode else (line.decode() for line in member_fp))
+                return
+    raise FileNotFoundError(f"{member} missing from {path}")
+
+def read_dmp(path: Path, member: str):
+    # whole .dmp file as a bytes-like object, memory-mapped when uncompressed
+    if path.name == TAXDUMP_ARCHIVE:
+        with open_dmp(path, member, "rb") as dmp_fp:
+            return(dmp_fp.read())
+    if compression_tools.get_compression(path) is None and os.path.getsize(path):
+        with open(path, "rb") as dmp_fp:
+            return(mmap.mmap(dmp_fp.fileno(), 0, access=mmap.ACCESS_READ))
+    with compression_tools.open_input(path, "rb") as dmp_fp:
+        return(dmp_fp.read())
+
+def compile_taxa(nodes_dmp: Path) -> tuple[dict, dict]:
+    with open_dmp(nodes_dmp, "nodes.dmp") as nodes_dmp_fp:
+        taxa = build_taxa_dict(nodes_dmp_fp, names_dmp_fp=())
+    meta, arrays = taxa_dict_to_arrays(taxa)
+    del arrays["name_offsets"], arrays["name_blob"]
+    return(meta, arrays)
+
+def compile_names(names_dmp: Path) -> tuple[dict, dict]:
+    # only scientific-name lines are split into fields, the synonyms and
+    # common names making up most of names.dmp are skipped by the regex
+    data = read_dmp(names_dmp, "names.dmp")
+    names = {}
+    for match in SCIENTIFIC_NAME_CLASS.finditer(data):
+        line_start = data.rfind(b"\n", 0, match.start()) + 1
+        fields = data[line_start:match.start()].split(b"|", 2)
+        names[int(fields[0])] = b"_".join(fields[1].split())
+    taxids = sorted(names)
+    name_lengths = numpy.zeros(max(taxids, default=0) + 2, dtype=numpy.int64)
+    name_lengths[numpy.array(taxids, dtype=numpy.int64) + 1] = [len(names[taxid]) for taxid in taxids]
+    arrays = {
+        "name_offsets": numpy.cumsum(name_lengths),
+        "name_blob": numpy.frombuffer(b"".join(names[taxid] for taxid in taxids), dtype=numpy.uint8),
+    }
+    return({}, arrays)
+
+def taxa_dict_to_arrays(taxa: dict) -> tuple[dict, dict]:
+    max_taxid = max(taxa, default=0)
+    ranks = sorted({taxon["rank"] for taxon in taxa.values()})
+    rank_codes = {rank: code for code, rank in enumerate(ranks)}
+
+    # taxids index the arrays directly, parent 0 marks an unknown taxid
+    parent = numpy.zeros(max_taxid + 1, dtype=numpy.int32)
+    rank = numpy.zeros(max_taxid + 1, dtype=numpy.uint8)
+    name_lengths = numpy.zeros(max_taxid + 2, dtype=numpy.int64)
+    names = []
+    for taxid in sorted(taxa):
+        parent[taxid] = taxa[taxid]["parent"]
+        rank[taxid] = rank_codes[taxa[taxid]["rank"]]
+        name = taxa[taxid].get("name", "").encode()
+        name_lengths[taxid + 1] = len(name)
+        names.append(name)
+    arrays = {
+        "parent": parent,
+        "rank": rank,
+        "name_offsets": numpy.cumsum(name_lengths),
+        "name_blob": numpy.frombuffer(b"".join(names), dtype=numpy.uint8),
+    }
+    return({"ranks": ranks, "num_taxa": len(taxa)}, arrays)
+
+def compile_rank_ancestors(parents: numpy.ndarray, rank_codes: numpy.ndarray,
+                           ranks: tuple) -> tuple[dict, dict]:
+    # walk all taxa up the tree in lockstep, recording the lowest ancestor
+    # (or the taxon itself) found at each canonical rank
+    ancestors = numpy.zeros((len(parents), len(CANONICAL_RANKS)), dtype=numpy.int32)
+    columns = numpy.full(len(ranks) + 1, -1, dtype=numpy.int64)
+    for column, rank in enumerate(CANONICAL_RANKS):
+        if rank in ranks:
+            columns[ranks.index(rank)] = column
+    taxids = numpy.flatnonzero(parents).astype(numpy.int64)
+    current = taxids.copy()
+    while len(taxids):
+        column = columns[rank_codes[current]]
+        found = (column >= 0) & (parents[current] != 0)
+        unset = ancestors[taxids[found], column[found]] == 0
+        ancestors[taxids[found][unset], column[found][unset]] = current[found][unset]
+        current = parents[current].astype(numpy.int64)
+        keep = current > 1
+        taxids, current = taxids[keep], current[keep]
+    return({"ranks": list(CANONICAL_RANKS)}, {"ancestors": ancestors})
+
+def compile_tree_index(parents: numpy.ndarray) -> tuple[dict, dict]:
+    """
+    Pre-order walk of the taxonomy with a range-minimum structure over the
+    depths along the walk. A taxon and its descendants take up the pre-order
+    positions from its own to its subtree_end, so subtree membership is
+    an interval test. The lowest common ancestor of two taxa is the
+    parent of the shallowest taxon after the first and up to the second of
+    them in pre-order (as in an Euler tour, with half the positions).
+    Minima are precomputed from the start and to the end of each block of
+    LCA_BLOCK_SIZE positions and, in a sparse table, over runs of 2^k blocks.
+    """
+    taxids = numpy.flatnonzero(parents).astype(numpy.int64)
+    is_root = parents[taxids] == taxids
+    roots, children = taxids[is_root], taxids[~is_root]
+    # children grouped by parent, in taxid order
+    children = children[numpy.argsort(parents[children], kind="stable")]
+    child_starts = numpy.searchsorted(parents[children], numpy.arange(len(parents) + 1))
+    num_children = numpy.diff(child_starts)
+
+    # top-down levels of the tree, each grouped by parent
+    levels = [roots]
+    while True:
+        frontier = levels[-1]
+        counts = num_children[frontier]
+        if not counts.sum():
+            break
+        ends = numpy.cumsum(counts)
+        positions = numpy.repeat(child_starts[frontier] - (ends - counts), counts) + \
+            numpy.arange(ends[-1])
+        levels.append(children[positions])
+
+    depth = numpy.full(len(parents), -1, dtype=numpy.int32)
+    for level, level_taxids in enumerate(levels):
+        depth[level_taxids] = level
+    subtree_size = numpy.zeros(len(parents), dtype=numpy.int64)
+    subtree_size[taxids] = 1
+    for level_taxids in reversed(levels[1:]):
+        numpy.add.at(subtree_size, parents[level_taxids], subtree_size[level_taxids])
+
+    # a taxon follows its parent and the subtrees of its earlier siblings
+    preorder = numpy.full(len(parents), -1, dtype=numpy.int64)
+    preorder[roots] = numpy.cumsum(subtree_size[roots]) - subtree_size[roots]
+    for level_taxids in levels[1:]:
+        level_parents = parents[level_taxids]
+        preceding = numpy.cumsum(subtree_size[level_taxids]) - subtree_size[level_taxids]
+        first_sibling = numpy.flatnonzero(numpy.r_[True, level_parents[1:] != level_parents[:-1]])
+        sibling_counts = numpy.diff(numpy.r_[first_sibling, len(level_taxids)])
+        preceding -= numpy.repeat(preceding[first_sibling], sibling_counts)
+        preorder[level_taxids] = preorder[level_parents] + 1 + preceding
+    # taxa cut off from a root (parent cycles or unknown parents) are left out
+    reached = taxids[preorder[taxids] >= 0]
+    order = numpy.empty(len(reached), dtype=numpy.int32)
+    order[preorder[reached]] = reached
+    order_depth = depth[order]
+
+    # position of the minimum depth from the block start / to the block end
+    num_blocks = -(-len(order) // LCA_BLOCK_SIZE)
+    padded = numpy.full(num_blocks * LCA_BLOCK_SIZE, numpy.iinfo(numpy.int32).max,
+                        dtype=numpy.int64)
+    padded[:len(order)] = order_depth
+    blocks = padded.reshape(num_blocks, LCA_BLOCK_SIZE)
+    # depth * 2^32 + position keeps the leftmost minimum in running minima
+    keys = (blocks << 32) | numpy.arange(len(padded)).reshape(blocks.shape)
+    prefix_min = numpy.minimum.accumulate(keys, axis=1).reshape(-1)[:len(order)] & 0xFFFFFFFF
+    suffix_min = numpy.minimum.accumulate(keys[:, ::-1], axis=1)[:, ::-1].reshape(-1)[
+        :len(order)] & 0xFFFFFFFF
+    block_table = [keys.min(axis=1)]
+    while 2 ** len(block_table) <= num_blocks:
+        previous, step = block_table[-1], 2 ** (len(block_table) - 1)
+        block_table.append(numpy.minimum(previous[:-step], previous[step:]))
+    block_table = numpy.stack([numpy.pad(row, (0, num_blocks - len(row))) & 0xFFFFFFFF
+                               for row in block_table])
+    return({"block_size": LCA_BLOCK_SIZE}, {
+        "preorder": preorder.astype(numpy.int32),
+        "subtree_end": numpy.where(preorder >= 0, preorder + subtree_size - 1, -1)
+                       .astype(numpy.int32),
+        "order": order,
+        "order_depth": order_depth,
+        "prefix_min": prefix_min.astype(numpy.int32),
+        "suffix_min": suffix_min.astype(numpy.int32),
+        "block_table": block_table.astype(numpy.int32),
+    })
+
+def get_source_stamps(sources: dict) -> dict:
+    stamps = {}
+    for key, path in sources.items():
+        stat = os.stat(path)
+        stamps[key] = [stat.st_size, stat.st_mtime_ns]
+    return(stamps)
+
+def get_taxonomy_version(taxonomy: str) -> str:
+    # changes whenever nodes.dmp or names.dmp change
+    stamps = get_source_stamps(get_taxdump_sources(taxonomy))
+    return(json.dumps(stamps, sort_keys=True))
+
+def load_cache(cache_path: Path, sources: dict, build):
+    """
+    Memory-map a compiled cache file, (re)building it with build() when it
+    is missing or when the size/mtime of any of its source files changed.
+    If the cache cannot be written, the freshly built arrays are returned.
+    """
+    stamps = get_source_stamps(sources)
+    cached = read_cache(cache_path, stamps)
+    if cached is not None:
+        return(cached)
+    try:
+        lock_fp = open(str(cache_path) + ".lock", "w")
+    except OSError:
+        return(build())
+    with lock_fp:
+        # only one of several concurrent jobs compiles, the others wait for it
+        fcntl.flock(lock_fp, fcntl.LOCK_EX)
+        cached = read_cache(cache_path, stamps)
+        if cached is not None:
+            return(cached)
+        meta, arrays = build()
+        try:
+            write_cache(cache_path, stamps, meta, arrays)
+        except OSError:
+            return(meta, arrays)
+    return(read_cache(cache_path, stamps))
+
+def write_cache(cache_path: Path, stamps: dict, meta: dict, arrays: dict):
+    layout = {}
+    offset = 0
+    for key, array in arrays.items():
+        layout[key] = {"dtype": array.dtype.str, "shape": list(array.shape),
+                       "offset": offset}
+        offset += -(-array.nbytes // CACHE_ALIGN) * CACHE_ALIGN
+    header = json.dumps({"version": CACHE_VERSION, "sources": stamps,
+                         "meta": meta, "arrays": layout}).encode()
+    data_start = -(-(len(CACHE_MAGIC) + 8 + len(header)) // CACHE_ALIGN) * CACHE_ALIGN
+
+    # write to a temporary file and rename so readers never see partial caches
+    fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, prefix=cache_path.name)
+    try:
+        with os.fdopen(fd, "wb") as cache_fp:
+            cache_fp.write(CACHE_MAGIC + struct.pack("<Q", len(header)) + header)
+            for key, array in arrays.items():
+                cache_fp.seek(data_start + layout[key]["offset"])
+                values = numpy.ascontiguousarray(array).reshape(-1)
+                for start in range(0, len(values), CACHE_WRITE_SIZE):
+                    cache_fp.write(values[start:start + CACHE_WRITE_SIZE].tobytes())
+            cache_fp.truncate(data_start + offset)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def read_cache(cache_path: Path, stamps: dict):
+    try:
+        with open(cache_path, "rb") as cache_fp:
+            if cache_fp.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+                return(None)
+            header_len = struct.unpack("<Q", cache_fp.read(8))[0]
+            header = json.loads(cache_fp.read(header_len))
+            if header["version"] != CACHE_VERSION or header["sources"] != stamps:
+                return(None)
+            buffer = mmap.mmap(cache_fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, struct.error):
+        return(None)
+    data_start = -(-(len(CACHE_MAGIC) + 8 + header_len) // CACHE_ALIGN) * CACHE_ALIGN
+    arrays = {}
+    for key, layout in header["arrays"].items():
+        dtype = numpy.dtype(layout["dtype"])
+        count = int(numpy.prod(layout["shape"]))
+        arrays[key] = numpy.frombuffer(
+            buffer, dtype=dtype, count=count, offset=data_start + layout["offset"]
+        ).reshape(layout["shape"])
+    return(header["meta"], arrays)
+
+
+class Taxa(Mapping):
+    """
+    Read-only taxid -> {"parent", "rank", "name"} mapping backed by flat
+    (usually memory-mapped) arrays. Drop-in replacement for the dict
+    returned by build_taxa_dict.
+    """
+    def __init__(self, compiled: tuple[dict, dict], taxonomy: str = None):
+        meta, arrays = compiled
+        self.taxonomy = taxonomy
+        self._rank_ancestors = None
+        self._tree = None
+        self._names = None
+        if "name_offsets" in arrays:
+            self._names = arrays
+        self.ranks = tuple(meta["ranks"])
+        self.num_taxa = meta["num_taxa"]
+        self.parents = arrays["parent"]
+        self.rank_codes = arrays["rank"]
+
+    def __contains__(self, taxid):
+        try:
+            return(0 < taxid < len(self.parents) and self.parents[taxid] != 0)
+        except TypeError:
+            return(False)
+
+    def __getitem__(self, taxid):
+        if taxid not in self:
+            raise KeyError(taxid)
+        return(Taxon(self, int(taxid)))
+
+    def __iter__(self):
+        return(iter(numpy.flatnonzero(self.parents).tolist()))
+
+    def __len__(self):
+        return(self.num_taxa)
+
+    def parent(self, taxid: int) -> int:
+        return(int(self.parents[taxid]))
+
+    def rank(self, taxid: int) -> str:
+        return(self.ranks[self.rank_codes[taxid]])
+
+    def name(self, taxid: int) -> str:
+        if taxid + 1 >= len(self.name_offsets):
+            raise KeyError("name")
+        start, end = self.name_offsets[taxid], self.name_offsets[taxid + 1]
+        if start == end:
+            raise KeyError("name")
+        return(self.name_blob[start:end].tobytes().decode())
+
+    @property
+    def names(self) -> dict:
+        """
+        name_offsets/name_blob arrays of scientific names, compiled from
+        names.dmp into their own cache on first use so that name-free runs
+        never read names.dmp.
+        """
+        if self._names is None:
+            names_dmp = get_taxdump_sources(self.taxonomy)["names.dmp"]
+            _, self._names = load_cache(
+                cache_path=Path(self.taxonomy + "/" + NAMES_CACHE),
+                sources={"names.dmp": names_dmp},
+                build=lambda: compile_names(names_dmp))
+        return(self._names)
+
+    @property
+    def name_offsets(self) -> numpy.ndarray:
+        return(self.names["name_offsets"])
+
+    @property
+    def name_blob(self) -> numpy.ndarray:
+        return(self.names["name_blob"])
+
+    @property
+    def rank_ancestors(self) -> numpy.ndarray:
+        """
+        taxid x CANONICAL_RANKS matrix of ancestor taxids (0 where a taxon
+        has no ancestor at that rank), cached next to nodes.dmp.
+        """
+        if self._rank_ancestors is None:
+            build = lambda: compile_rank_ancestors(
+                self.parents, self.rank_codes, self.ranks)
+            if self.taxonomy is None:
+                _, arrays = build()
+            else:
+                _, arrays = load_cache(
+                    cache_path=Path(self.taxonomy + "/" + ANCESTORS_CACHE),
+                    sources={"nodes.dmp": get_taxdump_sources(self.taxonomy)["nodes.dmp"]},
+                    build=build)
+            self._rank_ancestors = arrays["ancestors"]
+        return(self._rank_ancestors)
+
+    @property
+    def tree(self) -> dict:
+        """
+        Pre-order walk and range-minimum arrays of compile_tree_index,
+        cached next to nodes.dmp.
+        """
+        if self._tree is None:
+            build = lambda: compile_tree_index(self.parents)
+            if self.taxonomy is None:
+                _, self._tree = build()
+            else:
+                _, self._tree = load_cache(
+                    cache_path=Path(self.taxonomy + "/" + TREE_CACHE),
+                    sources={"nodes.dmp": get_taxdump_sources(self.taxonomy)["nodes.dmp"]},
+                    build=build)
+        return(self._tree)
+
+    def lca(self, taxids_a: numpy.ndarray, taxids_b: numpy.ndarray) -> numpy.ndarray:
+        # pairwise lowest common ancestors, 0 where a taxid is unknown
+        taxids_a = numpy.asarray(taxids_a, dtype=numpy.int64)
+        taxids_b = numpy.asarray(taxids_b, dtype=numpy.int64)
+        tree = self.tree
+        preorder_a = self.preorder(taxids_a)
+        preorder_b = self.preorder(taxids_b)
+        known = (preorder_a >= 0) & (preorder_b >= 0)
+        first = numpy.minimum(preorder_a, preorder_b)[known]
+        last = numpy.maximum(preorder_a, preorder_b)[known]
+
+        lcas = numpy.where(known & (preorder_a == preorder_b), taxids_a, 0)
+        differ = first != last
+        shallowest = tree["order"][self.min_depth_positions(first[differ] + 1, last[differ])]
+        # the shallowest taxon is a root if the taxa are in different trees
+        parents = self.parents[shallowest]
+        lcas[numpy.flatnonzero(known)[differ]] = numpy.where(parents == shallowest, 0, parents)
+        return(lcas)
+
+    def preorder(self, taxids: numpy.ndarray) -> numpy.ndarray:
+        # pre-order positions of taxids, -1 for unknown taxids
+        known = self.known(taxids)
+        return(numpy.where(known, self.tree["preorder"][numpy.where(known, taxids, 0)], -1)
+               .astype(numpy.int64))
+
+    def in_clades(self, taxids: numpy.ndarray, clades) -> numpy.ndarray:
+        """
+        Boolean mask of taxids that are one of the clades or descend from
+        one. The pre-order intervals of the clades are merged, so each taxid
+        is located with one binary search and two comparisons.
+        """
+        taxids = numpy.asarray(taxids, dtype=numpy.int64)
+        clades = numpy.asarray(clades, dtype=numpy.int64).reshape(-1)
+        clade_starts = self.preorder(clades)
+        clades, clade_starts = clades[clade_starts >= 0], clade_starts[clade_starts >= 0]
+        clade_ends = self.tree["subtree_end"][clades].astype(numpy.int64)
+        order = numpy.argsort(clade_starts, kind="stable")
+        clade_starts, clade_ends = clade_starts[order], clade_ends[order]
+        # nested clades are covered by the interval of the outermost one
+        outermost = clade_ends > numpy.maximum.accumulate(
+            numpy.r_[-1, clade_ends[:-1]])
+        clade_starts, clade_ends = clade_starts[outermost], clade_ends[outermost]
+
+        positions = self.preorder(taxids)
+        if not len(clade_starts):
+            return(numpy.zeros(positions.shape, dtype=bool))
+        interval = numpy.searchsorted(clade_starts, positions, side="right") - 1
+        return((positions >= 0) & (interval >= 0)
+               & (positions <= clade_ends[numpy.maximum(interval, 0)]))
+
+    def min_depth_positions(self, starts: numpy.ndarray, ends: numpy.ndarray) -> numpy.ndarray:
+        # pre-order position of the shallowest taxon in each [start, end] range
+        tree = self.tree
+        depth = tree["order_depth"]
+        block_size = LCA_BLOCK_SIZE
+        start_blocks, end_blocks = starts // block_size, ends // block_size
+        positions = numpy.empty(len(starts), dtype=numpy.int64)
+
+        # ranges within one block are scanned position by position
+        within = start_blocks == end_blocks
+        within_starts, within_ends = starts[within], ends[within]
+        best = within_starts.copy()
+        for offset in range(1, block_size):
+            candidates = numpy.minimum(within_starts + offset, within_ends)
+            better = depth[candidates] < depth[best]
+            best[better] = candidates[better]
+        positions[within] = best
+
+        # other ranges: the end of the first block, whole blocks in between
+        # and the start of the last block
+        starts, ends = starts[~within], ends[~within]
+        start_blocks, end_blocks = start_blocks[~within], end_blocks[~within]
+        candidates = [tree["suffix_min"][starts], tree["prefix_min"][ends]]
+        between = end_blocks - start_blocks - 1
+        has_between = between > 0
+        level = numpy.zeros(len(between), dtype=numpy.int64)
+        level[has_between] = numpy.log2(between[has_between]).astype(numpy.int64)
+        first_block = numpy.where(has_between, start_blocks + 1, 0)
+        last_block = numpy.where(has_between, end_blocks - (1 << level), 0)
+        table = tree["block_table"]
+        for block in (first_block, last_block):
+            candidates.append(numpy.where(has_between, table[level, block], candidates[0]))
+        candidates = numpy.stack(candidates).astype(numpy.int64)
+        shallowest = numpy.argmin(depth[candidates], axis=0)
+        positions[~within] = candidates[shallowest, numpy.arange(len(starts))]
+        return(positions)
+
+    def known(self, taxids: numpy.ndarray) -> numpy.ndarray:
+        in_range = (taxids > 0) & (taxids < len(self.parents))
+        return(in_range & (self.parents[numpy.where(in_range, taxids, 0)] != 0))
+
+    def ancestors_at_rank(self, taxids: numpy.ndarray, target_rank: str) -> numpy.ndarray:
+        # gather ancestors at a canonical rank, 0 for unknown/unresolved taxids
+        known = self.known(taxids)
+        column = CANONICAL_RANKS.index(target_rank)
+        return(numpy.where(
+            known, self.rank_ancestors[numpy.where(known, taxids, 0), column], 0))
+
+
+class Taxon(Mapping):
+    def __init__(self, taxa: Taxa, taxid: int):
+        self.taxa = taxa
+        self.taxid = taxid
+
+    def __getitem__(self, key):
+        match key:
+            case "parent":
+                return(self.taxa.parent(self.taxid))
+            case "rank":
+                return(self.taxa.rank(self.taxid))
+            case "name":
+                return(self.taxa.name(self.taxid))
+        raise KeyError(key)
+
+    def __iter__(self):
+        return(iter(("parent", "rank", "name")))
+
+    def __len__(self):
+        return(3)
 
 def build_taxa_dict(nodes_dmp_fp: TextIO, names_dmp_fp: TextIO) -> dict:
     taxa = {}
@@ -46,6 +590,14 @@ def get_taxon_rank(taxid: int, taxa: dict):
         return("no rank")
 
 def get_ancestor_at_rank(first_taxid: int, target_rank: str, taxa: dict):
+    if isinstance(taxa, Taxa) and target_rank in CANONICAL_RANKS:
+        if first_taxid <= 1:
+            return(first_taxid)
+        if first_taxid not in taxa:
+            print("Unknown taxid. Unable to get ancestor.")
+            return(first_taxid)
+        ancestor = int(taxa.ancestors_at_rank(numpy.array([first_taxid]), target_rank)[0])
+        return(ancestor if ancestor > 0 else first_taxid)
     taxid = first_taxid
     while taxid > 1:
         try:
@@ -59,13 +611,69 @@ def get_ancestor_at_rank(first_taxid: int, target_rank: str, taxa: dict):
     # return original taxid if no ancestor of target rank found
     return(first_taxid)
 
+def get_ancestors_at_rank(taxids, target_rank: str, taxa: dict) -> numpy.ndarray:
+    """
+    Vectorised get_ancestor_at_rank over an array/Series of taxids. Taxids
+    without an ancestor at target_rank (or unknown taxids) are returned as is.
+    """
+    taxids = numpy.asarray(taxids, dtype=numpy.int64)
+    if isinstance(taxa, Taxa) and target_rank in CANONICAL_RANKS:
+        ancestors = taxa.ancestors_at_rank(taxids, target_rank)
+        return(numpy.where(ancestors > 0, ancestors, taxids))
+    unique_taxids, inverse = numpy.unique(taxids, return_inverse=True)
+    ancestors = numpy.array(
+        [get_ancestor_at_rank(int(taxid), target_rank, taxa) for taxid in unique_taxids],
+        dtype=numpy.int64)
+    return(ancestors[inverse].reshape(taxids.shape))
+
+def get_rank_descendants(ancestors, target_rank: str, taxa: dict) -> numpy.ndarray:
+    """
+    All taxids that get_ancestor_at_rank summarises to one of the given
+    ancestors at target_rank (including the ancestors themselves).
+    """
+    ancestors = numpy.asarray(ancestors, dtype=numpy.int64)
+    if isinstance(taxa, Taxa) and target_rank in CANONICAL_RANKS:
+        column = taxa.rank_ancestors[:, CANONICAL_RANKS.index(target_rank)]
+        return(numpy.flatnonzero(numpy.isin(column, ancestors[ancestors > 0])))
+    taxids = numpy.array(list(taxa), dtype=numpy.int64)
+    summarised = get_ancestors_at_rank(taxids, target_rank, taxa)
+    keep = numpy.isin(summarised, ancestors) & have_rank(summarised, target_rank, taxa)
+    return(numpy.sort(taxids[keep]))
+
+def have_rank(taxids, rank: str, taxa: dict) -> numpy.ndarray:
+    # boolean mask of taxids with the given rank, False for unknown taxids
+    taxids = numpy.asarray(taxids, dtype=numpy.int64)
+    if isinstance(taxa, Taxa):
+        if rank not in taxa.ranks:
+            return(numpy.zeros(taxids.shape, dtype=bool))
+        known = taxa.known(taxids)
+        return(known & (taxa.rank_codes[numpy.where(known, taxids, 0)]
+                        == taxa.ranks.index(rank)))
+    return(numpy.array(
+        [taxid in taxa and taxa[taxid]["rank"] == rank for taxid in taxids.tolist()],
+        dtype=bool).reshape(taxids.shape))
+
 def ancestor_is_in(first_taxid: int, ancestors: list, taxa: dict):
-    taxid = first_taxid
-    while taxid > 1:
-        if taxid in ancestors:
-            return(True)
-        taxid = taxa[taxid]["parent"]
-    return(False)
+    return(bool(are_in_clades([first_taxid], clades=ancestors, taxa=taxa)[0]))
+
+def are_in_clades(taxids, clades, taxa: dict) -> numpy.ndarray:
+    # boolean mask of taxids that are one of the clades or descend from one,
+    # False for unknown taxids
+    taxids = numpy.asarray(taxids, dtype=numpy.int64)
+    if isinstance(taxa, Taxa):
+        return(taxa.in_clades(taxids, clades).reshape(taxids.shape))
+    clades = set(int(clade) for clade in clades)
+    unique_taxids, inverse = numpy.unique(taxids, return_inverse=True)
+    inside = numpy.zeros(len(unique_taxids), dtype=bool)
+    for i, taxid in enumerate(unique_taxids.tolist()):
+        seen = set()
+        while taxid in taxa and taxid not in seen:
+            if taxid in clades:
+                inside[i] = True
+                break
+            seen.add(taxid)
+            taxid = taxa[taxid]["parent"]
+    return(inside[inverse].reshape(taxids.shape))
 
 def get_lineage(
         first_taxid: int,
@@ -76,6 +684,13 @@ def get_lineage(
     taxonomy = OrderedDict()
     for rank in wanted_ranks:
         taxonomy[rank] = None # OrderedDict preserves order of insertion
+    if isinstance(taxa, Taxa) and set(wanted_ranks) <= set(CANONICAL_RANKS):
+        row = taxa.rank_ancestors[taxa[first_taxid].taxid]
+        for rank in wanted_ranks:
+            ancestor = int(row[CANONICAL_RANKS.index(rank)])
+            if ancestor > 0:
+                taxonomy[rank] = ancestor if output_taxids else taxa.name(ancestor)
+        return taxonomy
     taxid = first_taxid
     while True:
         if taxid == 1:
@@ -88,6 +703,89 @@ def get_lineage(
         taxid = taxa[taxid]["parent"]
     return taxonomy
 
+def get_lineages(taxids, taxa: dict, wanted_ranks: tuple[str]) -> numpy.ndarray:
+    """
+    Vectorised get_lineage(..., output_taxids=True) over an array of taxids:
+    a len(taxids) x len(wanted_ranks) matrix of ancestor taxids, 0 where a
+    lineage has no taxon at a rank or the taxid is unknown.
+    """
+    taxids = numpy.asarray(taxids, dtype=numpy.int64)
+    if isinstance(taxa, Taxa) and set(wanted_ranks) <= set(CANONICAL_RANKS):
+        columns = [CANONICAL_RANKS.index(rank) for rank in wanted_ranks]
+        known = taxa.known(taxids)
+        lineages = taxa.rank_ancestors[numpy.where(known, taxids, 0)][:, columns]
+        return(numpy.where(known[:, None], lineages, 0).astype(numpy.int64))
+    unique_taxids, inverse = numpy.unique(taxids, return_inverse=True)
+    lineages = numpy.zeros((len(unique_taxids), len(wanted_ranks)), dtype=numpy.int64)
+    for row, taxid in enumerate(unique_taxids.tolist()):
+        if taxid not in taxa:
+            continue
+        lineage = get_lineage(first_taxid=taxid, taxa=taxa, wanted_ranks=wanted_ranks,
+                              output_taxids=True)
+        lineages[row] = [ancestor or 0 for ancestor in lineage.values()]
+    return(lineages[inverse.reshape(-1)])
+
+def get_lca(taxid_a: int, taxid_b: int, taxa: dict) -> int:
+    # lowest common ancestor of two taxids, 0 if either is unknown
+    if isinstance(taxa, Taxa):
+        return(int(taxa.lca(numpy.array([taxid_a]), numpy.array([taxid_b]))[0]))
+    if taxid_a not in taxa or taxid_b not in taxa:
+        return(0)
+    ancestors = set()
+    taxid = taxid_a
+    while taxid not in ancestors:
+        ancestors.add(taxid)
+        taxid = taxa[taxid]["parent"]
+        if taxid not in taxa:
+            break
+    taxid = taxid_b
+    while taxid not in ancestors:
+        parent = taxa[taxid]["parent"]
+        if parent == taxid or parent not in taxa:
+            return(0)
+        taxid = parent
+    return(taxid)
+
+def get_lcas(taxids_a, taxids_b, taxa: dict) -> numpy.ndarray:
+    # vectorised get_lca over two arrays of taxids
+    taxids_a = numpy.asarray(taxids_a, dtype=numpy.int64)
+    taxids_b = numpy.asarray(taxids_b, dtype=numpy.int64)
+    if isinstance(taxa, Taxa):
+        return(taxa.lca(taxids_a, taxids_b))
+    return(numpy.array(
+        [get_lca(taxid_a, taxid_b, taxa)
+         for taxid_a, taxid_b in zip(taxids_a.tolist(), taxids_b.tolist())],
+        dtype=numpy.int64).reshape(taxids_a.shape))
+
+def get_group_lcas(taxids, groups, taxa: dict) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Lowest common ancestor of the taxids of each group (e.g. the hit taxids
+    of each read), ignoring unknown taxids. Returns the sorted distinct
+    groups and their LCAs, 0 for groups without a known taxid. The LCA of a
+    group is the LCA of its first and last taxon in pre-order.
+    """
+    taxids = numpy.asarray(taxids, dtype=numpy.int64)
+    unique_groups, group_codes = numpy.unique(numpy.asarray(groups), return_inverse=True)
+    group_codes = group_codes.reshape(-1)
+    lcas = numpy.zeros(len(unique_groups), dtype=numpy.int64)
+    if isinstance(taxa, Taxa):
+        preorder = taxa.preorder(taxids)
+        known = preorder >= 0
+        group_codes, taxids, preorder = group_codes[known], taxids[known], preorder[known]
+        by_group = numpy.argsort(group_codes * len(taxa.tree["order"]) + preorder)
+        group_codes, taxids = group_codes[by_group], taxids[by_group]
+        firsts = numpy.flatnonzero(numpy.diff(group_codes, prepend=-1) != 0)
+        lasts = numpy.flatnonzero(numpy.diff(group_codes, append=-1) != 0)
+        lcas[group_codes[firsts]] = taxa.lca(taxids[firsts], taxids[lasts])
+        return(unique_groups, lcas)
+    seen = numpy.zeros(len(unique_groups), dtype=bool)
+    for code, taxid in zip(group_codes.tolist(), taxids.tolist()):
+        if taxid not in taxa:
+            continue
+        lcas[code] = get_lca(int(lcas[code]), taxid, taxa) if seen[code] else taxid
+        seen[code] = True
+    return(unique_groups, lcas)
+
 def prune_lineage_empty_ranks(lineage: OrderedDict):
     return(
         OrderedDict(
@@ -98,6 +796,11 @@ def prune_lineage_empty_ranks(lineage: OrderedDict):
     )
 
 def map_taxids_to_higher(taxids: list, target_rank: str, taxa: dict):
+    if isinstance(taxa, Taxa) and target_rank in CANONICAL_RANKS:
+        unique_taxids = numpy.unique(numpy.asarray(taxids, dtype=numpy.int64))
+        ancestors = taxa.ancestors_at_rank(unique_taxids, target_rank)
+        found = ancestors > 0
+        return(dict(zip(unique_taxids[found].tolist(), ancestors[found].tolist())))
     taxid_map = {}
     for taxid in taxids:
         new_taxid = taxid
@@ -107,4 +810,4 @@ def map_taxids_to_higher(taxids: list, target_rank: str, taxa: dict):
                 taxid_map[taxid] = new_taxid
                 break
             new_taxid = taxa[new_taxid]["parent"]
-    return(taxid_map)
\ No newline at end of file
+    return(taxid_map)
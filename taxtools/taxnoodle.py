@@ -4,11 +4,22 @@ import click
 from collections import OrderedDict
 from typing import TextIO
 import taxdmp_tools
+import pool_tools
+import profile_cache
+import metrics
+import compression_tools
+import sys
+import extract_positive_reads
 from pathlib import Path
+import numpy
 import pandas
 from functools import reduce
 
 
+# classifiers with a profile parser, also the per-tool samplesheet column names
+CLASSIFIERS = ("kraken2", "diamond", "metabuli", "metacache", "sylph")
+
+
 @click.command()
 @click.option(
     "--samplesheet",
@@ -34,9 +45,12 @@ from functools import reduce
 @click.option(
     "--tool",
     "tool",
-    required=True,
     type=click.STRING,
-    help="classifier tool used to generate sample profiles"
+    help="classifier tool used to generate sample profiles, read from the column named after "
+         "the tool or else the second column. Without it, the samplesheet must have one "
+         "per-read output column per classifier (as for extract_positive_reads) and all tools "
+         "are processed in one run, writing <output stem>.<tool> matrices and a combined "
+         "<output stem>.long table"
 )
 @click.option(
     "--summarise-at",
@@ -45,35 +59,145 @@ from functools import reduce
     type=click.STRING,
     help="summarise abundance profiles up to the given taxonomic rank and ignore abundances at higher ranks"
 )
-
+@click.option(
+    "--clade",
+    "clades",
+    multiple=True,
+    type=click.INT,
+    help="only report taxa within this clade, e.g. 10239 for viruses (can be repeated)"
+)
+@click.option(
+    "--workers",
+    "workers",
+    default=1,
+    show_default=True,
+    type=click.INT,
+    help="number of sample profiles parsed in parallel"
+)
+@click.option(
+    "--per-read/--reports",
+    "per_read",
+    default=None,
+    help="count reads per taxon from per-read classifier outputs, or parse abundance reports "
+         "[default: per-read outputs without --tool, as for extract_positive_reads, "
+         "reports with --tool]"
+)
+@click.option(
+    "--update",
+    "update",
+    is_flag=True,
+    default=False,
+    help="reuse cached counts of unchanged sample profiles and only process new or changed "
+         "ones (counts are cached by every run)"
+)
+@click.option(
+    "--cache-dir",
+    "cache_dir",
+    type=click.Path(file_okay=False),
+    help="directory of cached per-sample counts [default: .taxnoodle_cache next to the output]"
+)
+@click.option(
+    "--output-format",
+    "output_format",
+    default="tsv",
+    show_default=True,
+    type=click.Choice(["tsv", "parquet", "arrow"]),
+    help="write a dense taxa x samples tsv matrix, or sparse long-format counts and a "
+         "separate taxon annotation table as Parquet or Arrow (requires pyarrow)"
+)
+@metrics.metrics_options
 def main(
         samplesheet_fp: TextIO,
         taxonomy: str,
         output_path: str,
         tool: str,
-        summarise_at: str
+        summarise_at: str,
+        clades: tuple,
+        workers: int,
+        per_read: bool,
+        output_format: str,
+        update: bool,
+        cache_dir: str,
+        metrics_path: str,
+        profile_stage: str
 ):
 
     output_file = Path(output_path)
     output_file.parent.mkdir(parents=True, exist_ok=True)
+    run_metrics = metrics.Metrics(command="taxnoodle", path=metrics_path,
+                                  profile_stage=profile_stage)
+
+    tool_profiles = get_tool_profiles(samplesheet_fp=samplesheet_fp, tool=tool)
+    multi_tool = tool is None
+    if per_read is None:
+        # multi-tool samplesheets hold per-read outputs, as for extract_positive_reads
+        per_read = multi_tool
+    with run_metrics.stage("taxonomy_load"):
+        taxa = taxdmp_tools.create_taxa(taxonomy = taxonomy)
+    # name/rank/lineage of each taxid, annotated once and shared by all stages and tools
+    annotations = {}
+    # counts are always cached, so that a later --update run only parses new samples
+    cache_path = Path(cache_dir or str(output_file.parent) + "/.taxnoodle_cache")
+    try:
+        cache = profile_cache.ProfileCache(
+            cache_dir=cache_path,
+            key="\t".join([str(per_read), taxdmp_tools.get_taxonomy_version(taxonomy)]))
+    except OSError:
+        print(f"Cannot write count cache {cache_path}", file=sys.stderr)
+        cache = None
+    with run_metrics.stage("parse") as stage:
+        tool_counts = count_tool_profiles(tool_profiles=tool_profiles, workers=workers,
+                                          per_read=per_read, cache=cache, reuse=update,
+                                          run_metrics=run_metrics)
+        stage["samples"] = sum(len(taxid_counts) for taxid_counts in tool_counts.values())
 
-    taxa = taxdmp_tools.create_taxa(taxonomy = taxonomy)
-    profiles = get_sample_profiles(samplesheet_fp = samplesheet_fp)
-    raw_profile_data = parse_profiles(profiles=profiles, classifier=tool)
-    standardised_data = standardise_profiles(data=raw_profile_data,
-                        classifier=tool, summarise_at=summarise_at, taxa=taxa)
-
-    if summarise_at:
-        taxid_map = taxdmp_tools.map_taxids_to_higher(taxids=standardised_data["taxonomy_id"],
-                                         target_rank=summarise_at, taxa=taxa)
-        summarised_data = summarise_data_at(
-            data=standardised_data, taxa=taxa, taxid_map=taxid_map)
-        wide_summarised_data = format_tax_data(summarised_data)
-        wide_summarised_data.to_csv(Path(
-            str(output_file.parent) + "/" + output_file.stem + ".sum_to_species.tsv"), sep="\t")
-        
-    wide_data = format_tax_data(standardised_data)
-    wide_data.to_csv(output_file, sep="\t")
+    long_tables = {"standardised": [], "summarised": []}
+    for tool_name, taxid_counts in tool_counts.items():
+        tool_output_file = output_file
+        if multi_tool:
+            tool_output_file = output_file.with_name(
+                output_file.stem + "." + tool_name + output_file.suffix)
+        with run_metrics.stage("standardise") as stage:
+            if clades:
+                taxid_counts = filter_clade_counts(taxid_counts=taxid_counts, clades=clades,
+                                                   taxa=taxa)
+            standardised_data = standardise_counts(taxid_counts=taxid_counts, taxa=taxa,
+                                                   annotations=annotations)
+            stage["rows"] = len(standardised_data)
+            if multi_tool:
+                stage["tool"] = tool_name
+                long_tables["standardised"].append(standardised_data.assign(tool=tool_name))
+
+        if summarise_at:
+            with run_metrics.stage("summarise") as stage:
+                taxid_map = taxdmp_tools.map_taxids_to_higher(taxids=standardised_data["taxonomy_id"],
+                                                 target_rank=summarise_at, taxa=taxa)
+                summarised_data = summarise_data_at(
+                    data=standardised_data, taxa=taxa, taxid_map=taxid_map,
+                    annotations=annotations)
+                stage["rows"] = len(summarised_data)
+                if multi_tool:
+                    stage["tool"] = tool_name
+                    long_tables["summarised"].append(summarised_data.assign(tool=tool_name))
+            with run_metrics.stage("output_summarised"):
+                write_tax_data(long_data=summarised_data, output_format=output_format,
+                               output_file=Path(str(tool_output_file.parent) + "/"
+                                                + tool_output_file.stem + ".sum_to_species.tsv"))
+
+        with run_metrics.stage("output"):
+            write_tax_data(long_data=standardised_data, output_format=output_format,
+                           output_file=tool_output_file)
+
+    if multi_tool:
+        with run_metrics.stage("output_combined"):
+            write_long_data(long_tables=long_tables["standardised"],
+                            output_format=output_format, output_file=output_file)
+            if summarise_at:
+                write_long_data(long_tables=long_tables["summarised"],
+                                output_format=output_format,
+                                output_file=Path(str(output_file.parent) + "/"
+                                                 + output_file.stem + ".sum_to_species.tsv"))
+    run_metrics.write()
 
 def taxid_map_to_df(taxid_map: dict):
     df = pandas.DataFrame(
@@ -82,36 +206,134 @@ def taxid_map_to_df(taxid_map: dict):
     )
     return(df)
 
-def summarise_data_at(data: pandas.DataFrame, taxa: dict, taxid_map: dict):
+def summarise_data_at(data: pandas.DataFrame, taxa: dict, taxid_map: dict,
+                      annotations: dict = None):
     summarised_data = data[data.taxonomy_id.isin(list(taxid_map.keys()))].copy()
     summarised_data.loc[:,"taxonomy_id"] = [taxid_map[x] for x in summarised_data["taxonomy_id"]]
     summarised_data = summarised_data.groupby(
         ["taxonomy_id", "sample"], as_index=False).aggregate({"num_reads": "sum"})
-    summarised_data["name"] = [taxa[taxid]["name"]
-                               for taxid in summarised_data["taxonomy_id"]]
-    summarised_data["rank"] = [taxa[taxid]["rank"]
-                               for taxid in summarised_data["taxonomy_id"]]
-    summarised_data["lineage"] = get_lineages_from_taxids(
-        taxids=summarised_data["taxonomy_id"], taxa=taxa)
-    return(summarised_data)
-
-def standardise_profiles(data: dict, classifier: str, taxa: dict, summarise_at: str):
-    std_data = {"sample": [], "taxonomy_id": [], "name": [], "rank": [],
-                "num_reads": [], "lineage": []}
-    for sample in data:
-        taxid_counts = get_taxid_counts(classifier)(data=data[sample])
-        std_data["sample"].extend([sample for i in range(len(taxid_counts))])
-        std_data["taxonomy_id"].extend([taxid for taxid in taxid_counts.keys()])
-        std_data["num_reads"].extend([count for count in taxid_counts.values()])    
-        std_data["name"] = list(map(
-            lambda taxid: taxdmp_tools.get_taxon_name(taxid, taxa),
-            std_data["taxonomy_id"]))
-        std_data["rank"] = list(map(
-            lambda taxid: taxdmp_tools.get_taxon_rank(taxid, taxa),
-            std_data["taxonomy_id"]))
-        std_data["lineage"] = get_lineages_from_taxids(
-            taxids=std_data["taxonomy_id"], taxa=taxa)
-    return(pandas.DataFrame(std_data).astype({"taxonomy_id": int, "num_reads": int}))
+    return(annotate_taxa(data=summarised_data, taxa=taxa, annotations=annotations))
+
+def standardise_profiles(data: dict, classifier: str, taxa: dict, summarise_at: str,
+                         annotations: dict = None):
+    taxid_counts = {
+        sample: get_taxid_counts(classifier)(data=data[sample]) for sample in data
+    }
+    return(standardise_counts(taxid_counts=taxid_counts, taxa=taxa, annotations=annotations))
+
+def standardise_counts(taxid_counts: dict, taxa: dict, annotations: dict = None):
+    std_data = {"sample": [], "taxonomy_id": [], "num_reads": []}
+    for sample in taxid_counts:
+        std_data["sample"].extend([sample for i in range(len(taxid_counts[sample]))])
+        std_data["taxonomy_id"].extend([taxid for taxid in taxid_counts[sample].keys()])
+        std_data["num_reads"].extend([count for count in taxid_counts[sample].values()])
+    std_data = pandas.DataFrame(std_data).astype({"taxonomy_id": int, "num_reads": int})
+    annotated_data = annotate_taxa(data=std_data, taxa=taxa, annotations=annotations)
+    return(annotated_data[["sample", "taxonomy_id", "name", "rank", "num_reads", "lineage"]])
+
+def filter_clade_counts(taxid_counts: dict, clades: tuple, taxa: dict):
+    # only keep the counts of taxa within one of the clades
+    clade_counts = {}
+    for sample, counts in taxid_counts.items():
+        taxids = list(counts)
+        in_clades = taxdmp_tools.are_in_clades(
+            numpy.array(taxids, dtype=numpy.int64), clades=clades, taxa=taxa)
+        clade_counts[sample] = {taxids[i]: counts[taxids[i]]
+                                for i in numpy.flatnonzero(in_clades).tolist()}
+    return(clade_counts)
+
+def count_profiles(profiles: dict, classifier: str, workers: int = 1, per_read: bool = False,
+                   cache: profile_cache.ProfileCache = None, reuse: bool = True,
+                   run_metrics: metrics.Metrics = None):
+    return(count_tool_profiles(tool_profiles={classifier: profiles}, workers=workers,
+                               per_read=per_read, cache=cache, reuse=reuse,
+                               run_metrics=run_metrics)[classifier])
+
+def count_tool_profiles(tool_profiles: dict, workers: int = 1, per_read: bool = False,
+                        cache: profile_cache.ProfileCache = None, reuse: bool = True,
+                        run_metrics: metrics.Metrics = None) -> dict:
+    # parse and count the sample profiles of all tools in one pool, so tools
+    # run concurrently, keeping tool and samplesheet order.
+    # New counts are written to the cache, and with reuse only profiles
+    # without cached counts are parsed.
+    jobs = [(tool, sample) for tool in tool_profiles for sample in tool_profiles[tool]]
+    taxid_counts = {}
+    if cache is not None and reuse:
+        for tool, sample in jobs:
+            cached_counts = cache.load(tool_profiles[tool][sample], prefix=tool)
+            if cached_counts is not None:
+                taxid_counts[(tool, sample)] = cached_counts
+        print(f"Reusing cached counts of {len(taxid_counts)} samples, "
+              f"processing {len(jobs) - len(taxid_counts)} samples", file=sys.stderr)
+    new_jobs = [job for job in jobs if job not in taxid_counts]
+    new_counts = pool_tools.map_samples(count_tool_profile,
+                                        [(tool_profiles[tool][sample], tool)
+                                         for tool, sample in new_jobs],
+                                        workers=workers, per_read=per_read,
+                                        with_metrics=metrics.is_enabled(run_metrics))
+    if metrics.is_enabled(run_metrics):
+        new_counts, records = pool_tools.split_metrics(new_counts)
+        run_metrics.add_samples(
+            "parse_sample",
+            [sample if len(tool_profiles) == 1 else f"{tool}/{sample}" for tool, sample in new_jobs],
+            records)
+    for (tool, sample), counts in zip(new_jobs, new_counts):
+        taxid_counts[(tool, sample)] = counts
+        if cache is not None:
+            cache.save(tool_profiles[tool][sample], counts, prefix=tool)
+    if cache is not None:
+        cache.save_hashes()
+    return({tool: {sample: taxid_counts[(tool, sample)] for sample in tool_profiles[tool]}
+            for tool in tool_profiles})
+
+def count_tool_profile(job: tuple, per_read: bool = False):
+    profile_path, classifier = job
+    return(count_profile(profile_path, classifier=classifier, per_read=per_read))
+
+def count_profile(profile_path: Path, classifier: str, per_read: bool = False):
+    if per_read:
+        return(count_per_read_profile(profile_path, classifier))
+    return(get_taxid_counts(classifier)(data=parse_profile(profile_path, classifier)))
+
+def count_per_read_profile(profile_path: Path, classifier: str, chunk_size: int = 1000000):
+    chunks = extract_positive_reads.iter_profile_chunks(
+        profile_path=str(profile_path), classifier=classifier, chunk_size=chunk_size)
+    return(count_taxids(chunk["taxid"] for chunk in chunks))
+
+def count_taxids(taxid_chunks) -> dict:
+    """
+    Count reads per taxid over an iterable of per-read taxid arrays,
+    ignoring unclassified (taxid 0) reads.
+    """
+    taxid_counts = {}
+    for taxids in taxid_chunks:
+        taxids = numpy.asarray(taxids, dtype=numpy.int64)
+        chunk_taxids, chunk_counts = numpy.unique(taxids[taxids > 0], return_counts=True)
+        for taxid, count in zip(chunk_taxids.tolist(), chunk_counts.tolist()):
+            taxid_counts[taxid] = taxid_counts.get(taxid, 0) + count
+    return(taxid_counts)
+
+def annotate_taxa(data: pandas.DataFrame, taxa: dict, annotations: dict = None):
+    """
+    Join name, rank and lineage columns onto a long table by taxonomy_id.
+    Each distinct taxid is annotated once and memoised in annotations.
+    """
+    if annotations is None:
+        annotations = {}
+    new_taxids = [taxid for taxid in data["taxonomy_id"].unique().tolist()
+                  if taxid not in annotations]
+    names = [taxdmp_tools.get_taxon_name(taxid, taxa) for taxid in new_taxids]
+    ranks = [taxdmp_tools.get_taxon_rank(taxid, taxa) for taxid in new_taxids]
+    lineages = get_lineages_from_taxids(taxids=new_taxids, taxa=taxa)
+    for taxid, name, rank, lineage in zip(new_taxids, names, ranks, lineages):
+        annotations[taxid] = (name, rank, lineage)
+
+    taxids = data["taxonomy_id"].unique().tolist()
+    annotation_table = pandas.DataFrame(
+        [(taxid, *annotations[taxid]) for taxid in taxids],
+        columns=["taxonomy_id", "name", "rank", "lineage"]
+    ).astype({"taxonomy_id": data["taxonomy_id"].dtype})
+    return(data.merge(annotation_table, on="taxonomy_id", how="left"))
 
 def get_taxid_counts(classifier):
     match classifier:
@@ -131,12 +353,7 @@ def get_k2_counts(data: dict):
     return(taxid_counts)
 
 def get_diamond_counts(data: dict):
-    taxids = list({taxid for taxid in data["taxonomy_id"] if taxid > 0})
-    taxid_counts = {}
-    for taxid in taxids:
-        num_reads = len([None for n in data["taxonomy_id"] if n == taxid])
-        taxid_counts[taxid] = num_reads
-    return(taxid_counts)
+    return(count_taxids([data["taxonomy_id"]]))
 
 def get_sylph_counts(data: dict):
     taxid_counts = {
@@ -151,42 +368,62 @@ def get_lineages_from_taxids(taxids: list[int], taxa: dict):
     lineages = []
     for taxid in taxids:
         if taxid == 0:
-            return("")
+            lineages.append("")
+            continue
         lineages.append(format_lineage(taxdmp_tools.get_lineage(
             first_taxid=taxid, taxa=taxa, wanted_ranks=wanted_ranks
         )))
     return(lineages)
 
-def get_sample_profiles(samplesheet_fp: TextIO):
-    # skip samplesheet file header
-    next(samplesheet_fp)
+def get_tool_profiles(samplesheet_fp: TextIO, tool: str = None) -> dict:
+    """
+    {tool: {sample: profile path}} from either a sample/profile samplesheet
+    of a single tool, or a samplesheet with one profile column per classifier
+    (as used by extract_positive_reads). Samples with an empty profile cell
+    are left out for that tool.
+    """
+    header = [column.strip() for column in next(samplesheet_fp).split(sep="\t")]
+    tool_columns = {column: i for i, column in enumerate(header) if column in CLASSIFIERS}
+    if tool is not None:
+        if tool in tool_columns:
+            tool_columns = {tool: tool_columns[tool]}
+        else:
+            tool_columns = {tool: 1}
+    elif not tool_columns:
+        raise click.UsageError(
+            "Samplesheet has no classifier columns "
+            f"({', '.join(CLASSIFIERS)}). Give the classifier with --tool")
 
-    profiles = {}
+    tool_profiles = {tool_name: {} for tool_name in tool_columns}
     for line in samplesheet_fp:
         if not line.strip():
             continue
         fields = line.split(sep="\t")
         sample = fields[0].strip()
-        profile_path = Path(fields[1].strip())
-        profiles[sample] = profile_path
-    return(profiles)
+        for tool_name, column in tool_columns.items():
+            if column < len(fields) and fields[column].strip():
+                tool_profiles[tool_name][sample] = Path(fields[column].strip())
+    return(tool_profiles)
 
 def parse_profiles(profiles: dict, classifier: str):
     profile_data = {}
     for sample in profiles:
-        with open(profiles[sample], "r") as profile_fp:
-            profile = profile_fp.readlines()
-        match classifier:
-            case "kraken2" | "metabuli":
-                profile_data[sample] = parse_k2_style_report(report=profile)
-            case "sylph":
-                profile_data[sample] = parse_sylph_profile(profile=profile)
-            case "diamond":
-                profile_data[sample] = parse_diamond_report(report=profile)
-            case "metacache":
-                profile_data[sample] = parse_metacache_report(report=profile)
+        profile_data[sample] = parse_profile(profiles[sample], classifier)
     return(profile_data)
 
+def parse_profile(profile_path: Path, classifier: str):
+    with compression_tools.open_input(profile_path) as profile_fp:
+        profile = profile_fp.readlines()
+    match classifier:
+        case "kraken2" | "metabuli":
+            return(parse_k2_style_report(report=profile))
+        case "sylph":
+            return(parse_sylph_profile(profile=profile))
+        case "diamond":
+            return(parse_diamond_report(report=profile))
+        case "metacache":
+            return(parse_metacache_report(report=profile))
+
 def format_tax_data(long_data: dict):
     wide_data = pandas.DataFrame(long_data).pivot_table(
         index=["taxonomy_id","name","rank","lineage"],
@@ -196,6 +433,51 @@ def format_tax_data(long_data: dict):
         fill_value=0)
     return(wide_data)
 
+def write_tax_data(long_data: pandas.DataFrame, output_file: Path, output_format: str = "tsv"):
+    # sparse outputs are written as <stem>.counts.<ext> and <stem>.taxa.<ext>
+    # next to output_file
+    if output_format == "tsv":
+        format_tax_data(long_data).to_csv(output_file, sep="\t")
+        return
+    counts, taxa_table = format_sparse_tax_data(long_data)
+    output_base = str(output_file.parent) + "/" + output_file.stem
+    match output_format:
+        case "parquet":
+            counts.to_parquet(output_base + ".counts.parquet", index=False)
+            taxa_table.to_parquet(output_base + ".taxa.parquet", index=False)
+        case "arrow":
+            counts.to_feather(output_base + ".counts.arrow")
+            taxa_table.to_feather(output_base + ".taxa.arrow")
+
+def write_long_data(long_tables: list, output_file: Path, output_format: str = "tsv"):
+    # combined long table of several tools, written as <stem>.long.<ext>
+    # next to output_file
+    long_data = pandas.concat(long_tables, ignore_index=True)[
+        ["tool", "sample", "taxonomy_id", "name", "rank", "num_reads", "lineage"]]
+    output_base = str(output_file.parent) + "/" + output_file.stem + ".long"
+    match output_format:
+        case "tsv":
+            long_data.to_csv(output_base + ".tsv", sep="\t", index=False)
+        case "parquet":
+            long_data.to_parquet(output_base + ".parquet", index=False)
+        case "arrow":
+            long_data.to_feather(output_base + ".arrow")
+
+def format_sparse_tax_data(long_data: pandas.DataFrame):
+    """
+    Long-format non-zero counts (taxonomy_id, sample, num_reads) and a table
+    with the name, rank and lineage of each taxon stored once.
+    """
+    long_data = pandas.DataFrame(long_data)
+    counts = long_data.groupby(["taxonomy_id", "sample"], as_index=False, sort=True).aggregate(
+        {"num_reads": "sum"})
+    counts = counts.loc[counts["num_reads"] != 0].reset_index(drop=True)
+    counts = counts.astype({"taxonomy_id": "int32", "num_reads": "int64",
+                            "sample": pandas.CategoricalDtype(sorted(long_data["sample"].unique()))})
+    taxa_table = long_data.drop_duplicates("taxonomy_id").sort_values("taxonomy_id")[
+        ["taxonomy_id", "name", "rank", "lineage"]].astype({"taxonomy_id": "int32"})
+    return(counts, taxa_table.reset_index(drop=True))
+
 def parse_k2_style_report(report: list):
     columns = ("percent", "clade_reads", "taxon_reads", "taxonomy_lvl",
                "taxonomy_id", "name")
@@ -1,8 +1,20 @@
 #!/usr/bin/env python3
 
 import click
+import json
+import os
+import signal
+import socket
+import socketserver
+import threading
 import taxdmp_tools
-from typing import TextIO
+import accession_tools
+import blast_tools
+import fastq_tools
+import metrics
+from pathlib import Path
+from itertools import islice
+from typing import Iterable, TextIO
 import sys
 
 option_taxonomy = click.option(
@@ -14,8 +26,24 @@ option_taxonomy = click.option(
 )
 
 @click.group(help="CLI tool to extract information from NCBI taxa")
-def cli():
-    pass
+@metrics.metrics_options
+@click.pass_context
+def cli(ctx: click.Context, metrics_path: str, profile_stage: str):
+    ctx.obj = metrics.Metrics(command=f"taxontools {ctx.invoked_subcommand}",
+                              path=metrics_path, profile_stage=profile_stage)
+    ctx.call_on_close(ctx.obj.write)
+
+@cli.command(help="Compile NCBI taxdump files into a memory-mappable cache")
+@option_taxonomy
+@click.pass_obj
+def compile(run_metrics: metrics.Metrics, taxonomy: str):
+    with run_metrics.stage("compile"):
+        taxa = taxdmp_tools.create_taxa(taxonomy=taxonomy)
+        taxa.rank_ancestors
+        taxa.tree
+        taxa.names
+    print(f"Compiled {len(taxa)} taxa to {taxonomy}/{taxdmp_tools.TAXA_CACHE}",
+          file=sys.stderr)
 
 @cli.command(help="Get ancestor taxon at a given taxonomic rank")
 @option_taxonomy
@@ -43,18 +71,400 @@ def cli():
    default=False,
    help="Print ancestor taxon rank"
 )
-def taxid2ancestor(input_fp: str, target_rank: str, name: bool, rank: bool, taxonomy: str):
-    taxids = [line.strip() for line in input_fp]
-    taxa = taxdmp_tools.create_taxa(taxonomy=taxonomy)
+@click.option(
+   "--socket",
+   "socket_path",
+   type=click.Path(dir_okay=False),
+   help="Unix socket of a running taxontools serve process to query instead of "
+        "loading the taxonomy (falls back to loading it if the server is not running)"
+)
+@click.option(
+   "--batch-size",
+   "batch_size",
+   type=click.INT,
+   default=10000,
+   show_default=True,
+   help="Number of output lines buffered before writing"
+)
+@click.pass_obj
+def taxid2ancestor(run_metrics: metrics.Metrics, input_fp: str, target_rank: str, name: bool,
+                   rank: bool, taxonomy: str, socket_path: str, batch_size: int):
+    request = {"taxonomy": os.path.realpath(taxonomy), "target_rank": target_rank,
+               "name": name, "rank": rank, "batch_size": batch_size}
+    if socket_path:
+        try:
+            with run_metrics.stage("server_lookup"):
+                query_server(socket_path=socket_path, request=request,
+                             lines=input_fp, output_fp=sys.stdout)
+            return
+        except (ConnectionRefusedError, FileNotFoundError):
+            print(f"No taxontools server at {socket_path}. Loading taxonomy.",
+                  file=sys.stderr)
+    with run_metrics.stage("taxonomy_load"):
+        taxa = taxdmp_tools.create_taxa(taxonomy=taxonomy)
+    with run_metrics.stage("lookup") as stage:
+        stage["rows"] = stream_ancestors(lines=input_fp, output_fp=sys.stdout, taxa=taxa,
+                                         target_rank=target_rank, name=name, rank=rank,
+                                         batch_size=batch_size)
+
+@cli.command(help="Keep the taxonomy loaded and answer taxid2ancestor queries on a Unix socket")
+@option_taxonomy
+@click.option(
+   "--socket",
+   "socket_path",
+   required=True,
+   type=click.Path(dir_okay=False),
+   help="Path of the Unix socket to listen on"
+)
+@click.pass_obj
+def serve(run_metrics: metrics.Metrics, taxonomy: str, socket_path: str):
+    with run_metrics.stage("taxonomy_load"):
+        taxa = taxdmp_tools.create_taxa(taxonomy=taxonomy)
+        if isinstance(taxa, taxdmp_tools.Taxa):
+            taxa.rank_ancestors
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = TaxonomyServer(socket_path, TaxonomyRequestHandler)
+    server.taxa = taxa
+    server.taxonomy = os.path.realpath(taxonomy)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Serving {taxonomy} on {socket_path}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+class TaxonomyServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
 
-    for taxid in taxids:
+class TaxonomyRequestHandler(socketserver.StreamRequestHandler):
+    # first line: json request, remaining lines: taxids (until EOF)
+    def handle(self):
+        lines = (line.decode() for line in self.rfile)
+        request = json.loads(next(lines))
+        writer = SocketWriter(self.wfile)
         try:
-            ancestor_taxid = taxdmp_tools.get_ancestor_at_rank(
-                first_taxid=int(taxid), target_rank=target_rank, taxa=taxa
-            )
-            print(format_taxon_output(taxid=ancestor_taxid, name=name, rank=rank, taxa=taxa))
-        except ValueError:
-            print(taxid)
+            if request["taxonomy"] != self.server.taxonomy:
+                raise ValueError(f"server taxonomy is {self.server.taxonomy}")
+            stream_ancestors(lines=lines, output_fp=writer, taxa=self.server.taxa,
+                             target_rank=request["target_rank"], name=request["name"],
+                             rank=request["rank"], batch_size=request["batch_size"],
+                             strict=True)
+        except LookupError as error:
+            writer.write(f"{SERVER_ERROR}\t{error.args[0]}\n")
+        except Exception as error:
+            writer.write(f"{SERVER_ERROR}\t{error!r}\n")
+
+class SocketWriter:
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text: str):
+        self.wfile.write(text.encode())
+
+    def flush(self):
+        self.wfile.flush()
+
+SERVER_ERROR = "#ERROR"
+
+def query_server(socket_path: str, request: dict, lines: Iterable[str], output_fp: TextIO):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        # the server answers while it still reads taxids, so they are sent from
+        # another thread and answers are copied out as they arrive
+        send_errors = []
+        sender = threading.Thread(target=send_request, daemon=True,
+                                  args=(client, request, lines, send_errors))
+        sender.start()
+        with client.makefile("r") as response_fp:
+            for line in response_fp:
+                if line.startswith(SERVER_ERROR):
+                    raise click.ClickException(line.rstrip("\n").split("\t", 1)[-1])
+                output_fp.write(line)
+        sender.join()
+        if send_errors:
+            raise send_errors[0]
+
+def send_request(client: socket.socket, request: dict, lines: Iterable[str], errors: list):
+    try:
+        with client.makefile("wb") as request_fp:
+            request_fp.write((json.dumps(request) + "\n").encode())
+            for line in lines:
+                request_fp.write(line.encode())
+        client.shutdown(socket.SHUT_WR)
+    except Exception as error:
+        errors.append(error)
+
+def stream_ancestors(lines: Iterable[str], output_fp: TextIO, taxa: dict, target_rank: str,
+                     name: bool, rank: bool, batch_size: int = 10000, strict: bool = False):
+    # answer taxids as they are read, looking each distinct taxid up once.
+    # With strict, unknown taxids raise a LookupError (the server replies
+    # with an error instead of printing a warning on its own stdout).
+    # Returns the number of answered lines.
+    answers = {}
+    output = []
+    num_lines = 0
+    for line in lines:
+        num_lines += 1
+        taxid = line.strip()
+        if taxid not in answers:
+            try:
+                if strict and int(taxid) > 1 and int(taxid) not in taxa:
+                    raise LookupError(f"Unknown taxid {taxid}. Unable to get ancestor.")
+                ancestor_taxid = taxdmp_tools.get_ancestor_at_rank(
+                    first_taxid=int(taxid), target_rank=target_rank, taxa=taxa
+                )
+                answers[taxid] = format_taxon_output(
+                    taxid=ancestor_taxid, name=name, rank=rank, taxa=taxa)
+            except ValueError:
+                answers[taxid] = taxid
+        output.append(answers[taxid])
+        if len(output) >= batch_size:
+            output_fp.write("\n".join(output) + "\n")
+            output_fp.flush()
+            output = []
+    if output:
+        output_fp.write("\n".join(output) + "\n")
+    output_fp.flush()
+    return(num_lines)
+
+@cli.command(help="Map sequence accessions to taxonomic IDs")
+@option_taxonomy
+@click.option(
+   "--input",
+   "input_fp",
+   type=click.File('r'),
+   default=sys.stdin,
+   help="File with sequence accessions, one per line"
+)
+@click.option(
+   "--seq-type",
+   "seq_type",
+   type=click.Choice(sorted(accession_tools.ACCESSION2TAXID_FILES)),
+   default="nucl",
+   show_default=True,
+   help="Type of accession2taxid files to search in the taxonomy directory"
+)
+@click.option(
+   "--accession2taxid",
+   "accession2taxid_paths",
+   type=click.Path(dir_okay=False, exists=True),
+   multiple=True,
+   help="accession2taxid file(s) to search instead of those in the taxonomy directory"
+)
+@click.option(
+   "--batch-size",
+   "batch_size",
+   type=click.INT,
+   default=1000000,
+   show_default=True,
+   help="Number of accessions looked up at a time"
+)
+@click.pass_obj
+def acc2taxid(run_metrics: metrics.Metrics, input_fp: TextIO, seq_type: str,
+              accession2taxid_paths: tuple, batch_size: int, taxonomy: str):
+    with run_metrics.stage("index_load"):
+        if accession2taxid_paths:
+            index = accession_tools.AccessionIndex(accession2taxid_paths)
+        else:
+            index = accession_tools.create_accession_index(taxonomy=taxonomy, seq_type=seq_type)
+    accessions = (line.strip() for line in input_fp if line.strip())
+    with run_metrics.stage("lookup") as stage:
+        stage["rows"] = 0
+        while batch := list(islice(accessions, batch_size)):
+            taxids = index.lookup(batch)
+            sys.stdout.write("".join(
+                f"{accession}\t{taxid}\n" for accession, taxid in zip(batch, taxids.tolist())))
+            stage["rows"] += len(batch)
+
+@cli.command(name="summarise-blast",
+             help="Summarise BLAST hits of sample reads to a taxonomic rank")
+@option_taxonomy
+@click.option(
+   "--samplesheet",
+   "samplesheet_fp",
+   required=True,
+   type=click.File('r'),
+   help="tsv samplesheet with sample, BLAST csv and FASTA query columns"
+)
+@click.option(
+   "--outdir",
+   "outdir",
+   required=True,
+   type=click.Path(file_okay=False),
+   help="Output directory"
+)
+@click.option(
+   "--min-qlen",
+   "min_qlen",
+   type=click.INT,
+   default=50,
+   show_default=True,
+   help="Discard hits with a shorter query length"
+)
+@click.option(
+   "--summarise-at",
+   "summarise_at",
+   default="species",
+   show_default=True,
+   type=click.STRING,
+   help="Taxonomic rank to summarise hit taxa to"
+)
+@click.option(
+   "--taxmap",
+   "taxmap_fp",
+   type=click.File('r'),
+   help="File mapping accessions to taxids (first two columns) to use instead of the "
+        "accession2taxid files in the taxonomy directory"
+)
+@click.option(
+   "--workers",
+   "workers",
+   type=click.INT,
+   default=1,
+   show_default=True,
+   help="Number of samples processed in parallel"
+)
+@click.pass_obj
+def summarise_blast(run_metrics: metrics.Metrics, samplesheet_fp: TextIO, outdir: str,
+                    min_qlen: int, summarise_at: str, taxmap_fp: TextIO, workers: int,
+                    taxonomy: str):
+    with run_metrics.stage("taxonomy_load"):
+        taxa = taxdmp_tools.create_taxa(taxonomy=taxonomy)
+    samples = blast_tools.parse_blast_samplesheet(samplesheet_fp)
+    with run_metrics.stage("index_load"):
+        if taxmap_fp:
+            taxmap, accession_index = blast_tools.parse_taxmap(taxmap_fp), None
+        else:
+            taxmap, accession_index = None, accession_tools.create_accession_index(taxonomy=taxonomy)
+    with run_metrics.stage("summarise"):
+        blast_tools.summarise_blast(samples=samples, outdir=Path(outdir), taxa=taxa,
+                                    min_qlen=min_qlen, summarise_at=summarise_at,
+                                    accession_index=accession_index, taxmap=taxmap,
+                                    workers=workers, run_metrics=run_metrics)
+
+@cli.command(name="lca-hits",
+             help="Collapse multi-hit BLAST/DIAMOND tabular output to the lowest common "
+                  "ancestor of the hit taxa of each read")
+@option_taxonomy
+@click.option(
+   "--input",
+   "hits_path",
+   required=True,
+   type=click.Path(dir_okay=False, exists=True),
+   help="BLAST csv (outfmt 10) or DIAMOND tsv (outfmt 6) with query and subject "
+        "IDs in the first two columns"
+)
+@click.option(
+   "--format",
+   "hit_format",
+   type=click.Choice(sorted(blast_tools.HIT_FORMATS)),
+   default="blast",
+   show_default=True,
+   help="Format of the hits, setting the column delimiter and the accession2taxid "
+        "files searched for hit accessions"
+)
+@click.option(
+   "--taxid-column",
+   "taxid_column",
+   type=click.IntRange(min=2),
+   help="Column number with hit taxids (e.g. staxids) to use instead of mapping "
+        "hit accessions"
+)
+@click.option(
+   "--taxmap",
+   "taxmap_fp",
+   type=click.File('r'),
+   help="File mapping accessions to taxids (first two columns) to use instead of the "
+        "accession2taxid files in the taxonomy directory"
+)
+@click.option(
+   "--min-qlen",
+   "min_qlen",
+   type=click.INT,
+   default=0,
+   show_default=True,
+   help="Discard hits with a shorter query length"
+)
+@click.option(
+   "--qlen-column",
+   "qlen_column",
+   type=click.IntRange(min=2),
+   default=5,
+   show_default=True,
+   help="Column number with the query length (qlen) of each hit, used with --min-qlen"
+)
+@click.option(
+   "--output",
+   "output_fp",
+   type=click.File('w'),
+   default="-",
+   help="Output tsv of read ID, LCA taxid and number of hits [default: stdout]"
+)
+@click.pass_obj
+def lca_hits(run_metrics: metrics.Metrics, hits_path: str, hit_format: str, taxid_column: int,
+             taxmap_fp: TextIO, min_qlen: int, qlen_column: int, output_fp: TextIO,
+             taxonomy: str):
+    with run_metrics.stage("taxonomy_load"):
+        taxa = taxdmp_tools.create_taxa(taxonomy=taxonomy)
+        taxa.tree
+    with run_metrics.stage("index_load"):
+        taxmap, accession_index = None, None
+        if taxmap_fp:
+            taxmap = blast_tools.parse_taxmap(taxmap_fp)
+        elif taxid_column is None:
+            accession_index = accession_tools.create_accession_index(
+                taxonomy=taxonomy, seq_type=blast_tools.HIT_FORMATS[hit_format][1])
+    with run_metrics.stage("collapse") as stage:
+        stage["rows"] = blast_tools.collapse_hits(
+            Path(hits_path), output_fp, taxa=taxa, hit_format=hit_format,
+            taxid_column=taxid_column and taxid_column - 1,
+            accession_index=accession_index, taxmap=taxmap, min_qlen=min_qlen,
+            qlen_column=qlen_column - 1)
+
+@cli.command(name="extract-reads",
+             help="Extract the positive reads of each sample and taxid into FASTA query files")
+@click.option(
+   "--positive-reads",
+   "positive_reads_fp",
+   required=True,
+   type=click.File('r'),
+   help="extract_positive_reads output with sample, fastq, taxid and reads columns"
+)
+@click.option(
+   "--outdir",
+   "outdir",
+   required=True,
+   type=click.Path(file_okay=False),
+   help="Output directory for <sample>.<taxid>.fa files"
+)
+@click.option(
+   "--index-dir",
+   "index_dir",
+   type=click.Path(file_okay=False),
+   help="Directory to keep the read indices of the fastq files in [default: next to "
+        "each fastq file]"
+)
+@click.option(
+   "--workers",
+   "workers",
+   type=click.INT,
+   default=1,
+   show_default=True,
+   help="Number of fastq files processed in parallel"
+)
+@click.pass_obj
+def extract_reads(run_metrics: metrics.Metrics, positive_reads_fp: TextIO, outdir: str,
+                  index_dir: str, workers: int):
+    with run_metrics.stage("extract") as stage:
+        extracted = fastq_tools.extract_positive_reads(
+            positive_reads_fp=positive_reads_fp, outdir=Path(outdir),
+            index_dir=index_dir and Path(index_dir), workers=workers,
+            run_metrics=run_metrics)
+        stage["rows"] = sum(num_written for num_written, _ in extracted)
 
 def format_taxon_output(taxid: int, name: bool, rank: bool, taxa: dict):
     fields = [str(taxid)]
@@ -0,0 +1,88 @@
+import io
+import os
+import random
+import sys
+import threading
+from pathlib import Path
+
+import click
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import taxdmp_tools
+import taxontools
+
+
+# (taxid, parent, rank) of a small taxonomy with two genera
+NODES = [
+    (1, 1, "no rank"),
+    (2, 1, "superkingdom"),
+    (10, 2, "genus"),
+    (11, 2, "genus"),
+    (100, 10, "species"),
+    (101, 10, "species"),
+    (110, 11, "species"),
+    (1100, 110, "strain"),
+]
+SPECIES = [100, 101, 110, 1100]
+
+
+@pytest.fixture
+def server(tmp_path):
+    taxonomy = tmp_path / "taxonomy"
+    taxonomy.mkdir()
+    with open(taxonomy / "nodes.dmp", "w") as nodes_fp:
+        for taxid, parent, rank in NODES:
+            nodes_fp.write(f"{taxid}\t|\t{parent}\t|\t{rank}\t|\tXX\t|\t0\t|\n")
+    with open(taxonomy / "names.dmp", "w") as names_fp:
+        for taxid, _, rank in NODES:
+            names_fp.write(f"{taxid}\t|\tTaxon {taxid} {rank}\t|\t\t|\tscientific name\t|\n")
+
+    socket_path = str(tmp_path / "taxontools.sock")
+    server = taxontools.TaxonomyServer(socket_path, taxontools.TaxonomyRequestHandler)
+    server.taxa = taxdmp_tools.create_taxa(taxonomy=str(taxonomy))
+    server.taxonomy = os.path.realpath(taxonomy)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield(server, socket_path)
+    server.shutdown()
+    server.server_close()
+
+def query(server, socket_path: str, lines: list) -> tuple[str, Exception]:
+    # output and error of query_server, run in a thread to catch deadlocks
+    request = {"taxonomy": server.taxonomy, "target_rank": "genus", "name": True,
+               "rank": False, "batch_size": 10000}
+    output_fp = io.StringIO()
+    errors = []
+    def run():
+        try:
+            taxontools.query_server(socket_path=socket_path, request=request,
+                                    lines=iter(lines), output_fp=output_fp)
+        except Exception as error:
+            errors.append(error)
+    client = threading.Thread(target=run, daemon=True)
+    client.start()
+    client.join(timeout=60)
+    assert not client.is_alive(), "client and server deadlocked"
+    return(output_fp.getvalue(), errors[0] if errors else None)
+
+def test_query_server_streams_more_than_socket_buffers(server):
+    server, socket_path = server
+    # several MB of taxids and answers, far more than the socket buffers hold
+    rng = random.Random(0)
+    lines = [f"{rng.choice(SPECIES)}\n" for _ in range(500000)]
+    output, error = query(server, socket_path, lines)
+    assert error is None
+
+    expected_fp = io.StringIO()
+    taxontools.stream_ancestors(lines=lines, output_fp=expected_fp, taxa=server.taxa,
+                                target_rank="genus", name=True, rank=False)
+    assert output == expected_fp.getvalue()
+    assert output.count("Taxon_10_genus") + output.count("Taxon_11_genus") == len(lines)
+
+def test_query_server_replies_with_an_error_for_unknown_taxids(server, capsys):
+    server, socket_path = server
+    output, error = query(server, socket_path, ["100\n", "999\n", "110\n"])
+    assert isinstance(error, click.ClickException)
+    assert "Unknown taxid 999" in error.message
+    assert "Unknown taxid" not in capsys.readouterr().out